@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from statistics import median
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# htseq-count statistics that are appended to each htseq file
+HTSEQ_STATISTICS = ['__no_feature', '__ambiguous', '__too_low_aQual', '__not_aligned', '__alignment_not_unique']
+
+
+def load_script(name, path):
+    """
+    Imports a script that isn't part of a package (e.g. scripts/pcc.py or helper/parse_gff.py)
+
+    :param name: name for the module
+    :param path: path to the script, relative to the LSTrAP directory
+    :return: the module
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def write_fasta(filename, names, lengths, alphabet, rng):
+    """
+    Writes random sequences to a fasta file, with 60 residues per line
+
+    :param filename: path to the output
+    :param names: list of sequence names
+    :param lengths: list with the length of each sequence
+    :param alphabet: string with the residues to draw from
+    :param rng: numpy random generator
+    """
+    letters = np.frombuffer(alphabet.encode('ascii'), dtype=np.uint8)
+
+    with open(filename, 'w') as f:
+        for name, length in zip(names, lengths):
+            sequence = letters[rng.integers(0, len(letters), length)].tobytes().decode('ascii')
+            print('>' + name, file=f)
+            for i in range(0, length, 60):
+                print(sequence[i:i + 60], file=f)
+
+
+def generate_data(directory, genes, samples, seed=42):
+    """
+    Generates a synthetic dataset: htseq-count files, a count matrix, cds and protein fasta files, a GFF3 file and the
+    blast tables, sequence ids and MCL families OrthoFinder produces
+
+    :param directory: directory to write the data to
+    :param genes: number of genes
+    :param samples: number of samples (htseq files)
+    :param seed: seed for the random generator (default = 42)
+    :return: dict with the paths to the data
+    """
+    rng = np.random.default_rng(seed)
+    names = ['gene%07d' % i for i in range(genes)]
+
+    data = {'genes': genes, 'samples': samples,
+            'htseq_dir': os.path.join(directory, 'htseq'),
+            'matrix': os.path.join(directory, 'exp_matrix.txt'),
+            'cds': os.path.join(directory, 'cds.fa'),
+            'proteins': os.path.join(directory, 'proteins.fa'),
+            'gff': os.path.join(directory, 'genes.gff3'),
+            'orthofinder': os.path.join(directory, 'orthofinder')}
+
+    os.makedirs(data['htseq_dir'], exist_ok=True)
+    os.makedirs(data['orthofinder'], exist_ok=True)
+
+    # counts follow a negative binomial distribution with gene specific means, like RNA-seq data
+    means = rng.lognormal(3, 2, genes)
+    counts = rng.negative_binomial(2, 2 / (2 + means[:, None]), (genes, samples))
+
+    for s in range(samples):
+        with open(os.path.join(data['htseq_dir'], 'sample%04d.htseq' % s), 'w') as f:
+            for name, count in zip(names, counts[:, s]):
+                print(name, count, sep='\t', file=f)
+            for statistic in HTSEQ_STATISTICS:
+                print(statistic, rng.integers(0, 100000), sep='\t', file=f)
+
+    with open(data['matrix'], 'w') as f:
+        print('gene', *['sample%04d.htseq' % s for s in range(samples)], sep='\t', file=f)
+        for name, row in zip(names, counts):
+            print(name, *row, sep='\t', file=f)
+
+    lengths = rng.integers(100, 1000, genes)
+    write_fasta(data['cds'], names, lengths * 3, 'ACGT', rng)
+    write_fasta(data['proteins'], names, [l if i % 10 else l - 1 for i, l in enumerate(lengths)],
+                'ACDEFGHIKLMNPQRSTVWY', rng)
+
+    # each gene has a single transcript with three exons
+    with open(data['gff'], 'w') as f:
+        print('##gff-version 3', file=f)
+        for i, (name, length) in enumerate(zip(names, lengths)):
+            start = i * 10000 + 1
+            stop = start + length * 3 + 600
+            print('chr1', 'bench', 'gene', start, stop, '.', '+', '.', 'ID=%s;Name=%s' % (name, name), sep='\t', file=f)
+            print('chr1', 'bench', 'mRNA', start, stop, '.', '+', '.', 'ID=%s.1;Parent=%s' % (name, name), sep='\t',
+                  file=f)
+            for e in range(3):
+                exon_start = start + e * (length + 300)
+                for feature in ['exon', 'CDS']:
+                    print('chr1', 'bench', feature, exon_start, exon_start + length - 1, '.', '+', '0',
+                          'Parent=%s.1' % name, sep='\t', file=f)
+
+    # OrthoFinder output: ten hits per gene, split over four blast files, and families of ten genes
+    with open(os.path.join(data['orthofinder'], 'SequenceIDs.txt'), 'w') as f:
+        for i, name in enumerate(names):
+            print('0_%d: %s' % (i, name), file=f)
+
+    hits = rng.integers(0, genes, (genes, 10))
+    for b in range(4):
+        with open(os.path.join(data['orthofinder'], 'Blast0_%d.txt' % b), 'w') as f:
+            for i in range(b, genes, 4):
+                for j in hits[i]:
+                    print('0_%d' % i, '0_%d' % j, '%.1f' % rng.uniform(30, 100), 300, 10, 0, 1, 300, 1, 300,
+                          '%.2g' % rng.uniform(0, 1e-5), '%.1f' % rng.uniform(50, 500), sep='\t', file=f)
+
+    with open(os.path.join(data['orthofinder'], 'mcl_families.unprocessed.txt'), 'w') as f:
+        order = rng.permutation(genes)
+        for i in range(0, genes, 10):
+            print('\t'.join('0_%d' % j for j in order[i:i + 10]), file=f)
+
+    return data
+
+
+def write_pipeline_config(data, directory):
+    """
+    Writes a config and data file to run the TranscriptomePipeline on the synthetic data (with the local scheduler)
+
+    :param data: dict with the paths to the data (see generate_data)
+    :param directory: directory for the ini files and output
+    :return: tuple with the path to the config and data file
+    """
+    config = os.path.join(directory, 'config.ini')
+    shutil.copy(os.path.join(ROOT, 'config.template.ini'), config)
+
+    output = os.path.join(directory, 'output')
+    data_file = os.path.join(directory, 'data.ini')
+
+    with open(data_file, 'w') as f:
+        print('[GLOBAL]\ngenomes=bench\nemail=None\n', file=f)
+        print('[bench]', file=f)
+        print('cds_fasta=%s' % data['cds'], file=f)
+        print('htseq_output=%s' % data['htseq_dir'], file=f)
+        for key, name in [('exp_matrix_output', 'exp_matrix.txt'), ('exp_matrix_tpm_output', 'exp_matrix.tpm.txt'),
+                          ('exp_matrix_rpkm_output', 'exp_matrix.rpkm.txt'),
+                          ('exp_matrix_cpm_output', 'exp_matrix.cpm.txt')]:
+            print('%s=%s' % (key, os.path.join(output, name)), file=f)
+
+    return config, data_file
+
+
+def bench_htseq_to_matrix(data, directory):
+    from pipeline.transcriptome import TranscriptomePipeline
+
+    config, data_file = write_pipeline_config(data, directory)
+    tp = TranscriptomePipeline(config, data_file, scheduler='LOCAL')
+
+    yield
+    tp.htseq_to_matrix()
+
+
+def bench_normalize(data, directory):
+    from pipeline.transcriptome import TranscriptomePipeline
+
+    config, data_file = write_pipeline_config(data, directory)
+    tp = TranscriptomePipeline(config, data_file, scheduler='LOCAL')
+    tp.htseq_to_matrix()
+
+    yield
+    tp.normalize()
+
+
+def bench_read_matrix(data, directory):
+    from utils.matrix import ExpressionMatrix
+
+    yield
+    ExpressionMatrix.read(data['matrix'], prefer_binary=False)
+
+
+def bench_read_matrix_binary(data, directory):
+    from utils.matrix import ExpressionMatrix
+
+    ExpressionMatrix.read(data['matrix'], prefer_binary=False).write(os.path.join(directory, 'matrix.txt'), binary=True)
+
+    yield
+    ExpressionMatrix.read(os.path.join(directory, 'matrix.txt'))
+
+
+def bench_normalize_matrix(data, directory):
+    from utils.matrix import ExpressionMatrix, read_gene_lengths
+
+    matrix = ExpressionMatrix.read(data['matrix'], prefer_binary=False)
+    lengths = read_gene_lengths(data['cds'], use_index=False)
+
+    yield
+    matrix.cpm()
+    matrix.rpkm(lengths)
+    matrix.tpm(lengths)
+
+
+def bench_write_matrix(data, directory):
+    from utils.matrix import ExpressionMatrix
+
+    matrix = ExpressionMatrix.read(data['matrix'], prefer_binary=False)
+
+    yield
+    matrix.write(os.path.join(directory, 'matrix.txt'))
+
+
+def bench_fasta_readfile(data, directory):
+    from utils.parser.fasta import Fasta
+
+    yield
+    Fasta().readfile(data['cds'])
+
+
+def bench_split_fasta(data, directory):
+    from pipeline.interpro import split_fasta
+
+    yield
+    split_fasta(data['proteins'], 100, os.path.join(directory, 'split'))
+
+
+def bench_orthology_mcl(data, directory):
+    from pipeline.orthology import concatenate_files, convert_mcl_families
+
+    orthofinder = data['orthofinder']
+    blast_files = sorted(os.path.join(orthofinder, f) for f in os.listdir(orthofinder) if f.startswith('Blast'))
+
+    yield
+    concatenate_files(blast_files, os.path.join(directory, 'full_blast.out'))
+    convert_mcl_families(os.path.join(orthofinder, 'SequenceIDs.txt'),
+                         os.path.join(orthofinder, 'mcl_families.unprocessed.txt'),
+                         os.path.join(directory, 'mcl_families.processed.txt'))
+
+
+def bench_parse_gff3(data, directory):
+    parse_gff = load_script('parse_gff', os.path.join('helper', 'parse_gff.py'))
+
+    yield
+    parse_gff.parse_gff3(data['gff'])
+
+
+def bench_pcc(data, directory):
+    pcc = load_script('pcc', os.path.join('scripts', 'pcc.py'))
+
+    yield
+    pcc.pcc(data['matrix'], os.path.join(directory, 'pcc.txt'), os.path.join(directory, 'pcc.mcl.txt'),
+            top_k=min(1000, data['genes'] - 1), prefer_binary=False)
+
+
+# Each benchmark is a generator, code before the yield is setup and not timed
+BENCHMARKS = {'htseq_to_matrix': bench_htseq_to_matrix,
+              'normalize': bench_normalize,
+              'read_matrix': bench_read_matrix,
+              'read_matrix_binary': bench_read_matrix_binary,
+              'normalize_matrix': bench_normalize_matrix,
+              'write_matrix': bench_write_matrix,
+              'fasta_readfile': bench_fasta_readfile,
+              'split_fasta': bench_split_fasta,
+              'orthology_mcl': bench_orthology_mcl,
+              'parse_gff3': bench_parse_gff3,
+              'pcc': bench_pcc}
+
+
+def max_rss():
+    """
+    :return: peak resident memory (KB) of this process and its child processes
+    """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def run_single(name, data_file, directory):
+    """
+    Runs a single benchmark, in a fresh process started by run_benchmark, and prints the results as JSON
+
+    :param name: name of the benchmark
+    :param data_file: JSON file with the paths to the data (see generate_data)
+    :param directory: empty directory for the output of the benchmark
+    """
+    with open(data_file) as f:
+        data = json.load(f)
+
+    benchmark = BENCHMARKS[name](data, directory)
+    next(benchmark)
+
+    baseline = max_rss()
+    stdout, sys.stdout = sys.stdout, sys.stderr
+
+    start = time.perf_counter()
+    for _ in benchmark:
+        pass
+    elapsed = time.perf_counter() - start
+
+    sys.stdout = stdout
+    print(json.dumps({'seconds': elapsed, 'baseline_rss_kb': baseline, 'peak_rss_kb': max_rss()}))
+
+
+def run_benchmark(name, data_file, directory, repeat):
+    """
+    Runs a benchmark a number of times, each time in a new process so the peak memory use is measured per run
+
+    :param name: name of the benchmark
+    :param data_file: JSON file with the paths to the data (see generate_data)
+    :param directory: directory for the output of the benchmark
+    :param repeat: number of runs
+    :return: dict with the time of each run, the median and minimum time and peak memory use
+    """
+    runs = []
+
+    for r in range(repeat):
+        run_directory = os.path.join(directory, '%s.%d' % (name, r))
+        os.makedirs(run_directory)
+
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), '--single', name, data_file,
+                                 run_directory], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ROOT)
+        shutil.rmtree(run_directory)
+
+        if result.returncode != 0:
+            print('Benchmark %s failed (exit code %d)' % (name, result.returncode), file=sys.stderr)
+            print(result.stderr.decode('utf-8'), file=sys.stderr)
+            return None
+
+        runs.append(json.loads(result.stdout.decode('utf-8').strip().split('\n')[-1]))
+
+    seconds = [r['seconds'] for r in runs]
+
+    return {'seconds': seconds, 'median': median(seconds), 'min': min(seconds),
+            'baseline_rss_kb': max(r['baseline_rss_kb'] for r in runs),
+            'peak_rss_kb': max(r['peak_rss_kb'] for r in runs)}
+
+
+def git_version():
+    """
+    :return: hash of the current commit or None if it can't be determined
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception as _:
+        return None
+
+
+def compare(results, previous):
+    """
+    Prints the change in run time and peak memory use compared to a previous run of the benchmarks
+
+    :param results: results of the current run
+    :param previous: results of a previous run (e.g. for another version of LSTrAP)
+    """
+    earlier = {(r['benchmark'], r['genes'], r['samples']): r for r in previous['results']}
+
+    print('\t'.join(['benchmark', 'genes', 'samples', 'median (s)', 'previous (s)', 'time ratio', 'peak RSS (KB)',
+                     'previous (KB)', 'memory ratio']))
+
+    for r in results['results']:
+        p = earlier.get((r['benchmark'], r['genes'], r['samples']))
+        if p is None:
+            continue
+
+        print(r['benchmark'], r['genes'], r['samples'], '%.3f' % r['median'], '%.3f' % p['median'],
+              '%.2f' % (r['median'] / p['median']) if p['median'] > 0 else 'NA', r['peak_rss_kb'], p['peak_rss_kb'],
+              '%.2f' % (r['peak_rss_kb'] / p['peak_rss_kb']), sep='\t')
+
+
+def run_benchmarks(args):
+    """
+    Generates data for each size and runs the selected benchmarks on it
+
+    :param args: Parsed arguments from argparse
+    """
+    selected = list(BENCHMARKS.keys()) if args.benchmarks is None else args.benchmarks.split(',')
+    unknown = [b for b in selected if b not in BENCHMARKS]
+
+    if len(unknown) > 0:
+        print('Unknown benchmarks %s, select from %s' % (', '.join(unknown), ', '.join(BENCHMARKS.keys())),
+              file=sys.stderr)
+        quit()
+
+    results = {'version': git_version(),
+               'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'platform': platform.platform(),
+               'repeat': args.repeat,
+               'results': []}
+
+    directory = tempfile.mkdtemp(prefix='lstrap_benchmark_', dir=args.tmp)
+
+    try:
+        for genes in [int(g) for g in args.genes.split(',')]:
+            data_directory = os.path.join(directory, 'data_%d' % genes)
+            print('Generating data for %d genes and %d samples...' % (genes, args.samples), file=sys.stderr)
+            data = generate_data(data_directory, genes, args.samples, seed=args.seed)
+
+            data_file = os.path.join(data_directory, 'data.json')
+            with open(data_file, 'w') as f:
+                json.dump(data, f)
+
+            for name in selected:
+                result = run_benchmark(name, data_file, directory, args.repeat)
+
+                if result is not None:
+                    print('%s\t%d genes\t%.3f s\t%d KB' % (name, genes, result['median'], result['peak_rss_kb']),
+                          file=sys.stderr)
+                    results['results'].append(dict(benchmark=name, genes=genes, samples=args.samples, **result))
+
+            shutil.rmtree(data_directory)
+    finally:
+        shutil.rmtree(directory)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print('Results written to %s' % args.output, file=sys.stderr)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="./benchmark.py",
+                                     description='Benchmarks the steps LSTrAP runs itself (rather than on the cluster) '
+                                                 'on synthetic data of different sizes.')
+
+    parser.add_argument('--genes', help='comma separated list with the number of genes of each dataset (default = 1000,10000)', default='1000,10000')
+    parser.add_argument('--samples', help='number of samples (htseq files) in each dataset (default = 50)', default=50, type=int)
+    parser.add_argument('--benchmarks', help='comma separated list of benchmarks to run (default: all), options are ' + ', '.join(BENCHMARKS.keys()), default=None)
+    parser.add_argument('--repeat', help='number of times each benchmark is run, the median time is reported (default = 3)', default=3, type=int)
+    parser.add_argument('--seed', help='seed used to generate the data (default = 42)', default=42, type=int)
+    parser.add_argument('--tmp', help='directory to generate the data in (default: system temporary directory)', default=None)
+    parser.add_argument('--output', help='path to write the results to, in JSON (default = benchmark.json)', default='benchmark.json')
+    parser.add_argument('--compare', help='results of a previous run (e.g. of another version) to compare with', default=None)
+    parser.add_argument('--single', help=argparse.SUPPRESS, nargs=3, default=None)
+
+    args = parser.parse_args()
+
+    if args.single is not None:
+        run_single(*args.single)
+    else:
+        run_benchmarks(args)
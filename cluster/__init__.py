@@ -1,77 +1,137 @@
-import re
 import sys
 
+from functools import lru_cache
 from subprocess import check_output, DEVNULL
-from time import sleep
 
+from cluster.schedulers import schedulers
 
+# scheduler used by the functions below, set with set_scheduler or detected on first use
+__scheduler = None
+
+
+@lru_cache(maxsize=None)
 def detect_cluster_system():
     """
     Checks which cluster manager is installed on the system, return "SGE" for Sun/Oracle Grid Engine, "PBS" for
-    PBS/Torque based systems and otherwise "other"
+    PBS/Torque based systems, "SLURM" for SLURM and otherwise "other". The result is cached, so this only checks the
+    system once.
 
-    :return: string "SBE", "PBS" or "other"
+    :return: string "SGE", "PBS", "SLURM" or "other"
     """
+    for system, executable in [("SGE", "sge_qmaster"), ("PBS", "pbs_sched"), ("SLURM", "sbatch")]:
+        try:
+            which_output = check_output(["which", executable], stderr=DEVNULL).decode("utf-8")
 
-    try:
-        which_output = check_output(["which", "sge_qmaster"], stderr=DEVNULL).decode("utf-8")
+            if "/" + executable in which_output:
+                return system
+        except Exception as _:
+            pass
 
-        if "/sge_qmaster" in which_output:
-            return "SGE"
-    except Exception as _:
-        pass
+    return "other"
 
-    try:
-        which_output = check_output(["which", "pbs_sched"], stderr=DEVNULL).decode("utf-8")
 
-        if "/pbs_sched" in which_output:
-            return "PBS"
-    except Exception as _:
-        pass
+def set_scheduler(name=None, cores=None):
+    """
+    Selects the scheduler to submit jobs to, if no name is provided the cluster manager is detected. Without a cluster
+    manager (and qsub) jobs are run on the local machine.
 
-    return "other"
+    :param name: SGE, PBS, SLURM or LOCAL (case insensitive) or None to detect the system (default = None)
+    :param cores: number of cores to use for local jobs, None to use all cores (default = None)
+    :return: the scheduler
+    """
+    global __scheduler
+
+    if name is None or name.lower() in ['', 'none', 'auto']:
+        name = detect_cluster_system()
+
+        if name not in schedulers:
+            try:
+                check_output(["which", "qsub"], stderr=DEVNULL)
+                print("Could not detect the cluster manager, assuming SGE.", file=sys.stderr)
+                name = "SGE"
+            except Exception as _:
+                print("No cluster manager found, running jobs locally.", file=sys.stderr)
+                name = "LOCAL"
+
+    if name.upper() not in schedulers:
+        print("Unsupported scheduler %s, select one of %s" % (name, ', '.join(schedulers.keys())), file=sys.stderr)
+        quit()
+
+    if name.upper() == "LOCAL":
+        __scheduler = schedulers["LOCAL"](cores=cores)
+    else:
+        __scheduler = schedulers[name.upper()]()
 
+    return __scheduler
 
-def job_running(job_name):
+
+def get_scheduler():
     """
-    Checks if a specific job is still running on a cluster using the qstat command
+    :return: the current scheduler, detected on first use if none was set
+    """
+    return set_scheduler() if __scheduler is None else __scheduler
 
-    :param job_name: name of the submitted script/jobname
-    :return: boolean true if the job is still running or in the queue
+
+def submit_job(script, job_name, options=None, variables=None, after=None):
+    """
+    Submits a job and keeps track of the job id, so job_running can check on this job specifically
+
+    :param script: path to the submission script
+    :param job_name: name of the job (as set in the submission script)
+    :param options: list with additional options for the scheduler (e.g. the qsub_* settings)
+    :param variables: variables passed to the job, as a string name=value,name=value
+    :param after: list of job ids, the job is held by the scheduler until these are done (default = None)
+    :return: job id (string) or None if the job id couldn't be determined
     """
+    return get_scheduler().submit(script, job_name, options=options, variables=variables, after=after)
 
-    running_jobs = []
-    c_system = detect_cluster_system()
 
-    if c_system == "SGE":
-        # Sun/Oracle Grid engine detected
-        qstat = check_output(["qstat", "-r"]).decode("utf-8")
+def submit_array_job(script, job_name, options=None, variables=None, after=None):
+    """
+    Submits a batch (array) job written with write_batch_submission_script
+
+    :param script: path to the submission script
+    :param job_name: name of the job (as set in the submission script)
+    :param options: list with additional options for the scheduler (e.g. the qsub_* settings)
+    :param variables: variables passed to all tasks, as a string name=value,name=value
+    :param after: list of job ids, the job is held by the scheduler until these are done (default = None)
+    :return: job id (string) or None if the job id couldn't be determined
+    """
+    return get_scheduler().submit_array(script, job_name, options=options, variables=variables, after=after)
 
-        pattern = "Full jobname:\s*" + job_name
 
-        running_jobs = re.findall(pattern, qstat)
-    elif c_system == "PBS":
-        # Sun/Oracle Grid engine detected
-        qstat = check_output(["qstat", "-f"]).decode("utf-8")
-        pattern = "Job_Name = \s*" + job_name
-        running_jobs = re.findall(pattern, qstat)
-    else:
-        print("Unsupported System", file=sys.stderr)
+def cancel_job(job_name):
+    """
+    Cancels all jobs with a specific name that were submitted with submit_job or submit_array_job
+
+    :param job_name: name of the job
+    """
+    get_scheduler().cancel(job_name)
+
+
+def job_running(job_name):
+    """
+    Checks if a specific job is still running on a cluster
+
+    :param job_name: name of the submitted script/jobname
+    :return: boolean true if the job is still running or in the queue
+    """
+    count = get_scheduler().running_jobs(job_name)
 
-    if len(running_jobs) > 0:
-        print('Still %d jobs running.' % len(running_jobs), end='\r')
+    if count > 0:
+        print('Still %d jobs running.' % count, end='\r')
     else:
         print('\nDone!\n')
 
-    return bool(len(running_jobs) > 0)
+    return bool(count > 0)
 
 
 def wait_for_job(job_name, sleep_time=5):
     """
-    Checks if a job is running and sleeps for a set number of minutes if it is
+    Checks if a job is running and sleeps if it is. Polling starts at short intervals which are doubled, up to
+    sleep_time, as long as the number of running jobs doesn't change.
 
     :param job_name: name of the job to check
-    :param sleep_time: time to sleep between polls (in minutes, default = 5)
+    :param sleep_time: longest time to sleep between polls (in minutes, default = 5)
     """
-    while job_running(job_name):
-        sleep(sleep_time*60)
+    get_scheduler().wait(job_name, sleep_time=sleep_time)
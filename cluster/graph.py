@@ -0,0 +1,173 @@
+import sys
+
+from time import sleep
+
+from cluster import get_scheduler
+
+
+class JobGraph:
+    """
+    Runs jobs that depend on each other. A job is submitted as soon as all jobs it depends on are done, rather than
+    after all jobs of the previous step, so e.g. each sample moves from trimming to alignment to counting on its own.
+    All running jobs are checked with a single status call.
+    """
+    def __init__(self, scheduler=None):
+        """
+        :param scheduler: scheduler to submit jobs to (default = the current scheduler, see cluster.get_scheduler)
+        """
+        self.scheduler = get_scheduler() if scheduler is None else scheduler
+        self.jobs = {}
+
+    def add(self, key, script, job_name, options=None, variables=None, after=None, on_done=None):
+        """
+        Adds a job to the graph
+
+        :param key: unique key for this job, used to refer to it in after
+        :param script: path to the submission script
+        :param job_name: name of the job (as set in the submission script)
+        :param options: list with additional options for the scheduler (e.g. the qsub_* settings)
+        :param variables: variables passed to the job, as a string name=value,name=value
+        :param after: list with keys of jobs that need to finish before this one is submitted (default = None)
+        :param on_done: function to call (without arguments) once the job is done (default = None)
+        :return: the key
+        """
+        if key in self.jobs:
+            print("Job %s was already added" % key, file=sys.stderr)
+            quit()
+
+        self.jobs[key] = {'script': script, 'job_name': job_name, 'options': options, 'variables': variables,
+                          'after': [] if after is None else [a for a in after if a is not None], 'on_done': on_done}
+
+        return key
+
+    def __ready(self, key, done):
+        return all(a in done or a not in self.jobs for a in self.jobs[key]['after'])
+
+    def submit_all(self):
+        """
+        Submits all jobs at once, dependencies are handled by the scheduler (e.g. -hold_jid on SGE, afterok on PBS and
+        SLURM) so there is no need to wait for the jobs. Jobs that depend on a job that failed are never started. Note
+        that on_done is not called for these jobs. If a job can't be submitted, the jobs that were already submitted
+        are cancelled and LSTrAP exits.
+
+        :return: dict with the job id for each key
+        """
+        job_ids = {}
+        pending = list(self.jobs.keys())
+        required = set(a for job in self.jobs.values() for a in job['after'])
+
+        while len(pending) > 0:
+            ready = [k for k in pending if self.__ready(k, job_ids)]
+
+            if len(ready) == 0:
+                print("Jobs %s can't be submitted, check their dependencies" % ', '.join(pending), file=sys.stderr)
+                self.__cancel_submitted(job_ids)
+                sys.exit(1)
+
+            for key in ready:
+                pending.remove(key)
+                job = self.jobs[key]
+                after = [job_ids[a] for a in job['after'] if a in job_ids]
+
+                job_ids[key] = self.scheduler.submit(job['script'], job['job_name'], options=job['options'],
+                                                     variables=job['variables'], after=after,
+                                                     hold_on_failure=key in required)
+
+                if job_ids[key] is None:
+                    print("Could not determine the job id for %s, jobs depending on it can't be submitted" % key,
+                          file=sys.stderr)
+                    self.__cancel_submitted(job_ids)
+                    sys.exit(1)
+
+        return job_ids
+
+    def __cancel_submitted(self, job_ids):
+        submitted = [j for j in job_ids.values() if j is not None]
+
+        if len(submitted) > 0:
+            print("Cancelling the jobs that were submitted: %s" % ', '.join(submitted), file=sys.stderr)
+            self.scheduler.cancel(submitted)
+
+    def run(self, sleep_time=5):
+        """
+        Submits all jobs, in order of their dependencies, and waits until all jobs are done. Polling starts at short
+        intervals which are doubled, up to sleep_time, as long as no jobs finish. on_done is only called for jobs that
+        succeeded (see Scheduler.exit_codes), jobs that depend on a job that failed are not submitted.
+
+        :param sleep_time: longest time to sleep between polls (in minutes, default = 5)
+        :return: set with the keys of jobs that failed or were not submitted as a job they depend on failed
+        """
+        longest = sleep_time * 60
+        interval = min(self.scheduler.min_poll_interval, longest)
+
+        pending = list(self.jobs.keys())
+        running = {}
+        untracked = {}
+        done = set()
+        failed = set()
+
+        while len(pending) > 0 or len(running) > 0 or len(untracked) > 0:
+            for key in [k for k in pending if self.__ready(k, done)]:
+                pending.remove(key)
+                job = self.jobs[key]
+                job_id = self.scheduler.submit(job['script'], job['job_name'], options=job['options'],
+                                               variables=job['variables'])
+                if job_id is None:
+                    # only the job name can be checked, wait for all jobs with this name
+                    untracked[key] = job['job_name']
+                else:
+                    running[job_id] = key
+
+            if len(running) == 0 and len(untracked) == 0:
+                if len(pending) > 0:
+                    print("Jobs %s can't be started, check their dependencies" % ', '.join(pending), file=sys.stderr)
+                break
+
+            print('Still %d jobs running, %d waiting.' % (len(running) + len(untracked), len(pending)), end='\r')
+
+            if len(running) > 0:
+                still_running = set(self.scheduler.wait_any(list(running.keys()), interval))
+            else:
+                sleep(interval)
+                still_running = set()
+
+            finished = [(k, j) for j, k in running.items() if j not in still_running]
+            running = {j: k for j, k in running.items() if j in still_running}
+
+            for key, job_name in list(untracked.items()):
+                if self.scheduler.running_jobs(job_name) == 0:
+                    # the exit code can't be determined without a job id
+                    finished.append((key, None))
+                    del untracked[key]
+
+            for key, job_id in finished:
+                codes = [0] if job_id is None else self.scheduler.exit_codes(job_id, self.jobs[key]['job_name'])
+
+                if any(c != 0 for c in codes):
+                    print("Job %s (%s) failed, jobs depending on it are not submitted" % (key, job_id), file=sys.stderr)
+                    failed.add(key)
+                else:
+                    done.add(key)
+                    if self.jobs[key]['on_done'] is not None:
+                        self.jobs[key]['on_done']()
+
+            # drop jobs depending (directly or through other jobs) on a job that failed
+            skipped = [k for k in pending if any(a in failed for a in self.jobs[k]['after'])]
+            while len(skipped) > 0:
+                for key in skipped:
+                    print("Job %s not submitted, a job it depends on failed" % key, file=sys.stderr)
+                    pending.remove(key)
+                    failed.add(key)
+                skipped = [k for k in pending if any(a in failed for a in self.jobs[k]['after'])]
+
+            # back off while nothing changes, poll quickly again once jobs start finishing
+            interval = min(interval * 2, longest) if len(finished) == 0 else min(self.scheduler.min_poll_interval,
+                                                                                  longest)
+
+        if len(failed) > 0:
+            print('\n%d jobs failed or were not submitted: %s' % (len(failed), ', '.join(sorted(failed))),
+                  file=sys.stderr)
+
+        print('\nDone!\n')
+
+        return failed
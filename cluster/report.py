@@ -0,0 +1,140 @@
+import json
+import os
+import re
+
+from statistics import mean, median
+
+# columns of the STATS_ files written by the jobs (see cluster.templates) and the run report
+FIELDS = ['job_name', 'job_id', 'task', 'sample', 'host', 'submitted', 'start', 'end', 'exit_code', 'max_rss_kb']
+
+
+def collect_job_stats(job_name, report='lstrap.report.tsv', samples=None):
+    """
+    Appends the statistics recorded by all jobs with a specific name (the STATS_ files) to the report of the run and
+    removes the individual files
+
+    :param job_name: name of the job
+    :param report: tab-delimited file to add the jobs to, created if it doesn't exist (default = lstrap.report.tsv)
+    :param samples: dict with the sample for each task id, for array jobs that don't pass the sample to the job
+    :return: number of jobs added
+    """
+    files = sorted(f for f in os.listdir('./') if f.startswith('STATS_' + job_name + '.'))
+
+    if len(files) == 0:
+        return 0
+
+    new_report = not os.path.exists(report)
+
+    with open(report, 'a') as f_out:
+        if new_report:
+            print('\t'.join(FIELDS), file=f_out)
+
+        for file in files:
+            with open(file, 'r') as f_in:
+                for line in f_in:
+                    parts = line.rstrip('\n').split('\t')
+
+                    if len(parts) == len(FIELDS):
+                        if parts[3] == '' and samples is not None:
+                            parts[3] = samples.get(parts[2], '')
+                        print('\t'.join(parts), file=f_out)
+
+            os.remove(file)
+
+    return len(files)
+
+
+def read_report(report='lstrap.report.tsv'):
+    """
+    Reads the report of a run, with the time the job was queued (wait) and ran (runtime) in seconds
+
+    :param report: path to the report (default = lstrap.report.tsv)
+    :return: list with a dict for each job
+    """
+    def to_int(value):
+        return int(value) if value.lstrip('-').isdigit() else None
+
+    jobs = []
+
+    with open(report, 'r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+
+        for line in f:
+            job = dict(zip(header, line.rstrip('\n').split('\t')))
+
+            for key in ['submitted', 'start', 'end', 'exit_code', 'max_rss_kb']:
+                job[key] = to_int(job[key])
+
+            # name of the step, without the timestamp added by write_submission_script
+            job['stage'] = re.sub(r'_\d+$', '', job['job_name'])
+            job['runtime'] = job['end'] - job['start'] if None not in [job['start'], job['end']] else None
+            job['wait'] = job['start'] - job['submitted'] if None not in [job['start'], job['submitted']] else None
+
+            jobs.append(job)
+
+    return jobs
+
+
+def summarize(jobs):
+    """
+    Summarizes a group of jobs
+
+    :param jobs: list of jobs (see read_report)
+    :return: dict with the number of (failed) jobs, run time, queue wait and peak memory of the jobs
+    """
+    runtimes = [j['runtime'] for j in jobs if j['runtime'] is not None]
+    waits = [j['wait'] for j in jobs if j['wait'] is not None]
+    rss = [j['max_rss_kb'] for j in jobs if j['max_rss_kb'] is not None]
+    starts = [j['start'] for j in jobs if j['start'] is not None]
+    ends = [j['end'] for j in jobs if j['end'] is not None]
+
+    return {'jobs': len(jobs),
+            'failed': sum(1 for j in jobs if j['exit_code'] != 0),
+            'hosts': len(set(j['host'] for j in jobs)),
+            'elapsed': max(ends) - min(starts) if len(starts) > 0 and len(ends) > 0 else None,
+            'runtime_total': sum(runtimes),
+            'runtime_mean': mean(runtimes) if len(runtimes) > 0 else None,
+            'runtime_median': median(runtimes) if len(runtimes) > 0 else None,
+            'runtime_max': max(runtimes) if len(runtimes) > 0 else None,
+            'wait_mean': mean(waits) if len(waits) > 0 else None,
+            'wait_max': max(waits) if len(waits) > 0 else None,
+            'max_rss_kb': max(rss) if len(rss) > 0 else None}
+
+
+def write_summary(report='lstrap.report.tsv', output='lstrap.report.json', stragglers=10):
+    """
+    Writes a summary of the report of a run, per stage (e.g. trimmomatic_pe) and per sample, in JSON. Jobs that took
+    much longer than others of the same stage (more than twice the median), are listed as stragglers, slowest first.
+
+    :param report: path to the report (default = lstrap.report.tsv)
+    :param output: path to write the summary to (default = lstrap.report.json)
+    :param stragglers: maximum number of stragglers to include (default = 10)
+    """
+    jobs = read_report(report)
+
+    stages = {}
+    samples = {}
+    for j in jobs:
+        stages.setdefault(j['stage'], []).append(j)
+        if j['sample'] != '':
+            samples.setdefault(j['sample'], []).append(j)
+
+    slow = []
+    for stage_jobs in stages.values():
+        runtimes = [j['runtime'] for j in stage_jobs if j['runtime'] is not None]
+
+        if len(runtimes) > 1:
+            cutoff = 2 * median(runtimes)
+            slow += [j for j in stage_jobs if j['runtime'] is not None and j['runtime'] > cutoff]
+
+    slow.sort(key=lambda j: j['runtime'], reverse=True)
+
+    summary = {'total': summarize(jobs),
+               'stages': {s: summarize(stage_jobs) for s, stage_jobs in stages.items()},
+               'samples': {s: dict(summarize(sample_jobs), stages={j['stage']: j['runtime'] for j in sample_jobs})
+                           for s, sample_jobs in samples.items()},
+               'stragglers': [{k: j[k] for k in ['stage', 'job_name', 'job_id', 'task', 'sample', 'host', 'runtime',
+                                                  'wait', 'exit_code', 'max_rss_kb']} for j in slow[:stragglers]]}
+
+    with open(output, 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
@@ -0,0 +1,705 @@
+import getpass
+import os
+import re
+import sys
+
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+from subprocess import check_output, run, Popen, PIPE, STDOUT
+from threading import Condition, Lock
+from time import sleep, time
+
+from cluster.templates import build_template, build_batch_template, build_pbs_template, build_slurm_template
+
+
+class Scheduler:
+    """
+    Base class for cluster managers. A scheduler writes submission scripts, submits (array) jobs, checks which jobs are
+    still running and can cancel jobs. Job ids are tracked per job name, so waiting for a job only requires a single
+    status call for all jobs with that name.
+
+    Subclasses need to implement the template functions, submit_command, parse_job_id, running_job_ids,
+    running_jobs_by_name and cancel_command.
+    """
+    name = None
+
+    # shortest time between two polls (in seconds)
+    min_poll_interval = 10
+
+    # a failing status command is tried this many times, waiting retry_interval seconds in between, before giving up
+    status_attempts = 3
+    retry_interval = 5
+
+    # exit code that keeps the jobs depending on a job on hold, for schedulers that release those whenever the job ends
+    hold_exit_code = None
+
+    def __init__(self):
+        # job ids of submitted jobs, per job name
+        self.submitted_jobs = {}
+
+    def build_template(self, name, email, module, cmd):
+        """
+        Generates submit script for a normal job.
+
+        :param name: Name for the job
+        :param email: Email address of the user, set to None to disable email
+        :param module: Module to load, separate multiple modules using spaces
+        :param cmd: The command to execute, separate multiple commands using newlines
+        :return: The completed template
+        """
+        raise NotImplementedError
+
+    def build_batch_template(self, name, email, module, cmd, jobs):
+        """
+        Generates submit script for a batch (array) job, each task can get its id from $SGE_TASK_ID
+
+        :param name: Name for the job
+        :param email: Email address of the user, set to None to disable email
+        :param module: Module to load, separate multiple modules using spaces
+        :param cmd: The command to execute, separate multiple commands using newlines
+        :param jobs: Number of jobs to include in the batch file
+        :return: The completed template
+        """
+        raise NotImplementedError
+
+    def submit_command(self, script, options, variables):
+        """
+        Builds the command to submit a script
+
+        :param script: path to the submission script
+        :param options: list with additional options for the scheduler (e.g. the qsub_* settings)
+        :param variables: variables passed to the job, as a string name=value,name=value
+        :return: command (list)
+        """
+        raise NotImplementedError
+
+    def dependency_options(self, job_ids):
+        """
+        :param job_ids: list of job ids
+        :return: options (list) to hold a job until those jobs are done
+        """
+        raise NotImplementedError
+
+    def cancel_command(self, job_ids):
+        """
+        :param job_ids: list of job ids
+        :return: command (list) to cancel those jobs
+        """
+        raise NotImplementedError
+
+    def parse_job_id(self, output):
+        """
+        Gets the job id from the output of the submit command
+
+        :param output: text printed when submitting
+        :return: job id (string) or None if no id was found
+        """
+        raise NotImplementedError
+
+    def running_job_ids(self, job_ids):
+        """
+        Checks which of a list of jobs are still running or waiting in the queue, using a single call
+
+        :param job_ids: list of job ids
+        :return: list of job ids that are still running or in the queue
+        """
+        raise NotImplementedError
+
+    def running_jobs_by_name(self, job_name):
+        """
+        Counts running jobs with a specific name, only used for jobs that weren't submitted through submit
+
+        :param job_name: name of the job
+        :return: number of jobs running or in the queue
+        """
+        raise NotImplementedError
+
+    def submit(self, script, job_name, options=None, variables=None, after=None, hold_on_failure=False):
+        """
+        Submits a job and keeps track of the job id, so the job can be checked on specifically
+
+        :param script: path to the submission script
+        :param job_name: name of the job (as set in the submission script)
+        :param options: list with additional options for the scheduler (e.g. the qsub_* settings)
+        :param variables: variables passed to the job, as a string name=value,name=value
+        :param after: list of job ids, the job is held by the scheduler until these are done (default = None)
+        :param hold_on_failure: if the job fails, jobs submitted with this job in after are never started
+                                (default = False). Note that on SGE the failed job is kept in the error state.
+        :return: job id (string) or None if the job id couldn't be determined
+        """
+        options = [] if options is None else list(options)
+        if after is not None and len(after) > 0:
+            options += self.dependency_options(after)
+
+        if hold_on_failure and self.hold_exit_code is not None:
+            # the job exits with this code when it fails, see cluster.templates
+            hold = 'LSTRAP_HOLD_EXIT=%d' % self.hold_exit_code
+            variables = hold if variables is None or variables == '' else variables + ',' + hold
+
+        command = self.submit_command(script, options, add_submit_time(variables))
+
+        result = run(command, stdout=PIPE)
+        output = result.stdout.decode("utf-8")
+        print(output, end='')
+
+        job_id = self.parse_job_id(output)
+
+        if job_id is None:
+            print("Could not determine the job id for %s, falling back to checking the job name." % job_name,
+                  file=sys.stderr)
+
+        self.submitted_jobs.setdefault(job_name, []).append(job_id)
+
+        return job_id
+
+    def submit_array(self, script, job_name, options=None, variables=None, after=None, hold_on_failure=False):
+        """
+        Submits a batch (array) job, written with build_batch_template. The number of tasks is set in the script, so
+        this is the same as submit on all supported systems.
+
+        :param script: path to the submission script
+        :param job_name: name of the job (as set in the submission script)
+        :param options: list with additional options for the scheduler (e.g. the qsub_* settings)
+        :param variables: variables passed to all tasks, as a string name=value,name=value
+        :param after: list of job ids, the job is held by the scheduler until these are done (default = None)
+        :param hold_on_failure: if a task fails, jobs submitted with this job in after are never started
+                                (default = False)
+        :return: job id (string) or None if the job id couldn't be determined
+        """
+        return self.submit(script, job_name, options=options, variables=variables, after=after,
+                           hold_on_failure=hold_on_failure)
+
+    def exit_codes(self, job_id, job_name):
+        """
+        Gets the exit codes of a finished job from the statistics the job recorded (the STATS_ files, see
+        cluster.report), these are written by the job itself so no accounting database is needed
+
+        :param job_id: id of a finished job
+        :param job_name: name of the job
+        :return: list with the exit code of each task, [None] if the job didn't record its statistics (e.g. it was
+                 killed by the scheduler)
+        """
+        prefix = 'STATS_%s.%s' % (job_name, job_id)
+        codes = []
+
+        for file in sorted(f for f in os.listdir('./') if f == prefix or f.startswith(prefix + '.')):
+            with open(file, 'r') as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    codes.append(int(parts[8]) if len(parts) > 8 and parts[8].lstrip('-').isdigit() else None)
+
+        return codes if len(codes) > 0 else [None]
+
+    def query(self, command, expected=None):
+        """
+        Runs a status command (e.g. qstat) and checks its exit code, the command is tried again if it fails. A failing
+        call returns no jobs, so it shouldn't be mistaken for all jobs being done.
+
+        :param command: command (list)
+        :param expected: regular expression for errors that are part of a normal answer (e.g. a job that is no longer
+                         known), a non-zero exit code is accepted if all lines on stderr match (default = None)
+        :return: output of the command (string), None if all attempts failed
+        """
+        for attempt in range(1, self.status_attempts + 1):
+            result = run(command, stdout=PIPE, stderr=PIPE)
+            errors = [line for line in result.stderr.decode("utf-8").splitlines() if line.strip() != '']
+
+            if result.returncode == 0 or \
+                    (expected is not None and len(errors) > 0 and all(re.search(expected, e) for e in errors)):
+                return result.stdout.decode("utf-8")
+
+            print("%s failed with exit code %d (attempt %d of %d): %s" %
+                  (command[0], result.returncode, attempt, self.status_attempts,
+                   result.stderr.decode("utf-8").strip()), file=sys.stderr)
+
+            if attempt < self.status_attempts:
+                sleep(self.retry_interval)
+
+        return None
+
+    def status(self, job_ids):
+        """
+        Checks which jobs are still running, if the scheduler can't be reached all jobs are considered done
+
+        :param job_ids: list of job ids
+        :return: list of job ids that are still running or in the queue
+        """
+        try:
+            return self.running_job_ids(job_ids)
+        except OSError:
+            print("Unsupported System", file=sys.stderr)
+            return []
+
+    def cancel(self, job_ids):
+        """
+        Cancels jobs
+
+        :param job_ids: list of job ids, or the name of a job submitted through submit
+        """
+        if isinstance(job_ids, str):
+            job_ids = [j for j in self.submitted_jobs.get(job_ids, []) if j is not None]
+
+        if len(job_ids) > 0:
+            run(self.cancel_command(job_ids))
+
+    def running_jobs(self, job_name):
+        """
+        Counts how many jobs with a specific name are still running. If the jobs were submitted with submit only those
+        job ids are checked, finished jobs are no longer tracked.
+
+        :param job_name: name of the submitted script/jobname
+        :return: number of jobs (arrays count as one) still running or in the queue
+        """
+        if job_name in self.submitted_jobs and None not in self.submitted_jobs[job_name]:
+            self.submitted_jobs[job_name] = self.status(self.submitted_jobs[job_name])
+            count = len(self.submitted_jobs[job_name])
+        else:
+            try:
+                count = self.running_jobs_by_name(job_name)
+            except OSError:
+                print("Unsupported System", file=sys.stderr)
+                count = 0
+
+        if count == 0:
+            self.submitted_jobs.pop(job_name, None)
+
+        return count
+
+    def wait_any(self, job_ids, timeout):
+        """
+        Waits (at most timeout seconds) for jobs to finish
+
+        :param job_ids: list of job ids
+        :param timeout: time to wait before checking the jobs again (in seconds)
+        :return: list of job ids that are still running or in the queue
+        """
+        sleep(timeout)
+
+        return self.status(job_ids)
+
+    def wait(self, job_name, sleep_time=5):
+        """
+        Checks if a job is running and sleeps if it is. Polling starts at short intervals which are doubled, up to
+        sleep_time, as long as the number of running jobs doesn't change.
+
+        :param job_name: name of the job to check
+        :param sleep_time: longest time to sleep between polls (in minutes, default = 5)
+        """
+        longest = sleep_time * 60
+        interval = min(self.min_poll_interval, longest)
+        previous = None
+
+        while True:
+            count = self.running_jobs(job_name)
+
+            if count == 0:
+                print('\nDone!\n')
+                break
+
+            print('Still %d jobs running.' % count, end='\r')
+
+            # back off while nothing changes, poll quickly again once jobs start finishing
+            interval = min(interval * 2, longest) if count == previous else min(self.min_poll_interval, longest)
+            previous = count
+
+            sleep(interval)
+
+
+class SGEScheduler(Scheduler):
+    """
+    Sun/Oracle Grid Engine (and forks), jobs are submitted using qsub, checked with qstat and cancelled with qdel
+    """
+    name = "SGE"
+
+    def build_template(self, name, email, module, cmd):
+        return build_template(name, email, module, cmd)
+
+    def build_batch_template(self, name, email, module, cmd, jobs):
+        return build_batch_template(name, email, module, cmd, jobs)
+
+    def submit_command(self, script, options, variables):
+        return ["qsub"] + options + ([] if variables is None else ["-v", variables]) + [script]
+
+    # jobs are released when the jobs they wait for end, regardless of their exit code, unless one exits with code 100
+    hold_exit_code = 100
+
+    def dependency_options(self, job_ids):
+        return ["-hold_jid", ",".join(job_ids)]
+
+    def cancel_command(self, job_ids):
+        return ["qdel"] + job_ids
+
+    def parse_job_id(self, output):
+        # Your job 123 ("name") has been submitted, Your job-array 123.1-10:1 ("name") has been submitted
+        match = re.search(r'Your job(?:-array)? (\d+)', output)
+
+        return match.group(1) if match else None
+
+    def running_job_ids(self, job_ids):
+        # only the jobs of the current user are listed, array tasks share the job id
+        qstat = self.query(["qstat", "-u", getpass.getuser()])
+
+        if qstat is None:
+            print("Could not check the status of jobs %s, assuming they are still running" % ', '.join(job_ids),
+                  file=sys.stderr)
+            return list(job_ids)
+
+        listed = set(line.split()[0] for line in qstat.splitlines() if re.match(r'^\s*\d+\s', line))
+
+        return [j for j in job_ids if j in listed]
+
+    def running_jobs_by_name(self, job_name):
+        qstat = check_output(["qstat", "-r"]).decode("utf-8")
+
+        return len(re.findall("Full jobname:\s*" + job_name, qstat))
+
+
+class PBSScheduler(Scheduler):
+    """
+    PBS/Torque, jobs are submitted using qsub, checked with qstat and cancelled with qdel
+    """
+    name = "PBS"
+
+    def build_template(self, name, email, module, cmd):
+        return build_pbs_template(name, email, module, cmd)
+
+    def build_batch_template(self, name, email, module, cmd, jobs):
+        return build_pbs_template(name, email, module, cmd, jobs=jobs)
+
+    def submit_command(self, script, options, variables):
+        return ["qsub"] + options + ([] if variables is None else ["-v", variables]) + [script]
+
+    def dependency_options(self, job_ids):
+        # Torque requires afterokarray for array jobs (123[].server)
+        jobs = [j for j in job_ids if '[]' not in j]
+        arrays = [j for j in job_ids if '[]' in j]
+        depend = (["afterok:" + ":".join(jobs)] if len(jobs) > 0 else []) + \
+                 (["afterokarray:" + ":".join(arrays)] if len(arrays) > 0 else [])
+
+        return ["-W", "depend=" + ",".join(depend)]
+
+    def cancel_command(self, job_ids):
+        return ["qdel"] + job_ids
+
+    def parse_job_id(self, output):
+        # 123.server or 123[].server for arrays
+        match = re.search(r'^\s*(\d+(?:\[\])?(?:\.\S+)?)\s*$', output, re.MULTILINE)
+
+        return match.group(1) if match else None
+
+    def running_job_ids(self, job_ids):
+        # finished jobs are reported as unknown (on stderr, qstat then exits with an error) or with state C
+        qstat = self.query(["qstat"] + job_ids, expected=r'Unknown Job Id|Job has finished')
+
+        if qstat is None:
+            print("Could not check the status of jobs %s, assuming they are still running" % ', '.join(job_ids),
+                  file=sys.stderr)
+            return list(job_ids)
+
+        # Torque truncates long ids (123.serv*), so jobs are matched on their number
+        listed = set(re.match(r'\d+', parts[0]).group() for parts in (line.split() for line in qstat.splitlines())
+                     if len(parts) >= 5 and re.match(r'\d+', parts[0]) and parts[4] != 'C')
+
+        return [j for j in job_ids if re.match(r'\d+', j).group() in listed]
+
+    def running_jobs_by_name(self, job_name):
+        qstat = check_output(["qstat", "-f"]).decode("utf-8")
+
+        return len(re.findall("Job_Name = \s*" + job_name, qstat))
+
+
+class SLURMScheduler(Scheduler):
+    """
+    SLURM, jobs are submitted using sbatch, checked with squeue and cancelled with scancel. The qsub_* settings are
+    passed to sbatch as they are, so these should contain sbatch options (e.g. --cpus-per-task=4 --mem=8G).
+    """
+    name = "SLURM"
+
+    def build_template(self, name, email, module, cmd):
+        return build_slurm_template(name, email, module, cmd)
+
+    def build_batch_template(self, name, email, module, cmd, jobs):
+        return build_slurm_template(name, email, module, cmd, jobs=jobs)
+
+    def submit_command(self, script, options, variables):
+        export = "--export=ALL" if variables is None else "--export=ALL," + variables
+
+        return ["sbatch"] + options + [export, script]
+
+    def dependency_options(self, job_ids):
+        # jobs that can't run anymore, as a job they depend on failed, are removed from the queue
+        return ["--dependency=afterok:" + ":".join(job_ids), "--kill-on-invalid-dep=yes"]
+
+    def cancel_command(self, job_ids):
+        return ["scancel"] + job_ids
+
+    def parse_job_id(self, output):
+        # Submitted batch job 123
+        match = re.search(r'Submitted batch job (\d+)', output)
+
+        return match.group(1) if match else None
+
+    def running_job_ids(self, job_ids):
+        # array tasks are listed as 123_4 or 123_[5-10]
+        squeue = self.query(["squeue", "-h", "-u", getpass.getuser(), "-o", "%i"])
+
+        if squeue is None:
+            print("Could not check the status of jobs %s, assuming they are still running" % ', '.join(job_ids),
+                  file=sys.stderr)
+            return list(job_ids)
+
+        listed = set(line.strip().split('_')[0] for line in squeue.splitlines() if line.strip() != '')
+
+        return [j for j in job_ids if j in listed]
+
+    def running_jobs_by_name(self, job_name):
+        squeue = check_output(["squeue", "-h", "-u", getpass.getuser(), "-n", job_name, "-o", "%i"]).decode("utf-8")
+
+        return len([line for line in squeue.splitlines() if line.strip() != ''])
+
+
+def add_submit_time(variables):
+    """
+    Adds the current time as LSTRAP_SUBMITTED to the variables of a job, the job reports this so the time it was queued
+    can be determined (see cluster.report)
+
+    :param variables: variables passed to the job, as a string name=value,name=value (or None)
+    :return: variables including LSTRAP_SUBMITTED (seconds since epoch)
+    """
+    submitted = 'LSTRAP_SUBMITTED=%d' % time()
+
+    return submitted if variables is None or variables == '' else variables + ',' + submitted
+
+
+def parse_cores(options):
+    """
+    Gets the number of cores a job requests from the scheduler options (the qsub_* settings). Recognizes parallel
+    environments on SGE (-pe cores 4), ppn=4 and ncpus=4 on PBS and --cpus-per-task=4 or -c 4 on SLURM.
+
+    :param options: list with options
+    :return: number of cores, 1 if no cores were requested
+    """
+    joined = ' '.join(options)
+
+    for pattern in [r'-pe\s+\S+\s+(\d+)', r'ppn=(\d+)', r'ncpus=(\d+)', r'--cpus-per-task[=\s](\d+)',
+                    r'(?:^|\s)-c\s+(\d+)']:
+        match = re.search(pattern, joined)
+        if match:
+            return max(int(match.group(1)), 1)
+
+    return 1
+
+
+class LocalScheduler(Scheduler):
+    """
+    Runs jobs on the local machine, without a cluster manager. Submission scripts are run with bash in a bounded pool,
+    each job reserves the number of cores requested in its options (e.g. -pe cores 4 in qsub_tophat) and jobs only
+    start when enough cores are free. Jobs are only added to the pool once the jobs they depend on are done, so waiting
+    jobs never take up the place of jobs that can run. Array tasks get SGE_TASK_ID, as on a cluster. Since the jobs are
+    run by this process, waiting for a job doesn't require polling.
+    """
+    name = "LOCAL"
+
+    def __init__(self, cores=None):
+        """
+        :param cores: number of cores jobs can use at the same time (default = all cores of the machine)
+        """
+        super().__init__()
+
+        self.cores = max(int(cores), 1) if cores is not None else (os.cpu_count() or 1)
+        self.free_cores = self.cores
+        self.condition = Condition()
+        self.pool = ThreadPoolExecutor(max_workers=self.cores)
+
+        self.lock = Lock()
+        self.last_id = 0
+        self.futures = {}
+        self.processes = {}
+        self.cancelled = set()
+
+    def build_template(self, name, email, module, cmd):
+        return build_template(name, email, module, cmd)
+
+    def build_batch_template(self, name, email, module, cmd, jobs):
+        return build_batch_template(name, email, module, cmd, jobs)
+
+    @staticmethod
+    def __after(futures, callback):
+        """
+        Calls a function once all futures are done, from the thread that completes the last one
+
+        :param futures: list of futures
+        :param callback: function to call (without arguments)
+        """
+        if len(futures) == 0:
+            callback()
+            return
+
+        lock = Lock()
+        remaining = [len(futures)]
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+
+            if last:
+                callback()
+
+        for f in futures:
+            f.add_done_callback(done)
+
+    def __start_task(self, future, job_id, task, script, env, cores, output, after):
+        """
+        Adds a job or array task to the pool, once the jobs it depends on are done. The result of the task (see
+        __run_task) is passed on to future, the task is skipped when a job it depends on failed.
+
+        :param future: future returned for this task by submit
+        :param after: futures of the jobs this task depends on, these are all done
+        """
+        if not future.set_running_or_notify_cancel():
+            return
+
+        if any(f.cancelled() or f.result() != 0 for f in after):
+            print("Job %s (%s) not started, a job it depends on failed" % (job_id, output), file=sys.stderr)
+            future.set_result(None)
+            return
+
+        def finished(result):
+            if result.exception() is not None:
+                future.set_exception(result.exception())
+            else:
+                future.set_result(result.result())
+
+        self.pool.submit(self.__run_task, job_id, task, script, env, cores, output).add_done_callback(finished)
+
+    def __run_task(self, job_id, task, script, env, cores, output):
+        """
+        Runs a single job or array task once enough cores are free
+
+        :return: exit code of the script, None if the job was cancelled
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.free_cores >= cores or job_id in self.cancelled)
+            if job_id in self.cancelled:
+                return None
+            self.free_cores -= cores
+
+        try:
+            with open(output, 'w') as f:
+                with self.lock:
+                    process = Popen(['bash', script], stdout=f, stderr=STDOUT, env=env)
+                    self.processes[(job_id, task)] = process
+                exit_code = process.wait()
+        finally:
+            with self.lock:
+                self.processes.pop((job_id, task), None)
+            with self.condition:
+                self.free_cores += cores
+                self.condition.notify_all()
+
+        if exit_code != 0:
+            print("Job %s (%s) exited with code %d" % (job_id, output, exit_code), file=sys.stderr)
+
+        return exit_code
+
+    def submit(self, script, job_name, options=None, variables=None, after=None, hold_on_failure=False):
+        """
+        Adds a job to the pool. The number of cores is taken from the options (see parse_cores), for batch scripts one
+        task per index in the array is added. Output is written to OUT_<job_name>.<job id>(.<task id>).
+
+        :param script: path to the submission script
+        :param job_name: name of the job (as set in the submission script)
+        :param options: list with options (e.g. the qsub_* settings), only used to get the number of cores
+        :param variables: variables passed to the job, as a string name=value,name=value
+        :param after: list of job ids, the job only starts when all of these exited with code 0 (default = None)
+        :param hold_on_failure: not used, jobs never start after a job they depend on failed
+        :return: job id (string)
+        """
+        # jobs can only depend on earlier jobs, so the tasks these wait for are already running or queued before them
+        dependencies = [f for j in ([] if after is None else after) for f in self.futures.get(j, [])]
+
+        cores = min(parse_cores([] if options is None else options), self.cores)
+
+        with open(script, 'r') as f:
+            match = re.search(r'^#\$ -t 1-(\d+)', f.read(), re.MULTILINE)
+        tasks = list(range(1, int(match.group(1)) + 1)) if match else [None]
+
+        with self.lock:
+            self.last_id += 1
+            job_id = str(self.last_id)
+
+        env = dict(os.environ)
+        env.update(v.split('=', 1) for v in add_submit_time(variables).split(',') if '=' in v)
+        env.update({'JOB_NAME': job_name, 'JOB_ID': job_id, 'NSLOTS': str(cores)})
+
+        futures = []
+        for task in tasks:
+            task_env = dict(env)
+            output = 'OUT_%s.%s' % (job_name, job_id)
+            if task is not None:
+                task_env['SGE_TASK_ID'] = str(task)
+                output += '.%d' % task
+            future = Future()
+            futures.append(future)
+            self.__after(dependencies, lambda f=future, t=task, e=task_env, o=output:
+                         self.__start_task(f, job_id, t, script, e, cores, o, dependencies))
+
+        self.futures[job_id] = futures
+        self.submitted_jobs.setdefault(job_name, []).append(job_id)
+
+        print('Your job %s ("%s") has been submitted' % (job_id, job_name))
+
+        return job_id
+
+    def running_job_ids(self, job_ids):
+        return [j for j in job_ids if any(not f.done() for f in self.futures.get(j, []))]
+
+    def running_jobs_by_name(self, job_name):
+        # all local jobs are submitted through submit
+        return 0
+
+    def wait_any(self, job_ids, timeout):
+        # returns as soon as one of the jobs is done
+        pending = [f for j in job_ids for f in self.futures.get(j, []) if not f.done()]
+        if len(pending) > 0:
+            wait_futures(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        return self.status(job_ids)
+
+    def exit_codes(self, job_id, job_name=None):
+        """
+        :param job_id: id of a finished job
+        :param job_name: not used, the exit codes are kept for each job id
+        :return: list with exit code of each task (None for tasks that were cancelled or not started)
+        """
+        return [f.result() if not f.cancelled() else None for f in self.futures.get(job_id, [])]
+
+    def cancel(self, job_ids):
+        if isinstance(job_ids, str):
+            job_ids = self.submitted_jobs.get(job_ids, [])
+
+        for job_id in job_ids:
+            with self.condition:
+                self.cancelled.add(job_id)
+                self.condition.notify_all()
+            for f in self.futures.get(job_id, []):
+                f.cancel()
+            with self.lock:
+                for (j, _), process in self.processes.items():
+                    if j == job_id:
+                        process.terminate()
+
+    def wait(self, job_name, sleep_time=5):
+        """
+        Waits until all jobs with a specific name are done
+
+        :param job_name: name of the job to wait for
+        :param sleep_time: not used, there is no polling for local jobs
+        """
+        for job_id in self.submitted_jobs.pop(job_name, []):
+            wait_futures(self.futures[job_id])
+
+        print('\nDone!\n')
+
+
+schedulers = {s.name: s for s in [SGEScheduler, PBSScheduler, SLURMScheduler, LocalScheduler]}
@@ -1,5 +1,45 @@
 
 
+
+
+# Runs the command and records the host, submit, start and end time (seconds since epoch), exit code and peak memory
+# use (max RSS of the largest process, in KB) of the job in STATS_<job name>.<job id>(.<task id>), see cluster.report.
+# The submit time is passed by the scheduler as LSTRAP_SUBMITTED. Peak memory requires GNU time or python3, a
+# /usr/bin/time that doesn't support -f/-o (e.g. BSD time) is skipped.
+__job_body = """#
+%s
+date
+hostname
+read -r -d '' lstrap_cmd <<'LSTRAP_CMD'
+%s
+LSTRAP_CMD
+lstrap_start=$(date +%%s)
+lstrap_rss=.rss.$$.$(hostname)
+if /usr/bin/time -f %%M -o /dev/null true 2> /dev/null; then
+    /usr/bin/time -f %%M -o $lstrap_rss bash -c "$lstrap_cmd"
+elif command -v python3 > /dev/null; then
+    python3 -c 'import resource, subprocess, sys; c = subprocess.call(["bash", "-c", sys.argv[1]]); print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss, file=open(sys.argv[2], "w")); sys.exit(c if c >= 0 else 128 - c)' "$lstrap_cmd" $lstrap_rss
+else
+    bash -c "$lstrap_cmd"
+fi
+exit_code=$?
+lstrap_end=$(date +%%s)
+lstrap_name=${JOB_NAME:-${PBS_JOBNAME:-$SLURM_JOB_NAME}}
+lstrap_id=${JOB_ID:-${PBS_JOBID:-${SLURM_ARRAY_JOB_ID:-$SLURM_JOB_ID}}}
+lstrap_id=${lstrap_id/\\[[0-9]*\\]/[]}
+lstrap_task=${SGE_TASK_ID/undefined/}
+printf '%%s\\t%%s\\t%%s\\t%%s\\t%%s\\t%%s\\t%%s\\t%%s\\t%%s\\t%%s\\n' "$lstrap_name" "$lstrap_id" "$lstrap_task" "$sample" \\
+    "$(hostname)" "$LSTRAP_SUBMITTED" "$lstrap_start" "$lstrap_end" "$exit_code" "$(tail -n 1 $lstrap_rss 2> /dev/null)" \\
+    > STATS_$lstrap_name.$lstrap_id${lstrap_task:+.$lstrap_task}
+rm -f $lstrap_rss
+date
+# a failed job exits with LSTRAP_HOLD_EXIT if set, on SGE exit code 100 keeps the jobs depending on it (-hold_jid) on hold
+if [ $exit_code -ne 0 ] && [ -n "$LSTRAP_HOLD_EXIT" ]; then
+    exit $LSTRAP_HOLD_EXIT
+fi
+exit $exit_code
+"""
+
 __template = """#!/bin/bash
 #
 
@@ -13,13 +53,7 @@ __template = """#!/bin/bash
 #email
 %s
 
-#
-%s
-date
-hostname
-%s
-date
-"""
+""" + __job_body
 
 __batch_template = """#!/bin/bash
 #
@@ -36,13 +70,84 @@ __batch_template = """#!/bin/bash
 #email
 %s
 
+""" + __job_body
+
+__pbs_template = """#!/bin/bash
 #
+
+#PBS -N %s
+#PBS -j oe
+#PBS -o /dev/null
+#PBS -S /bin/bash
 %s
-date
-hostname
+#email
 %s
-date
-"""
+
+cd $PBS_O_WORKDIR
+%s
+exec > OUT_$PBS_JOBNAME.$PBS_JOBID$TASK_SUFFIX 2>&1
+
+""" + __job_body
+
+__slurm_template = """#!/bin/bash
+#
+
+#SBATCH -J %s
+#SBATCH -o OUT_%%x.%s
+#SBATCH -e ERR_%%x.%s
+%s
+#email
+%s
+
+%s
+""" + __job_body
+
+
+def build_pbs_template(name, email, module, cmd, jobs=None):
+    """
+    Generates submit script for PBS/Torque, for a normal or batch (array) job. For array jobs SGE_TASK_ID is set to the
+    task id, so commands work on all systems.
+
+    :param name: Name for the job
+    :param email: Email address of the user, set to None to disable email
+    :param module: Module to load, separate multiple modules using spaces in case more than one module is required
+    :param cmd: The command to execute, separate multiple commands using newlines
+    :param jobs: Number of jobs to include in the batch file, set to None for a normal job (default = None)
+    :return: The completed template
+    """
+    include_email = "" if email is None else "#PBS -m bea\n#PBS -M " + email
+    load_module = "" if module is None else "module load " + module
+
+    if jobs is None:
+        array, task_id = "", "TASK_SUFFIX=''"
+    else:
+        array = "#PBS -t 1-%d\n" % jobs
+        task_id = "export SGE_TASK_ID=${PBS_ARRAYID:-$PBS_ARRAY_INDEX}\nTASK_SUFFIX=.$SGE_TASK_ID"
+
+    return __pbs_template % (name, array, include_email, task_id, load_module, cmd)
+
+
+def build_slurm_template(name, email, module, cmd, jobs=None):
+    """
+    Generates submit script for SLURM, for a normal or batch (array) job. For array jobs SGE_TASK_ID is set to the task
+    id, so commands work on all systems.
+
+    :param name: Name for the job
+    :param email: Email address of the user, set to None to disable email
+    :param module: Module to load, separate multiple modules using spaces in case more than one module is required
+    :param cmd: The command to execute, separate multiple commands using newlines
+    :param jobs: Number of jobs to include in the batch file, set to None for a normal job (default = None)
+    :return: The completed template
+    """
+    include_email = "" if email is None else "#SBATCH --mail-type=ALL\n#SBATCH --mail-user=" + email
+    load_module = "" if module is None else "module load " + module
+
+    if jobs is None:
+        output, array, task_id = "%j", "", ""
+    else:
+        output, array, task_id = "%A.%a", "#SBATCH --array=1-%d\n" % jobs, "export SGE_TASK_ID=$SLURM_ARRAY_TASK_ID\n"
+
+    return __slurm_template % (name, output, output, array, include_email, task_id, load_module, cmd)
 
 
 def build_template(name, email, module, cmd):
@@ -1,12 +1,8 @@
-from parsers.fasta import Fasta
+from parsers.fasta import iter_records
 import sys
 
 
 fasta_file = sys.argv[1]
 
-fh = Fasta()
-
-fh.readfile(fasta_file)
-
-for k, s in fh.sequences.items():
+for k, s in iter_records(fasta_file):
     print('%s\t.\tCDS\t1\t%d\t.\t.\t.\tParent=%s' % (k, len(s), k))
@@ -6,9 +6,11 @@ import matplotlib.pyplot as plt
 
 import argparse
 
+from parsers.matrix import read_matrix
 
-def plot_data(matrix_file, show_labels=True, file_out=None, dpi_output=300, distance='euclidean'):
-    df = pd.read_table(matrix_file, header=0, index_col=0)
+
+def plot_data(matrix_file, show_labels=True, file_out=None, dpi_output=300, distance='euclidean', prefer_binary=False):
+    df = read_matrix(matrix_file, prefer_binary=prefer_binary)
 
     distances = pdist(df.values.transpose(), metric=distance)
     labels = [l.replace('.htseq', '') for l in df.columns]
@@ -32,6 +34,7 @@ if __name__ == "__main__":
     parser.add_argument('--png', help='save output as png file (default: None, don\'t write png to file)', default=None)
     parser.add_argument('--dpi', help='dpi for the output (default = 300)', default=300, type=float)
     parser.add_argument('--distance', help='Distance metric to use (euclidean, cityblock, ...)', default='euclidean')
+    parser.add_argument('--binary', dest='prefer_binary', action='store_true', help='read the binary copy of the matrix (written with run.py --binary-matrix) if it is up to date, faster but values are float32')
 
     parser.set_defaults(show_labels=True)
 
@@ -42,5 +45,6 @@ if __name__ == "__main__":
               show_labels=args.show_labels,
               file_out=args.png,
               dpi_output=args.dpi,
-              distance=args.distance)
+              distance=args.distance,
+              prefer_binary=args.prefer_binary)
 
@@ -3,6 +3,8 @@ import sys
 
 import pandas as pd
 
+from parsers.matrix import read_matrix
+
 
 def merge_matrix(first, second, output):
     """
@@ -13,8 +15,9 @@ def merge_matrix(first, second, output):
     :param output:  output matrix (path)
     """
 
-    df_first = pd.read_table(first, header=0, index_col=0)
-    df_second = pd.read_table(second, header=0, index_col=0)
+    # the text files are used as the output is written as text, values from a binary copy would be float32
+    df_first = read_matrix(first, prefer_binary=False)
+    df_second = read_matrix(second, prefer_binary=False)
 
     if df_first.shape[0] != df_second.shape[0]:
         print("WARNING: attempting to merge two matrices with a different number of rows", file=sys.stderr)
@@ -1,3 +1,5 @@
+import mmap
+import os
 import sys
 
 
@@ -28,30 +30,12 @@ class Fasta:
         """
         print("Reading FASTA file:" + filename + "...", file=sys.stderr)
 
-        # Initialize variables
-        name = ''
-        sequence = []
-        count = 1
+        count = 0
 
-        # open file
-        f = open(filename, 'r')
+        for name, sequence in iter_records(filename):
+            self.sequences[name] = sequence
+            count += 1
 
-        for line in f:
-            line = line.rstrip()
-            if line.startswith(">"):
-                # ignore if first
-                if not name == '':
-                    self.sequences[name] = ''.join(sequence)
-                    count += 1
-                name = line.lstrip('>')
-                sequence = []
-            else:
-                sequence.append(line)
-
-        # add last gene
-        self.sequences[name] = ''.join(sequence)
-
-        f.close()
         print("Done! (found ", count, " sequences)", file=sys.stderr)
 
     def writefile(self, filename):
@@ -64,3 +48,238 @@ class Fasta:
             for k, v in self.sequences.items():
                 print(">" + k, file=f)
                 print(v, file=f)
+
+
+def iter_records(filename):
+    """
+    Reads a fasta file one record at a time, only the current sequence is kept in memory
+
+    :param filename: file to read
+    :return: yields tuples with the name and sequence of each record
+    """
+    name, sequence = None, []
+
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.rstrip()
+            if line.startswith(">"):
+                if name is not None:
+                    yield name, ''.join(sequence)
+                name, sequence = line.lstrip('>'), []
+            else:
+                sequence.append(line)
+
+    if name is not None:
+        yield name, ''.join(sequence)
+
+
+def sequence_lengths(filename):
+    """
+    Reads a fasta file line by line and yields the length of each sequence, sequences are never kept in memory
+
+    :param filename: file to read
+    :return: yields tuples with the name and length of each sequence
+    """
+    name, length = None, 0
+
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.rstrip()
+            if line.startswith(">"):
+                if name is not None:
+                    yield name, length
+                name, length = line.lstrip('>'), 0
+            else:
+                length += len(line)
+
+    if name is not None:
+        yield name, length
+
+
+class FastaIndex:
+    """
+    Random access to the sequences in a fasta file, using an index with the offset of each record in the style of
+    samtools faidx (name, length, offset, residues per line and bytes per line). The fasta file is memory-mapped, so
+    sequences are only read from disk when they are requested.
+
+    The index is stored next to the fasta file (.lstrap.idx, not .fai as the names differ from those of samtools) with
+    the size and modification time of the fasta file, and rebuilt when these change. Names are the full header line,
+    like Fasta.readfile. Records with lines of different lengths are supported, for these the residues per line and
+    bytes per line are set to 0 and the entire record is read to get part of it.
+    """
+    def __init__(self, filename, index_file=None):
+        """
+        Opens a fasta file, building the index if required
+
+        :param filename: fasta file
+        :param index_file: path to the index (default = filename + '.lstrap.idx')
+        """
+        self.filename = filename
+        self.index_file = filename + '.lstrap.idx' if index_file is None else index_file
+
+        # name -> (length, offset, residues per line, bytes per line), in the order of the fasta file
+        self.records = {}
+
+        # taken before building the index, so changes made while it is built are detected next time
+        fingerprint = self.__fingerprint()
+
+        if not self.__read_index(fingerprint):
+            self.__build_index()
+            self.__write_index(fingerprint)
+
+        self.__file = open(filename, 'rb')
+        self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.path.getsize(filename) > 0 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, name):
+        return self.fetch(name)
+
+    def close(self):
+        """
+        Closes the memory-mapped fasta file
+        """
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+        self.__file.close()
+
+    def length(self, name):
+        """
+        :param name: name of the sequence
+        :return: length of the sequence
+        """
+        return self.records[name][0]
+
+    def lengths(self):
+        """
+        :return: dict with the length of each sequence, taken from the index
+        """
+        return {name: record[0] for name, record in self.records.items()}
+
+    def fetch(self, name, start=0, end=None):
+        """
+        Gets (part of) a sequence
+
+        :param name: name of the sequence
+        :param start: first position to include, 0-based (default = 0)
+        :param end: position to stop at, not included (default = None, until the end of the sequence)
+        :return: string with the sequence
+        """
+        length, offset, line_bases, line_width = self.records[name]
+
+        start = max(start, 0)
+        end = length if end is None else min(end, length)
+
+        if start >= end:
+            return ''
+
+        if line_bases > 0:
+            first = offset + (start // line_bases) * line_width + start % line_bases
+            last = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases + 1
+
+            return b''.join(self.__map[first:last].split()).decode('ascii')
+        else:
+            stop = self.__map.find(b'>', offset)
+            stop = len(self.__map) if stop == -1 else stop
+
+            return b''.join(self.__map[offset:stop].split())[start:end].decode('ascii')
+
+    def __build_index(self):
+        """
+        Reads the fasta file once to find the offset and line lengths of each record
+        """
+        def add_record():
+            if regular and line_bases:
+                self.records[name] = (length, start, line_bases, line_width)
+            else:
+                self.records[name] = (length, start, 0, 0)
+
+        name = None
+        offset = 0
+
+        with open(self.filename, 'rb') as f:
+            for line in f:
+                if line.startswith(b'>'):
+                    if name is not None:
+                        add_record()
+
+                    name = line[1:].rstrip().decode('utf-8')
+                    start, length, line_bases, line_width = offset + len(line), 0, None, None
+                    regular, last_line = True, False
+                else:
+                    bases = len(line.rstrip())
+
+                    if line_bases is None:
+                        line_bases, line_width = bases, len(line)
+                    elif last_line or bases > line_bases or (bases == line_bases and len(line) != line_width):
+                        # only the last line of a record can be shorter
+                        regular = False
+                    elif bases < line_bases:
+                        last_line = True
+
+                    length += bases
+
+                offset += len(line)
+
+        if name is not None:
+            add_record()
+
+    def __fingerprint(self):
+        """
+        :return: first line of the index, with the size and modification time (ns) of the fasta file it was built from
+        """
+        stat = os.stat(self.filename)
+
+        return '#%d\t%d' % (stat.st_size, stat.st_mtime_ns)
+
+    def __read_index(self, fingerprint):
+        """
+        Reads an existing index, if it was built from the current fasta file
+
+        :param fingerprint: size and modification time of the fasta file (see __fingerprint)
+        :return: True if the index was read, False if it is missing or outdated
+        """
+        if not os.path.exists(self.index_file):
+            return False
+
+        with open(self.index_file, 'r') as f:
+            if f.readline().rstrip('\n') != fingerprint:
+                return False
+
+            for line in f:
+                # names can contain tabs, the numbers never do
+                parts = line.rstrip('\n').rsplit('\t', 4)
+                self.records[parts[0]] = tuple(int(p) for p in parts[1:5])
+
+        return True
+
+    def __write_index(self, fingerprint):
+        """
+        Writes the index next to the fasta file, if this isn't possible the index is only kept in memory
+
+        :param fingerprint: size and modification time of the fasta file (see __fingerprint)
+        """
+        try:
+            with open(self.index_file + '.tmp', 'w') as f:
+                print(fingerprint, file=f)
+                for name, record in self.records.items():
+                    print(name, *record, sep='\t', file=f)
+
+            os.replace(self.index_file + '.tmp', self.index_file)
+        except OSError as e:
+            print("Could not write fasta index %s (%s)" % (self.index_file, e), file=sys.stderr)
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# the binary matrix reader is shared with the rest of LSTrAP, two levels up from this file
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from utils.matrix import read_binary_matrix, has_binary, binary_path
+
+
+def read_matrix(filename, prefer_binary=False):
+    """
+    Reads an LSTrAP expression matrix into a pandas DataFrame (genes as rows, samples as columns). With prefer_binary
+    the binary copy of the matrix (<filename>.bin) is used if it is at least as recent as the text file, this is much
+    faster to read but values are stored as float32 in the binary copy.
+
+    :param filename: path to the matrix
+    :param prefer_binary: read the binary copy if available (default = False)
+    :return: pandas DataFrame
+    """
+    if prefer_binary and has_binary(filename):
+        genes, samples, values = read_binary_matrix(binary_path(filename))
+        df = pd.DataFrame(np.asarray(values, dtype=np.float64), index=genes, columns=samples)
+        df.index.name = 'gene'
+
+        return df
+
+    return pd.read_table(filename, header=0, index_col=0)
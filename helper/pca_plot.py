@@ -5,19 +5,20 @@ output: plot with the points colored by the tissues that were taken for the give
 """
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 from sklearn.decomposition import PCA as sklearnPCA
 from sklearn import preprocessing
 import seaborn as sns
 
+from parsers.matrix import read_matrix
+
 import argparse
 
 
-def run_pca(expression):
+def run_pca(expression, prefer_binary=False):
     # Load Expression data
 
-    df = pd.read_table(expression, header=0, index_col=0)
+    df = read_matrix(expression, prefer_binary=prefer_binary)
     run_ids = list(df.columns.values)
     dataMatrix = np.transpose(np.array(df))
 
@@ -44,8 +45,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="./pca_plot.py")
 
     parser.add_argument('expression', help='path to expression matrix')
+    parser.add_argument('--binary', dest='prefer_binary', action='store_true', help='read the binary copy of the matrix (written with run.py --binary-matrix) if it is up to date, faster but values are float32')
 
     # Parse arguments and start script
     args = parser.parse_args()
 
-    run_pca(args.expression)
\ No newline at end of file
+    run_pca(args.expression, prefer_binary=args.prefer_binary)
\ No newline at end of file
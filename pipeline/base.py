@@ -3,15 +3,20 @@ import time
 import os
 import shlex
 
-from cluster.templates import build_template, build_batch_template
+from cluster import set_scheduler
+from cluster.report import collect_job_stats
+from utils.manifest import StepManifest
 
 
 class PipelineBase:
-    def __init__(self, config, data, enable_log=False, use_hisat2=False):
+    def __init__(self, config, data, enable_log=False, use_hisat2=False, scheduler=None, hash_inputs=False):
         """
         Constructor run with path to ini file with settings
 
         :param config: path to settings ini file
+        :param scheduler: name of the scheduler to use, overrides the setting in the config file (default = None)
+        :param hash_inputs: store checksums of input files in step manifests, so touched but unchanged inputs don't
+                            trigger a re-run (default = False)
         """
         self.cp = configparser.ConfigParser()
         self.cp.read(config)
@@ -45,12 +50,23 @@ class PipelineBase:
         self.htseq_count_cmd = self.cp['TOOLS']['htseq_count_cmd']
 
         self.pcc_cmd = self.cp['TOOLS']['pcc_cmd']
+        self.pcc_shard_cmd = self.cp['TOOLS'].get('pcc_shard_cmd', None)
+        self.pcc_merge_cmd = self.cp['TOOLS'].get('pcc_merge_cmd', None)
+        self.rank_network_cmd = self.cp['TOOLS'].get('rank_network_cmd', None)
         self.mcl_cmd = self.cp['TOOLS']['mcl_cmd']
         self.mcxdeblast_cmd = self.cp['TOOLS']['mcxdeblast_cmd']
 
         self.interproscan_cmd = self.cp['TOOLS']['interproscan_cmd']
         self.orthofinder_cmd = self.cp['TOOLS']['orthofinder_cmd']
 
+        interproscan_chunks = self.cp['TOOLS'].get('interproscan_chunks', 'auto').strip()
+        self.interproscan_chunks = None if interproscan_chunks in ['', 'auto'] else int(interproscan_chunks)
+        self.interproscan_chunk_size = int(self.cp['TOOLS'].get('interproscan_chunk_size', '150000'))
+
+        local_cores = self.cp['TOOLS'].get('local_cores', '').strip()
+        self.scheduler = set_scheduler(self.cp['TOOLS'].get('scheduler', None) if scheduler is None else scheduler,
+                                       cores=int(local_cores) if local_cores != '' else None)
+
         self.qsub_indexing = shlex.split(self.cp['TOOLS']['qsub_indexing'].strip('\''))
         self.qsub_trimmomatic = shlex.split(self.cp['TOOLS']['qsub_trimmomatic'].strip('\''))
         self.qsub_tophat = shlex.split(self.cp['TOOLS']['qsub_tophat'].strip('\''))
@@ -66,6 +82,7 @@ class PipelineBase:
 
         self.enable_log = enable_log
         self.use_hisat2 = use_hisat2
+        self.hash_inputs = hash_inputs
 
         if self.enable_log:
             self.log = open('lstrap.log', 'w')
@@ -90,7 +107,7 @@ class PipelineBase:
         stamped_filename = str(filename % timestamp)
         stamped_jobname = str(jobname % timestamp)
 
-        template = build_template(stamped_jobname, self.email, module, command)
+        template = self.scheduler.build_template(stamped_jobname, self.email, module, command)
 
         with open(stamped_filename, "w") as f:
             print(template, file=f)
@@ -112,19 +129,71 @@ class PipelineBase:
         stamped_filename = str(filename % timestamp)
         stamped_jobname = str(jobname % timestamp)
 
-        template = build_batch_template(stamped_jobname, self.email, module, command, jobcount)
+        template = self.scheduler.build_batch_template(stamped_jobname, self.email, module, command, jobcount)
 
         with open(stamped_filename, "w") as f:
             print(template, file=f)
 
         return stamped_filename, stamped_jobname
 
+    def write_task_array_script(self, jobname, module, command, filename, tasks):
+        """
+        Writes a batch submission script with one task for each set of variables in tasks, so a single array job can
+        replace a job per file. The variables are written to a task manifest (one line per task, fields separated by the
+        ASCII unit separator so empty values are kept) from which each task reads its own line using $SGE_TASK_ID.
+
+        :param jobname: Name of the job include %d for the timestamp !
+        :param module: Module to load, separate multiple modules using spaces in case more than one module is required
+        :param command: The command to execute, variables of the tasks can be used like ${name}
+        :param filename: Filename for the script include %d for the timestamp !
+        :param tasks: List with a dict of variables for each task, all tasks need to have the same variables
+        :return: Tuple with stamped_filename, stamped_jobname and the filename of the manifest
+        """
+        names = sorted(tasks[0].keys())
+
+        manifest = os.path.abspath(filename.replace('.sh', '') % int(time.time()) + '.tasks.txt')
+        with open(manifest, "w") as f:
+            for task in tasks:
+                print('\x1f'.join(str(task[n]) for n in names), file=f)
+
+        # unlike a tab (whitespace) consecutive separators aren't merged by read, so empty fields stay in place
+        preamble = "IFS=$'\\x1f' read -r %s <<< \"$(sed -n \"${SGE_TASK_ID}p\" %s)\"" % (' '.join(names), manifest)
+
+        stamped_filename, stamped_jobname = self.write_batch_submission_script(jobname, module,
+                                                                               preamble + '\n' + command,
+                                                                               filename, jobcount=len(tasks))
+
+        return stamped_filename, stamped_jobname, manifest
+
+    def step_manifest(self, output):
+        """
+        Opens the manifest of a step, stored next to its output (file or directory)
+
+        :param output: path to the output of the step
+        :return: StepManifest
+        """
+        return StepManifest(os.path.normpath(output) + '.steps.tsv', use_hash=self.hash_inputs)
+
     @staticmethod
-    def clean_out_files(jobname):
+    def mark_done(command):
         """
-        Concatenates output of jobs into a single log file and removes the individual files
+        Extends a command so the file in variable ${done} is created if, and only if, all lines of the command succeed.
+        The command runs in a subshell with set -e, so it stops at the first line that fails and its exit code is kept.
+
+        :param command: The command to execute
+        :return: The extended command
+        """
+        return '(\nset -e\n' + command + '\n)\ntask_exit=$?\n' \
+               'if [ $task_exit -eq 0 ]; then touch ${done}; fi\n(exit $task_exit)'
+
+    @staticmethod
+    def clean_out_files(jobname, samples=None):
+        """
+        Concatenates output of jobs into a single log file and removes the individual files. The timing and resource
+        use of the jobs is added to the report of the run (see cluster.report).
 
         :param jobname: name of the job
+        :param samples: dict with the sample for each task id of an array job (default = None)
         """
 
         def write_log(files, log):
@@ -158,3 +227,5 @@ class PipelineBase:
 
         for f in out_files + err_files:
             os.remove(f)
+
+        collect_job_stats(jobname, samples=samples)
@@ -25,7 +25,9 @@ def check_sanity_data(filename):
                              'htseq_output', 'exp_matrix_output', 'exp_matrix_tpm_output', 'exp_matrix_rpkm_output',
                              'interpro_output', 'pcc_output', 'pcc_mcl_output', 'mcl_cluster_output']
             required_paths = ['cds_fasta', 'protein_fasta', 'genome_fasta', 'gff_file', 'fastq_dir']
-            optional_settings = ['tophat_cutoff', 'htseq_cutoff']
+            optional_settings = ['tophat_cutoff', 'htseq_cutoff', 'exp_matrix_cpm_output', 'pcc_top_k', 'pcc_cutoff',
+                                 'pcc_sparse', 'pcc_method', 'pcc_store_output', 'rank_network_method', 'rank_network_max_rank',
+                                 'rank_network_output']
 
             for g in genomes:
                 if not all([i in cp[g].keys() for i in required_keys]):
@@ -1,59 +1,106 @@
 import os
-import subprocess
+import sys
 
-from cluster import wait_for_job
+from cluster import submit_array_job, wait_for_job
 
-from utils.parser.fasta import Fasta
+from utils.parser.fasta import iter_records, sequence_lengths
 from math import ceil
 from .base import PipelineBase
 
 
-class InterProPipeline(PipelineBase):
+def split_fasta(file, chunks, output_directory, filenames="proteins_%d.fasta", chunk_size=150000):
+    """
+    Splits a fasta file into a number of chunks with about the same number of residues (rather than sequences), so
+    chunks with long proteins don't hold up the array job. The order of the sequences is kept. The file is read twice,
+    once to get the length of each sequence and once to write the chunks, sequences are not kept in memory.
 
-    def run_interproscan(self):
-        """
-        Runs interproscan for all or
-        """
+    :param file: input fasta file
+    :param chunks: number of parts to split the file into, None to pick the number based on chunk_size
+    :param output_directory: output directory
+    :param filenames: template for the filenames, should contain %d for the number
+    :param chunk_size: number of residues per chunk when the number of chunks is picked automatically (default = 150000)
+    :return: number of chunks written, lower than chunks if there are fewer sequences
+    """
+    lengths = [length for _, length in sequence_lengths(file)]
+    total = sum(lengths)
+
+    if chunks is None:
+        chunks = ceil(total / chunk_size)
 
-        def split_fasta(file, chunks, output_directory, filenames="proteins_%d.fasta"):
-            """
-            Splits a fasta file into a number of chuncks
+    chunks = max(1, min(chunks, len(lengths)))
+    target = total / chunks
 
-            :param file: input fasta file
-            :param chunks: number of parts to split the file into
-            :param output_directory: output directory
-            :param filenames: template for the filenames, should contain %d for the number
-            """
-            fasta = Fasta()
-            fasta.readfile(file)
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
 
-            for k in fasta.sequences.keys():
-                fasta.sequences[k] = fasta.sequences[k].replace('*', '')
+    chunk, residues, count = 0, 0, 0
+    f = None
 
-            seq_per_chunk = ceil(len(fasta.sequences.keys())/chunks)
+    for i, (name, sequence) in enumerate(iter_records(file)):
+        # start the next chunk when the middle of this sequence lies beyond the current chunk, or when every chunk left
+        # needs one of the remaining sequences
+        if f is None or (chunk < chunks and count > 0 and
+                         (residues + lengths[i] / 2 > chunk * target or len(lengths) - i == chunks - chunk)):
+            if f is not None:
+                f.close()
+            chunk += 1
+            count = 0
+            f = open(os.path.join(output_directory, filenames % chunk), 'w')
 
-            if not os.path.exists(output_directory):
-                os.makedirs(output_directory)
+        print(">" + name, file=f)
+        print(sequence.replace('*', ''), file=f)
 
-            for i in range(1, chunks+1):
-                subset = fasta.remove_subset(seq_per_chunk)
-                filename = filenames % i
-                filename = os.path.join(output_directory, filename)
+        residues += lengths[i]
+        count += 1
 
-                subset.writefile(filename)
+    if f is not None:
+        f.close()
 
-        filename, jobname = self.write_batch_submission_script("interproscan_%d", self.interproscan_module, self.interproscan_cmd, "interproscan_%d.sh")
+    return chunk
+
+
+class InterProPipeline(PipelineBase):
+
+    def run_interproscan(self, graph=None):
+        """
+        Runs interproscan for all or
+
+        :param graph: JobGraph to add the jobs to, when set the jobs are not run here (default = None)
+        :return: dict with, for each genome, the key of the job in graph (None without graph)
+        """
+        keys = {}
+        jobs = []
 
         for g in self.genomes:
             tmp_dir = os.path.join(self.dp[g]['interpro_output'], 'tmp')
             os.makedirs(self.dp[g]['interpro_output'], exist_ok=True)
             os.makedirs(tmp_dir, exist_ok=True)
 
-            split_fasta(self.dp[g]['protein_fasta'], 100, tmp_dir, filenames="interpro_in_%d")
-            command = ["qsub"] + self.qsub_interproscan + ["-v", "in_dir=%s,in_prefix=%s,out_dir=%s,out_prefix=%s" % (tmp_dir, "interpro_in_", self.dp[g]['interpro_output'], "output_"), filename]
-            subprocess.call(command)
+            chunks = split_fasta(self.dp[g]['protein_fasta'], self.interproscan_chunks, tmp_dir,
+                                 filenames="interpro_in_%d", chunk_size=self.interproscan_chunk_size)
+
+            if chunks == 0:
+                print("No sequences found in %s, skipping InterProScan for %s" % (self.dp[g]['protein_fasta'], g),
+                      file=sys.stderr)
+                continue
+
+            # the number of tasks depends on the number of chunks, so each genome gets its own array job
+            filename, jobname = self.write_batch_submission_script("interproscan_" + g + "_%d",
+                                                                   self.interproscan_module, self.interproscan_cmd,
+                                                                   "interproscan_" + g + "_%d.sh", jobcount=chunks)
+            variables = "in_dir=%s,in_prefix=%s,out_dir=%s,out_prefix=%s" % (tmp_dir, "interpro_in_", self.dp[g]['interpro_output'], "output_")
+
+            if graph is None:
+                submit_array_job(filename, jobname, self.qsub_interproscan, variables)
+                jobs.append((filename, jobname))
+            else:
+                keys[g] = graph.add(g + '/interproscan', filename, jobname, self.qsub_interproscan, variables)
+
+        if graph is not None:
+            return keys
 
-        wait_for_job(jobname, sleep_time=1)
+        for filename, jobname in jobs:
+            wait_for_job(jobname, sleep_time=1)
 
-        os.remove(filename)
-        PipelineBase.clean_out_files(jobname)
+            os.remove(filename)
+            PipelineBase.clean_out_files(jobname)
@@ -1,13 +1,49 @@
 import os
-import subprocess
 import sys
 from shutil import copy
 
-from cluster import wait_for_job
+from cluster import submit_job, wait_for_job
 
 from .base import PipelineBase
 
 
+def concatenate_files(filenames, output):
+    """
+    Concatenates files into a single file
+
+    :param filenames: list of files to concatenate
+    :param output: path to the output file
+    """
+    with open(output, 'w') as outfile:
+        for fname in filenames:
+            with open(fname) as infile:
+                for line in infile:
+                    outfile.write(line)
+
+
+def convert_mcl_families(sequence_ids, mcl_families, output):
+    """
+    Replaces the OrthoFinder sequence ids in the families found by MCL with the gene names
+
+    :param sequence_ids: path to SequenceIDs.txt from OrthoFinder
+    :param mcl_families: path to the MCL output (one family per line)
+    :param output: path to write the families with gene names to
+    """
+    id_conversion = {}
+    with open(sequence_ids) as infile:
+        for line in infile:
+            parts = line.strip().split()
+            id = parts[0].strip(':')
+            gene = parts[1]
+
+            id_conversion[id] = gene
+
+    with open(mcl_families, 'r') as infile, open(output, 'w') as outfile:
+        for l in infile:
+            parts = [id_conversion[id] if id in id_conversion.keys() else '!error!' for id in l.strip().split()]
+            print('\t'.join(parts), file=outfile)
+
+
 class OrthologyPipeline(PipelineBase):
 
     def run_orthofinder(self):
@@ -29,8 +65,7 @@ class OrthologyPipeline(PipelineBase):
             print('çopying', self.dp[g]['protein_fasta'], 'to', os.path.join(orthofinder_dir, g + '.fasta'))
             copy(self.dp[g]['protein_fasta'], os.path.join(orthofinder_dir, g + '.fasta'))
 
-        command = ["qsub"] + self.qsub_orthofinder + ["-v", "fasta_dir=" + orthofinder_dir, filename]
-        subprocess.call(command)
+        submit_job(filename, jobname, self.qsub_orthofinder, "fasta_dir=" + orthofinder_dir)
 
         # wait for all jobs to complete
         wait_for_job(jobname)
@@ -62,11 +97,7 @@ class OrthologyPipeline(PipelineBase):
         full_blast_abc = os.path.join(working_dir, 'full_blast.abc')
         mcl_families_out = os.path.join(orthofinder_dir, 'mcl_families.unprocessed.txt')
 
-        with open(full_blast, 'w') as outfile:
-            for fname in orthofinder_blast_files:
-                with open(os.path.join(working_dir, fname)) as infile:
-                    for line in infile:
-                        outfile.write(line)
+        concatenate_files([os.path.join(working_dir, fname) for fname in orthofinder_blast_files], full_blast)
 
         filename, jobname = self.write_submission_script("mcl_%d",
                                                          self.mcl_module,
@@ -74,29 +105,16 @@ class OrthologyPipeline(PipelineBase):
                                                          self.mcl_cmd,
                                                          "mcl_%d.sh")
         # submit job
-        command = ["qsub"] + self.qsub_mcxdeblast + \
-                  ["-v", "blast_in=" + full_blast +
+        submit_job(filename, jobname, self.qsub_mcxdeblast, "blast_in=" + full_blast +
                    ",abc_out=" + full_blast_abc +
                    ",in=" + full_blast_abc +
-                   ",out=" + mcl_families_out, filename]
-        subprocess.call(command)
+                   ",out=" + mcl_families_out)
 
         # wait for all jobs to complete
         wait_for_job(jobname)
 
-        id_conversion = {}
-        with open(os.path.join(working_dir, 'SequenceIDs.txt')) as infile:
-            for line in infile:
-                parts = line.strip().split()
-                id = parts[0].strip(':')
-                gene = parts[1]
-
-                id_conversion[id] = gene
-
-        with open(mcl_families_out, 'r') as infile, open(os.path.join(orthofinder_dir, 'mcl_families.processed.txt'), 'w') as outfile:
-            for l in infile:
-                parts = [id_conversion[id] if id in id_conversion.keys() else '!error!' for id in l.strip().split()]
-                print('\t'.join(parts), file=outfile)
+        convert_mcl_families(os.path.join(working_dir, 'SequenceIDs.txt'), mcl_families_out,
+                             os.path.join(orthofinder_dir, 'mcl_families.processed.txt'))
 
         # remove the submission script
         os.remove(filename)
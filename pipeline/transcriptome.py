@@ -1,11 +1,12 @@
-import subprocess
+import numpy as np
 import os
 import sys
 import shutil
-import re
 
-from cluster import wait_for_job
-from utils.matrix import read_matrix, write_matrix, normalize_matrix_counts, normalize_matrix_length
+from cluster import submit_job, submit_array_job, wait_for_job
+from cluster.graph import JobGraph
+from utils.matrix import ExpressionMatrix, read_gene_lengths, length_index_key, merge_genes, has_binary
+from utils.manifest import SampleManifest, StepManifest
 from .base import PipelineBase
 from .check.quality import check_tophat, check_hisat2, check_htseq
 
@@ -36,9 +37,7 @@ class TranscriptomePipeline(PipelineBase):
             os.makedirs(os.path.dirname(output), exist_ok=True)
             shutil.copy(con_file, output + '.fa')
 
-            command = ["qsub"] + self.qsub_indexing + ["-v", "in=" + con_file + ",out=" + output, filename]
-
-            subprocess.call(command)
+            submit_job(filename, jobname, self.qsub_indexing, "in=" + con_file + ",out=" + output)
 
         print("Preparing the genomic fasta file...")
 
@@ -55,22 +54,20 @@ class TranscriptomePipeline(PipelineBase):
 
     def trim_fastq(self, overwrite=False):
         """
-        Runs Trimmomatic on all fastq files
+        Runs Trimmomatic on all fastq files, files trimmed before with the same settings are skipped (see StepManifest)
+
+        :param overwrite: when true all files are trimmed again
         """
-        filename_se, jobname = self.write_submission_script("trimmomatic_%d",
-                                                            None,
-                                                            self.trimmomatic_se_cmd,
-                                                            "trimmomatic_se_%d.sh")
-        filename_pe, jobname = self.write_submission_script("trimmomatic_%d",
-                                                            None,
-                                                            self.trimmomatic_pe_cmd,
-                                                            "trimmomatic_pe_%d.sh")
+        se_tasks, pe_tasks = [], []
+        steps = []
 
         for g in self.genomes:
             fastq_input_dir = self.dp[g]['fastq_dir']
             trimmed_output = self.dp[g]['trimmomatic_output']
             os.makedirs(trimmed_output, exist_ok=True)
 
+            steps.append(self.step_manifest(trimmed_output))
+
             fastq_files = []
 
             for file in os.listdir(fastq_input_dir):
@@ -102,43 +99,45 @@ class TranscriptomePipeline(PipelineBase):
 
                         outbp = os.path.join(trimmed_output, outbp)
                         outbu = os.path.join(trimmed_output, outbu)
-                        if overwrite or not os.path.exists(outap):
+                        if self.__add_task(pe_tasks, steps[-1], outap, self.trimmomatic_pe_cmd,
+                                           {'ina': ina, 'inb': inb, 'outap': outap, 'outau': outau, 'outbp': outbp,
+                                            'outbu': outbu, 'jar': self.trimmomatic_path,
+                                            'sample': file.rsplit('_1.', 1)[0]},
+                                           [ina, inb], [outap, outau, outbp, outbu], overwrite):
                             print('Submitting pair %s, %s' % (file, pair_file))
-                            command = ["qsub"] + self.qsub_trimmomatic + \
-                                      ["-v", "ina=%s,inb=%s,outap=%s,outau=%s,outbp=%s,outbu=%s,jar=%s" % (ina, inb, outap, outau, outbp, outbu, self.trimmomatic_path), filename_pe]
-                            subprocess.call(command)
                         else:
                             print('Found', outap, 'skipping')
                     else:
                         outfile = file.replace('.fq.gz', '.trimmed.fq.gz') if file.endswith('.fq.gz') else file.replace('.fastq.gz', '.trimmed.fastq.gz')
-                        if overwrite or not os.path.exists(os.path.join(trimmed_output, outfile)):
+                        infile, outfile = os.path.join(fastq_input_dir, file), os.path.join(trimmed_output, outfile)
+                        if self.__add_task(se_tasks, steps[-1], outfile, self.trimmomatic_se_cmd,
+                                           {'in': infile, 'out': outfile, 'jar': self.trimmomatic_path,
+                                            'sample': file.replace('.fastq.gz', '').replace('.fq.gz', '')},
+                                           [infile], [outfile], overwrite):
                             print('Submitting single %s' % file)
-                            command = ["qsub"] + self.qsub_trimmomatic + ["-v", "in=" + os.path.join(fastq_input_dir, file) + ",out=" + os.path.join(trimmed_output, outfile) +
-                                                ",jar=" + self.trimmomatic_path, filename_se]
-                            subprocess.call(command)
                         else:
                             print('Found', outfile, 'skipping')
                 else:
                     outfile = file.replace('.fq.gz', '.trimmed.fq.gz') if file.endswith('.fq.gz') else file.replace('.fastq.gz', '.trimmed.fastq.gz')
-                    if overwrite or not os.path.exists(os.path.join(trimmed_output, outfile)):
+                    infile, outfile = os.path.join(fastq_input_dir, file), os.path.join(trimmed_output, outfile)
+                    if self.__add_task(se_tasks, steps[-1], outfile, self.trimmomatic_se_cmd,
+                                       {'in': infile, 'out': outfile, 'jar': self.trimmomatic_path,
+                                        'sample': file.replace('.fastq.gz', '').replace('.fq.gz', '')},
+                                       [infile], [outfile], overwrite):
                         print('Submitting single %s' % file)
-                        command = ["qsub"] + self.qsub_trimmomatic + ["-v", "in=" + os.path.join(fastq_input_dir, file) + ",out=" + os.path.join(trimmed_output, outfile) +
-                                         ",jar=" + self.trimmomatic_path, filename_se]
-                        subprocess.call(command)
                     else:
                         print('Found', outfile, 'skipping')
 
-        print('Trimming fastq files...')
-
-        # wait for all jobs to complete
-        wait_for_job(jobname, sleep_time=1)
+        # a single array job for all single-end and one for all paired-end files
+        submitted = self.__submit_tasks("trimmomatic_se_%d", None, self.trimmomatic_se_cmd, "trimmomatic_se_%d.sh",
+                                        se_tasks, self.qsub_trimmomatic)
+        submitted += self.__submit_tasks("trimmomatic_pe_%d", None, self.trimmomatic_pe_cmd, "trimmomatic_pe_%d.sh",
+                                         pe_tasks, self.qsub_trimmomatic)
 
-        # remove the submission script
-        os.remove(filename_se)
-        os.remove(filename_pe)
+        print('Trimming fastq files...')
 
-        # remove OUT_ files
-        PipelineBase.clean_out_files(jobname)
+        # wait for all jobs to complete, remove the submission scripts, manifests and OUT_ files
+        self.__wait_for_tasks(submitted, steps)
 
         print("Done\n\n")
 
@@ -149,17 +148,8 @@ class TranscriptomePipeline(PipelineBase):
         :param overwrite: when true the pipeline will start tophat even if the output exists
         :param keep_previous: when true trimmed fastq files will not be removed after tophat completes
         """
-        filename_se, jobname = self.write_submission_script("tophat_%d",
-                                                            self.bowtie_module + ' ' + self.tophat_module,
-                                                            self.tophat_se_cmd,
-                                                            "tophat_se_%d.sh")
-
-        filename_pe, jobname = self.write_submission_script("tophat_%d",
-                                                            self.bowtie_module + ' ' + self.tophat_module,
-                                                            self.tophat_pe_cmd,
-                                                            "tophat_pe_%d.sh")
-
-        print('Mapping reads with tophat...')
+        se_tasks, pe_tasks = [], []
+        steps = []
 
         for g in self.genomes:
             tophat_output = self.dp[g]['alignment_output']
@@ -167,6 +157,8 @@ class TranscriptomePipeline(PipelineBase):
             trimmed_fastq_dir = self.dp[g]['trimmomatic_output']
             os.makedirs(tophat_output, exist_ok=True)
 
+            steps.append(self.step_manifest(tophat_output))
+
             pe_files = []
             se_files = []
 
@@ -188,25 +180,36 @@ class TranscriptomePipeline(PipelineBase):
                     output_dir = os.path.join(tophat_output, output_dir)
                     forward = os.path.join(trimmed_fastq_dir, pe_file)
                     reverse = os.path.join(trimmed_fastq_dir, pair_file)
-                    if overwrite or not os.path.exists(os.path.join(output_dir, 'accepted_hits.bam')):
+                    if self.__add_task(pe_tasks, steps[-1], output_dir, self.tophat_pe_cmd,
+                                       {'out': output_dir, 'genome': bowtie_output, 'forward': forward,
+                                        'reverse': reverse, 'sample': os.path.basename(output_dir)},
+                                       [forward, reverse], [os.path.join(output_dir, 'accepted_hits.bam')], overwrite):
                         print('Submitting pair %s, %s' % (pe_file, pair_file))
-                        command = ["qsub"] + self.qsub_tophat + ["-v", "out=%s,genome=%s,forward=%s,reverse=%s" % (output_dir, bowtie_output, forward, reverse), filename_pe]
-                        subprocess.call(command)
                     else:
                         print('Output exists, skipping', pe_file)
 
             for se_file in se_files:
                 output_dir = se_file.replace('.trimmed.fq.gz', '').replace('.trimmed.fastq.gz', '')
                 output_dir = os.path.join(tophat_output, output_dir)
-                if overwrite or not os.path.exists(os.path.join(output_dir, 'accepted_hits.bam')):
+                fq = os.path.join(trimmed_fastq_dir, se_file)
+                if self.__add_task(se_tasks, steps[-1], output_dir, self.tophat_se_cmd,
+                                   {'out': output_dir, 'genome': bowtie_output, 'fq': fq,
+                                    'sample': os.path.basename(output_dir)},
+                                   [fq], [os.path.join(output_dir, 'accepted_hits.bam')], overwrite):
                     print('Submitting single %s' % se_file)
-                    command = ["qsub"] + self.qsub_tophat + ["-v", "out=%s,genome=%s,fq=%s" % (output_dir, bowtie_output, os.path.join(trimmed_fastq_dir, se_file)), filename_se]
-                    subprocess.call(command)
                 else:
                     print('Output exists, skipping', se_file)
 
-        # wait for all jobs to complete
-        wait_for_job(jobname, sleep_time=1)
+        modules = self.bowtie_module + ' ' + self.tophat_module
+        submitted = self.__submit_tasks("tophat_se_%d", modules, self.tophat_se_cmd, "tophat_se_%d.sh", se_tasks,
+                                        self.qsub_tophat)
+        submitted += self.__submit_tasks("tophat_pe_%d", modules, self.tophat_pe_cmd, "tophat_pe_%d.sh", pe_tasks,
+                                         self.qsub_tophat)
+
+        print('Mapping reads with tophat...')
+
+        # wait for all jobs to complete, remove the submission scripts, manifests and OUT_ files
+        self.__wait_for_tasks(submitted, steps)
 
         # remove all trimmed fastq files when keep_previous is disabled
         if not keep_previous:
@@ -215,13 +218,6 @@ class TranscriptomePipeline(PipelineBase):
                 for file in os.listdir(trimmed_fastq_dir):
                     os.remove(os.path.join(trimmed_fastq_dir, file))
 
-        # remove the submission script
-        os.remove(filename_se)
-        os.remove(filename_pe)
-
-        # remove OUT_ files
-        PipelineBase.clean_out_files(jobname)
-
     def __run_hisat2(self, overwrite=False, keep_previous=False):
         """
         Maps the reads from the trimmed fastq files to the bowtie-indexed genome
@@ -229,17 +225,8 @@ class TranscriptomePipeline(PipelineBase):
         :param overwrite: when true the pipeline will start tophat even if the output exists
         :param keep_previous: when true trimmed fastq files will not be removed after tophat completes
         """
-        filename_se, jobname = self.write_submission_script("hisat2_%d",
-                                                            self.hisat2_module,
-                                                            self.hisat2_se_cmd,
-                                                            "hisat2_se_%d.sh")
-
-        filename_pe, jobname = self.write_submission_script("hisat2_%d",
-                                                            self.hisat2_module,
-                                                            self.hisat2_pe_cmd,
-                                                            "hisat2_pe_%d.sh")
-
-        print('Mapping reads with HISAT2...')
+        se_tasks, pe_tasks = [], []
+        steps = []
 
         for g in self.genomes:
             alignment_output = self.dp[g]['alignment_output']
@@ -247,6 +234,8 @@ class TranscriptomePipeline(PipelineBase):
             trimmed_fastq_dir = self.dp[g]['trimmomatic_output']
             os.makedirs(alignment_output, exist_ok=True)
 
+            steps.append(self.step_manifest(alignment_output))
+
             pe_files = []
             se_files = []
 
@@ -270,12 +259,12 @@ class TranscriptomePipeline(PipelineBase):
                     output_stats = os.path.join(alignment_output, output_stats)
                     forward = os.path.join(trimmed_fastq_dir, pe_file)
                     reverse = os.path.join(trimmed_fastq_dir, pair_file)
-                    if overwrite or not os.path.exists(output_sam):
+                    if self.__add_task(pe_tasks, steps[-1], output_sam, self.hisat2_pe_cmd,
+                                       {'out': output_sam, 'genome': indexing_output, 'forward': forward,
+                                        'reverse': reverse, 'stats': output_stats,
+                                        'sample': os.path.basename(output_sam)[:-len('.sam')]},
+                                       [forward, reverse], [output_sam, output_stats], overwrite):
                         print('Submitting pair %s, %s' % (pe_file, pair_file))
-                        command = ["qsub"] + self.qsub_tophat + \
-                                  ["-v", "out=%s,genome=%s,forward=%s,reverse=%s,stats=%s" %
-                                   (output_sam, indexing_output, forward, reverse, output_stats), filename_pe]
-                        subprocess.call(command)
                     else:
                         print('Output exists, skipping', pe_file)
 
@@ -285,26 +274,24 @@ class TranscriptomePipeline(PipelineBase):
                 output_stats = se_file.replace('.trimmed.fq.gz', '').replace('.trimmed.fastq.gz', '') + '.stats'
                 output_stats = os.path.join(alignment_output, output_stats)
 
-                if overwrite or not os.path.exists(output_sam):
+                fq = os.path.join(trimmed_fastq_dir, se_file)
+                if self.__add_task(se_tasks, steps[-1], output_sam, self.hisat2_se_cmd,
+                                   {'out': output_sam, 'genome': indexing_output, 'fq': fq, 'stats': output_stats,
+                                    'sample': os.path.basename(output_sam)[:-len('.sam')]},
+                                   [fq], [output_sam, output_stats], overwrite):
                     print('Submitting single %s' % se_file)
-                    command = ["qsub"] + self.qsub_tophat + ["-v",
-                                                             "out=%s,genome=%s,fq=%s,stats=%s" %
-                                                             (output_sam, indexing_output,
-                                                              os.path.join(trimmed_fastq_dir, se_file), output_stats),
-                                                             filename_se]
-                    subprocess.call(command)
                 else:
                     print('Output exists, skipping', se_file)
 
-        # wait for all jobs to complete
-        wait_for_job(jobname, sleep_time=1)
+        submitted = self.__submit_tasks("hisat2_se_%d", self.hisat2_module, self.hisat2_se_cmd, "hisat2_se_%d.sh",
+                                        se_tasks, self.qsub_tophat)
+        submitted += self.__submit_tasks("hisat2_pe_%d", self.hisat2_module, self.hisat2_pe_cmd, "hisat2_pe_%d.sh",
+                                         pe_tasks, self.qsub_tophat)
 
-        # remove the submission script
-        os.remove(filename_se)
-        os.remove(filename_pe)
+        print('Mapping reads with HISAT2...')
 
-        # remove OUT_ files
-        PipelineBase.clean_out_files(jobname)
+        # wait for all jobs to complete, remove the submission scripts, manifests and OUT_ files
+        self.__wait_for_tasks(submitted, steps)
 
     def run_alignment(self, overwrite=False, keep_previous=False):
         """
@@ -322,22 +309,23 @@ class TranscriptomePipeline(PipelineBase):
 
         print("Done\n\n")
 
-    def __run_htseq_count_tophat(self, keep_previous=False):
+    def __run_htseq_count_tophat(self, keep_previous=False, overwrite=False):
         """
         Based on the gff file and sam file counts the number of reads that map to a given gene
 
         :param keep_previous: when true sam files output will not be removed after htseq-count completes
+        :param overwrite: when true all files are counted again, otherwise files counted before are skipped
         """
-        filename, jobname = self.write_submission_script("htseq_count_%d",
-                                                         (self.samtools_module + '\t' + self.python_module),
-                                                         self.htseq_count_cmd,
-                                                         "htseq_count_%d.sh")
+        tasks = []
+        steps = []
 
         for g in self.genomes:
             tophat_output = self.dp[g]['alignment_output']
             htseq_output = self.dp[g]['htseq_output']
             os.makedirs(htseq_output, exist_ok=True)
 
+            steps.append(self.step_manifest(htseq_output))
+
             gff_file = self.dp[g]['gff_file']
             gff_feature = self.dp[g]['gff_feature']
             gff_id = self.dp[g]['gff_id']
@@ -351,15 +339,19 @@ class TranscriptomePipeline(PipelineBase):
 
             for d, bam_file in bam_files:
                 htseq_out = os.path.join(htseq_output, d + '.htseq')
-                print(d, bam_file, htseq_out)
+                if self.__add_task(tasks, steps[-1], htseq_out, self.htseq_count_cmd,
+                                   {'itype': 'bam', 'feature': gff_feature, 'field': gff_id, 'bam': bam_file,
+                                    'gff': gff_file, 'out': htseq_out, 'sample': d},
+                                   [bam_file, gff_file], [htseq_out], overwrite):
+                    print(d, bam_file, htseq_out)
+                else:
+                    print('Found', htseq_out, 'skipping')
 
-                command = ["qsub"] + self.qsub_htseq_count + ["-v", "itype=bam,feature=%s,field=%s,bam=%s,gff=%s,out=%s"
-                                                              % (gff_feature, gff_id, bam_file, gff_file, htseq_out),
-                                                              filename]
-                subprocess.call(command)
+        submitted = self.__submit_tasks("htseq_count_%d", self.samtools_module + '\t' + self.python_module,
+                                        self.htseq_count_cmd, "htseq_count_%d.sh", tasks, self.qsub_htseq_count)
 
-        # wait for all jobs to complete
-        wait_for_job(jobname, sleep_time=1)
+        # wait for all jobs to complete, remove the submission script, manifest and OUT_ files
+        self.__wait_for_tasks(submitted, steps)
 
         # remove all tophat files files when keep_previous is disabled
         # NOTE: only the large bam file is removed (for now)
@@ -372,22 +364,17 @@ class TranscriptomePipeline(PipelineBase):
                     if os.path.exists(bam_file):
                         os.remove(bam_file)
 
-        # remove the submission script
-        os.remove(filename)
-
-        # remove OUT_ files
-        PipelineBase.clean_out_files(jobname)
+    def __run_htseq_count_hisat2(self, keep_previous=False, overwrite=False):
+        tasks = []
+        steps = []
 
-    def __run_htseq_count_hisat2(self, keep_previous=False):
-        filename, jobname = self.write_submission_script("htseq_count_%d",
-                                                         (self.samtools_module + '\t' + self.python_module),
-                                                         self.htseq_count_cmd,
-                                                         "htseq_count_%d.sh")
         for g in self.genomes:
             alignment_output = self.dp[g]['alignment_output']
             htseq_output = self.dp[g]['htseq_output']
             os.makedirs(htseq_output, exist_ok=True)
 
+            steps.append(self.step_manifest(htseq_output))
+
             gff_file = self.dp[g]['gff_file']
             gff_feature = self.dp[g]['gff_feature']
             gff_id = self.dp[g]['gff_id']
@@ -397,17 +384,20 @@ class TranscriptomePipeline(PipelineBase):
 
             for sam_file in sam_files:
                 htseq_out = os.path.join(htseq_output, sam_file.replace('.sam', '.htseq'))
-                print(sam_file, htseq_out)
+                sam_path = os.path.join(alignment_output, sam_file)
+                if self.__add_task(tasks, steps[-1], htseq_out, self.htseq_count_cmd,
+                                   {'itype': 'sam', 'feature': gff_feature, 'field': gff_id, 'bam': sam_path,
+                                    'gff': gff_file, 'out': htseq_out, 'sample': sam_file[:-len('.sam')]},
+                                   [sam_path, gff_file], [htseq_out], overwrite):
+                    print(sam_file, htseq_out)
+                else:
+                    print('Found', htseq_out, 'skipping')
 
-                command = ["qsub"] + self.qsub_htseq_count + ["-v", "itype=sam,feature=%s,field=%s,bam=%s,gff=%s,out=%s"
-                                                              % (gff_feature, gff_id,
-                                                                 os.path.join(alignment_output, sam_file),
-                                                                 gff_file, htseq_out),
-                                                              filename]
-                subprocess.call(command)
+        submitted = self.__submit_tasks("htseq_count_%d", self.samtools_module + '\t' + self.python_module,
+                                        self.htseq_count_cmd, "htseq_count_%d.sh", tasks, self.qsub_htseq_count)
 
-        # wait for all jobs to complete
-        wait_for_job(jobname, sleep_time=1)
+        # wait for all jobs to complete, remove the submission script, manifest and OUT_ files
+        self.__wait_for_tasks(submitted, steps)
 
         if not keep_previous:
             for g in self.genomes:
@@ -419,26 +409,378 @@ class TranscriptomePipeline(PipelineBase):
                     if os.path.exists(sam_file):
                         os.remove(sam_file)
 
-        # remove the submission script
-        os.remove(filename)
-
-        # remove OUT_ files
-        PipelineBase.clean_out_files(jobname)
-
-    def run_htseq_count(self, keep_previous=False):
+    def run_htseq_count(self, keep_previous=False, overwrite=False):
         """
         Depending on which alinger was used, run htseq-counts to determine expression levels.
 
         :param keep_previous: when true sam files output will not be removed after htseq-count completes
+        :param overwrite: when true all files are counted again, otherwise files counted before with the same settings
+                          are skipped (see StepManifest)
         """
 
         if self.use_hisat2:
-            self.__run_htseq_count_hisat2(keep_previous=keep_previous)
+            self.__run_htseq_count_hisat2(keep_previous=keep_previous, overwrite=overwrite)
         else:
-            self.__run_htseq_count_tophat(keep_previous=keep_previous)
+            self.__run_htseq_count_tophat(keep_previous=keep_previous, overwrite=overwrite)
 
         print("Done\n\n")
 
+    def __samples(self, g):
+        """
+        Lists the samples of a genome, based on the fastq files (paired files end in _1 and _2), with the variables and
+        output of the trimming, alignment and htseq-count job for each sample. For each job the key, inputs and outputs
+        in the step manifest are included (in files), these are the same as in the separate steps.
+
+        :param g: genome to list the samples for
+        :return: list of dicts, one for each sample
+        """
+        fastq_input_dir = self.dp[g]['fastq_dir']
+        trimmed_output = self.dp[g]['trimmomatic_output']
+        alignment_output = self.dp[g]['alignment_output']
+        indexing_output = self.dp[g]['indexing_output']
+        htseq_output = self.dp[g]['htseq_output']
+
+        gff_file = self.dp[g]['gff_file']
+        gff_feature = self.dp[g]['gff_feature']
+        gff_id = self.dp[g]['gff_id']
+
+        # sort required to make sure _1 files are before _2
+        fastq_files = sorted(f for f in os.listdir(fastq_input_dir) if f.endswith('.fq.gz') or f.endswith('.fastq.gz'))
+
+        samples = []
+
+        while len(fastq_files) > 0:
+            file = fastq_files.pop(0)
+            extension = '.fq.gz' if file.endswith('.fq.gz') else '.fastq.gz'
+            pair_file = file.replace('_1.', '_2.')
+
+            if '_1.' in file and pair_file in fastq_files:
+                fastq_files.remove(pair_file)
+
+                name = file[:-len('_1' + extension)]
+                outap, outau, outbp, outbu = [os.path.join(trimmed_output, f.replace(extension, '.trimmed.%s' % t + extension))
+                                              for f in [file, pair_file] for t in ['paired', 'unpaired']]
+
+                sample = {'name': name, 'paired': True, 'trimmed': [outap, outau, outbp, outbu],
+                          'trim': "ina=%s,inb=%s,outap=%s,outau=%s,outbp=%s,outbu=%s,jar=%s" %
+                                  (os.path.join(fastq_input_dir, file), os.path.join(fastq_input_dir, pair_file),
+                                   outap, outau, outbp, outbu, self.trimmomatic_path)}
+                sample['files'] = {'trim': (outap, [os.path.join(fastq_input_dir, f) for f in [file, pair_file]],
+                                            sample['trimmed'])}
+                reads = "forward=%s,reverse=%s" % (outap, outbp)
+                trimmed = [outap, outbp]
+            else:
+                name = file[:-len(extension)]
+                outfile = os.path.join(trimmed_output, name + '.trimmed' + extension)
+
+                sample = {'name': name, 'paired': False, 'trimmed': [outfile],
+                          'trim': "in=%s,out=%s,jar=%s" % (os.path.join(fastq_input_dir, file), outfile,
+                                                           self.trimmomatic_path)}
+                sample['files'] = {'trim': (outfile, [os.path.join(fastq_input_dir, file)], [outfile])}
+                reads = "fq=%s" % outfile
+                trimmed = [outfile]
+
+            if self.use_hisat2:
+                aligned = os.path.join(alignment_output, name + '.sam')
+                sample['align'] = "out=%s,genome=%s,%s,stats=%s" % (aligned, indexing_output, reads,
+                                                                     os.path.join(alignment_output, name + '.stats'))
+                sample['files']['align'] = (aligned, trimmed, [aligned, os.path.join(alignment_output, name + '.stats')])
+                itype = 'sam'
+            else:
+                aligned = os.path.join(alignment_output, name, 'accepted_hits.bam')
+                sample['align'] = "out=%s,genome=%s,%s" % (os.path.join(alignment_output, name), indexing_output, reads)
+                sample['files']['align'] = (os.path.join(alignment_output, name), trimmed, [aligned])
+                itype = 'bam'
+
+            sample['aligned'] = aligned
+            sample['trim'] += ',sample=' + name
+            sample['align'] += ',sample=' + name
+            sample['htseq'] = "itype=%s,feature=%s,field=%s,bam=%s,gff=%s,out=%s,sample=%s" % \
+                              (itype, gff_feature, gff_id, aligned, gff_file, os.path.join(htseq_output, name + '.htseq'),
+                               name)
+            sample['files']['htseq'] = (os.path.join(htseq_output, name + '.htseq'), [aligned, gff_file],
+                                        [os.path.join(htseq_output, name + '.htseq')])
+
+            samples.append(sample)
+
+        return samples
+
+    def __add_task(self, tasks, steps, key, command, variables, inputs, outputs, overwrite=False):
+        """
+        Adds a task, unless the step manifest shows it was completed before with the same command and inputs and its
+        outputs are intact
+
+        :param tasks: list of tasks to add the variables to
+        :param steps: StepManifest of the step
+        :param key: unique name of the task in the manifest
+        :param command: command of the step (with placeholders)
+        :param variables: dict with the variables for the command, the marker file is added as done
+        :param inputs: list of input files
+        :param outputs: list of output files
+        :param overwrite: when true the task is added regardless of the manifest (default = False)
+        :return: True if the task was added, False if it can be skipped
+        """
+        command_id = StepManifest.command_id(command, variables)
+
+        if not overwrite and steps.done(key, command_id, inputs, outputs):
+            return False
+
+        variables['done'] = steps.start(key, command_id, inputs, outputs)
+        tasks.append(variables)
+
+        return True
+
+    @staticmethod
+    def __start_step(steps, key, command, variables, inputs, outputs, overwrite=False):
+        """
+        Checks the step manifest for a single job, like __add_task, and registers the job if it needs to run
+
+        :param steps: StepManifest of the step
+        :param key: unique name of the job in the manifest (e.g. the genome)
+        :param command: command of the step (with placeholders)
+        :param variables: variables for the command, as a string name=value,name=value
+        :param inputs: list of input files
+        :param outputs: list of output files
+        :param overwrite: when true the job is registered regardless of the manifest (default = False)
+        :return: variables with the marker file added as done, None if the job can be skipped
+        """
+        command_id = StepManifest.command_id(command, dict(v.split('=', 1) for v in variables.split(',')))
+
+        if not overwrite and steps.done(key, command_id, inputs, outputs):
+            return None
+
+        return variables + ',done=' + steps.start(key, command_id, inputs, outputs)
+
+    @staticmethod
+    def __start_sample_step(steps, sample, step, command, intermediate):
+        """
+        Registers the job of a sample for a step in the step manifest (see __samples and run_samples)
+
+        :param steps: StepManifest of the step
+        :param sample: dict with the files and variables of the sample
+        :param step: trim, align or htseq
+        :param command: command of the step (with placeholders)
+        :param intermediate: list of intermediate files of the sample, these can be removed before the job is recorded
+        :return: variables for the job with the marker file added as done
+        """
+        key, inputs, outputs = sample['files'][step]
+        command_id = StepManifest.command_id(command, dict(v.split('=', 1) for v in sample[step].split(',')))
+
+        return sample[step] + ',done=' + steps.start(key, command_id, inputs, outputs, intermediate=intermediate)
+
+    def __submit_tasks(self, jobname, module, command, filename, tasks, options):
+        """
+        Submits a single array job for a list of tasks (added with __add_task), see
+        PipelineBase.write_task_array_script
+
+        :param jobname: name of the job include %d for the timestamp !
+        :param module: module(s) to load
+        :param command: command to execute, using the variables of the tasks
+        :param filename: filename for the script include %d for the timestamp !
+        :param tasks: list with a dict of variables for each task
+        :param options: list with additional options for the scheduler (e.g. the qsub_* settings)
+        :return: list with a tuple (script, job name, manifest, dict with the sample for each task id) for the
+                 submitted job, empty if there are no tasks
+        """
+        if len(tasks) == 0:
+            return []
+
+        filename, jobname, manifest = self.write_task_array_script(jobname, module, self.mark_done(command), filename,
+                                                                   tasks)
+        submit_array_job(filename, jobname, options)
+
+        return [(filename, jobname, manifest, {str(i + 1): t.get('sample', '') for i, t in enumerate(tasks)})]
+
+    @staticmethod
+    def __wait_for_tasks(submitted, steps):
+        """
+        Waits for array jobs submitted with __submit_tasks, afterwards the scripts and manifests are removed and the
+        OUT_ files are merged into the log. Tasks that succeeded are recorded in the step manifests.
+
+        :param submitted: list with tuples (script, job name, manifest, samples)
+        :param steps: list of StepManifests the tasks were added to
+        """
+        for filename, jobname, manifest, samples in submitted:
+            wait_for_job(jobname, sleep_time=1)
+
+            os.remove(filename)
+            os.remove(manifest)
+
+            PipelineBase.clean_out_files(jobname, samples=samples)
+
+        for step in steps:
+            step.finish()
+
+    @staticmethod
+    def __remove_files(files):
+        """
+        Removes intermediate files (if they exist)
+
+        :param files: list of paths
+        """
+        for f in files:
+            if os.path.exists(f):
+                os.remove(f)
+
+    def run_samples(self, index=True, trim=True, align=True, count=True, overwrite=False, keep_previous=False,
+                    graph=None):
+        """
+        Runs trimming, alignment and htseq-count as a chain of jobs for each sample. Each sample moves on to the next
+        step as soon as its own job is done, instead of waiting for all samples, alignment only waits for the index of
+        its own genome. Jobs completed before with the same settings and inputs are skipped, using the same step
+        manifests as the separate steps. Intermediate files that were removed are made again when the next step needs
+        to run. With graph the jobs are recorded in the manifests the next time they are opened.
+
+        :param index: build the index for each genome (default = True)
+        :param trim: trim the fastq files with trimmomatic (default = True)
+        :param align: align reads with TopHat or HISAT2 (default = True)
+        :param count: count reads per gene with htseq-count (default = True)
+        :param overwrite: when true all jobs are submitted, regardless of the step manifests (default = False)
+        :param keep_previous: when true intermediate files (trimmed reads and alignments) will not be removed once the
+                              next step for a sample is done (default = False)
+        :param graph: JobGraph to add the jobs to, when set the jobs are not run here (default = None)
+        :return: dict with, for each genome, the keys of the last job of each sample
+        """
+        scripts = {}
+        commands = {'trim': {False: self.trimmomatic_se_cmd, True: self.trimmomatic_pe_cmd},
+                    'align': {False: self.hisat2_se_cmd, True: self.hisat2_pe_cmd} if self.use_hisat2 else
+                             {False: self.tophat_se_cmd, True: self.tophat_pe_cmd},
+                    'htseq': {False: self.htseq_count_cmd, True: self.htseq_count_cmd}}
+
+        if index:
+            scripts['index'] = self.write_submission_script("build_index_%d",
+                                                            self.hisat2_module if self.use_hisat2 else self.bowtie_module,
+                                                            self.hisat2_build_cmd if self.use_hisat2 else self.bowtie_build_cmd,
+                                                            "build_index_%d.sh")
+        if trim:
+            scripts['trim_se'] = self.write_submission_script("trimmomatic_%d", None,
+                                                              self.mark_done(self.trimmomatic_se_cmd),
+                                                              "trimmomatic_se_%d.sh")
+            scripts['trim_pe'] = self.write_submission_script("trimmomatic_%d", None,
+                                                              self.mark_done(self.trimmomatic_pe_cmd),
+                                                              "trimmomatic_pe_%d.sh")
+        if align:
+            if self.use_hisat2:
+                scripts['align_se'] = self.write_submission_script("hisat2_%d", self.hisat2_module,
+                                                                   self.mark_done(self.hisat2_se_cmd),
+                                                                   "hisat2_se_%d.sh")
+                scripts['align_pe'] = self.write_submission_script("hisat2_%d", self.hisat2_module,
+                                                                   self.mark_done(self.hisat2_pe_cmd),
+                                                                   "hisat2_pe_%d.sh")
+            else:
+                scripts['align_se'] = self.write_submission_script("tophat_%d",
+                                                                   self.bowtie_module + ' ' + self.tophat_module,
+                                                                   self.mark_done(self.tophat_se_cmd),
+                                                                   "tophat_se_%d.sh")
+                scripts['align_pe'] = self.write_submission_script("tophat_%d",
+                                                                   self.bowtie_module + ' ' + self.tophat_module,
+                                                                   self.mark_done(self.tophat_pe_cmd),
+                                                                   "tophat_pe_%d.sh")
+        if count:
+            scripts['htseq'] = self.write_submission_script("htseq_count_%d",
+                                                            (self.samtools_module + '\t' + self.python_module),
+                                                            self.mark_done(self.htseq_count_cmd),
+                                                            "htseq_count_%d.sh")
+
+        run_graph = graph is None
+        graph = JobGraph(self.scheduler) if graph is None else graph
+        last_jobs = {}
+        manifests = []
+
+        for g in self.genomes:
+            last_jobs[g] = []
+
+            for d in ['trimmomatic_output', 'alignment_output', 'htseq_output']:
+                os.makedirs(self.dp[g][d], exist_ok=True)
+
+            steps = {'trim': self.step_manifest(self.dp[g]['trimmomatic_output']),
+                     'align': self.step_manifest(self.dp[g]['alignment_output']),
+                     'htseq': self.step_manifest(self.dp[g]['htseq_output'])}
+            manifests += steps.values()
+
+            index_key = None
+            if index:
+                output = self.dp[g]['indexing_output']
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                shutil.copy(self.dp[g]['genome_fasta'], output + '.fa')
+
+                filename, jobname = scripts['index']
+                index_key = graph.add(g + '/index', filename, jobname, self.qsub_indexing,
+                                      "in=" + self.dp[g]['genome_fasta'] + ",out=" + output)
+
+            for sample in self.__samples(g):
+                key = g + '/' + sample['name']
+                trim_key, align_key = None, None
+                intermediate = sample['trimmed'] + [sample['aligned']]
+
+                done = {}
+                for step in ['trim', 'align', 'htseq']:
+                    step_key, inputs, outputs = sample['files'][step]
+                    command_id = StepManifest.command_id(commands[step][sample['paired']],
+                                                         dict(v.split('=', 1) for v in sample[step].split(',')))
+                    done[step] = steps[step].done(step_key, command_id, inputs, outputs, intermediate=intermediate)
+
+                # a job runs again when the job before it does, removed intermediate files are made again if needed
+                run = {'trim': trim and (overwrite or not done['trim'])}
+                run['align'] = align and (overwrite or run['trim'] or not done['align'])
+                run['htseq'] = count and (overwrite or run['align'] or not done['htseq'])
+                if run['htseq'] and not os.path.exists(sample['aligned']):
+                    run['align'] = align
+                if run['align'] and not all(os.path.exists(f) for f in sample['trimmed']):
+                    run['trim'] = trim
+
+                if run['trim']:
+                    filename, jobname = scripts['trim_pe' if sample['paired'] else 'trim_se']
+                    trim_key = graph.add(key + '/trim', filename, jobname, self.qsub_trimmomatic,
+                                         self.__start_sample_step(steps['trim'], sample, 'trim',
+                                                                  commands['trim'][sample['paired']], intermediate))
+
+                if run['align']:
+                    filename, jobname = scripts['align_pe' if sample['paired'] else 'align_se']
+                    on_done = None if keep_previous else lambda files=sample['trimmed']: self.__remove_files(files)
+                    align_key = graph.add(key + '/align', filename, jobname, self.qsub_tophat,
+                                          self.__start_sample_step(steps['align'], sample, 'align',
+                                                                   commands['align'][sample['paired']], intermediate),
+                                          after=[index_key, trim_key], on_done=on_done)
+
+                count_key = None
+                if run['htseq'] and (align_key is not None or os.path.exists(sample['aligned'])):
+                    filename, jobname = scripts['htseq']
+                    on_done = None if keep_previous else lambda files=[sample['aligned']]: self.__remove_files(files)
+                    count_key = graph.add(key + '/htseq', filename, jobname, self.qsub_htseq_count,
+                                          self.__start_sample_step(steps['htseq'], sample, 'htseq',
+                                                                   commands['htseq'][sample['paired']], intermediate),
+                                          after=[align_key], on_done=on_done)
+
+                last_job = count_key or align_key or trim_key
+                if last_job is not None:
+                    last_jobs[g].append(last_job)
+
+        if not run_graph:
+            # keep the started jobs, these are recorded when the manifests are opened after the jobs are done
+            for manifest in manifests:
+                manifest.write()
+
+            return last_jobs
+
+        print('Processing samples...')
+
+        graph.run(sleep_time=1)
+
+        for manifest in manifests:
+            manifest.finish()
+
+        for filename, jobname in scripts.values():
+            if os.path.exists(filename):
+                os.remove(filename)
+
+        for jobname in set(jobname for _, jobname in scripts.values()):
+            PipelineBase.clean_out_files(jobname)
+
+        print("Done\n\n")
+
+        return last_jobs
+
     def check_quality(self):
         """
         Function that checks tophat and htseq quality and throws warnings if insufficient reads map. If the log file is
@@ -485,9 +827,17 @@ class TranscriptomePipeline(PipelineBase):
                     print('WARNING: sample with insufficient quality (HTSEQ-Count) detected:', h, file=sys.stderr)
                     print('WARNING: check the log for additional information', file=sys.stderr)
 
-    def htseq_to_matrix(self):
+    def htseq_to_matrix(self, incremental=False, binary=False):
         """
         Groups all htseq files into one expression matrix
+
+        The files used are recorded in a manifest next to the matrix, with the genes in each file. In incremental mode
+        only new or changed files are read and added to the existing matrix, samples that were removed are dropped. The
+        genes of the other files are taken from the manifest, so genes and their order are the same as when the matrix
+        is built from scratch.
+
+        :param incremental: update the existing matrix rather than building it from scratch (default = False)
+        :param binary: also write a binary copy of the matrix, which is faster to read (default = False)
         """
         for g in self.genomes:
             htseq_output = self.dp[g]['htseq_output']
@@ -495,75 +845,129 @@ class TranscriptomePipeline(PipelineBase):
 
             # Check directory for .htseq files and apply quality control, keep valid files
             htseq_files = [f for f in os.listdir(htseq_output) if f.endswith('.htseq')]
-            counts = {}
-
-            for file in htseq_files:
-                full_path = os.path.join(htseq_output, file)
-                with open(full_path, "r") as f:
-                    for row in f:
-                        gene_id, count = re.split('\t+', row.strip())
-
-                        if gene_id not in counts.keys():
-                            counts[gene_id] = {}
-
-                        counts[gene_id][file] = count
 
             output_file = self.dp[g]['exp_matrix_output']
             os.makedirs(os.path.dirname(output_file), exist_ok=True)
-            with open(output_file, "w") as f_out:
 
-                header = '\t'.join(htseq_files)
-                print('gene\t' + header, file=f_out)
+            manifest = SampleManifest(output_file + '.manifest.tsv')
+            gene_lists = {}
+
+            # manifests written before the genes were stored can't be used to update the matrix
+            if incremental and os.path.exists(output_file) and len(manifest.samples) > 0 \
+                    and all(manifest.genes(s) is not None for s in manifest.samples):
+                counts = ExpressionMatrix.read(output_file, dtype=np.int64, prefer_binary=False)
+                updated = [f for f in htseq_files
+                           if f not in counts.sample_index or manifest.changed(f, os.path.join(htseq_output, f))]
+
+                if len(updated) == 0 and counts.samples == htseq_files:
+                    print("Expression matrix for %s is up to date" % g)
+                    manifest.write()
+                    continue
+
+                print("Updating %d samples in expression matrix for %s" % (len(updated), g))
+                new_counts = ExpressionMatrix.from_htseq([os.path.join(htseq_output, f) for f in updated],
+                                                         samples=updated, gene_lists=gene_lists)
+                genes = merge_genes(gene_lists[f] if f in gene_lists else manifest.genes(f) for f in htseq_files)
+                counts = counts.update(new_counts, samples=htseq_files, genes=genes)
+            else:
+                updated = htseq_files
+                counts = ExpressionMatrix.from_htseq([os.path.join(htseq_output, f) for f in htseq_files],
+                                                     samples=htseq_files, gene_lists=gene_lists)
+
+            counts.write(output_file, binary=binary)
 
-                bad_fields = ['no_feature', 'ambiguous', 'too_low_aQual', 'not_aligned', 'alignment_not_unique']
-                for gene_id in counts:
-                    values = []
-                    for f in htseq_files:
-                        if f in counts[gene_id].keys():
-                            values.append(counts[gene_id][f])
-                        else:
-                            values.append('0')
-                    if all([x not in gene_id for x in bad_fields]):
-                        print(gene_id.strip() + '\t' + '\t'.join(values), file=f_out)
+            for f in updated:
+                manifest.add(f, os.path.join(htseq_output, f), genes=gene_lists[f])
+            manifest.keep(htseq_files)
+            manifest.write()
 
             print("Done\n\n")
 
-    def normalize_rpkm(self):
+    def normalize(self, incremental=False, binary=False):
         """
-        Applies rpkm normalization to the htseq-counts expression matrix
+        Applies rpkm and tpm normalization to the htseq-counts expression matrix. The matrix and gene lengths are read
+        once for both, counts per million are written as well when exp_matrix_cpm_output is set in the data file.
+
+        In incremental mode the matrices are only written again if samples were added, changed or removed since the last
+        normalization (according to the manifest written by htseq_to_matrix) or the cds fasta file changed. All samples
+        are normalized then, so the output is the same as without incremental mode.
 
         Note that as this is not a cpu intensive process it is done as part of the main pipeline
-        """
-        for g in self.genomes:
-            data, conditions = read_matrix(self.dp[g]['exp_matrix_output'])
-            normalized_data = normalize_matrix_counts(data, conditions)
-            length_normalized_data = normalize_matrix_length(normalized_data, self.dp[g]['cds_fasta'])
-            os.makedirs(os.path.dirname(self.dp[g]['exp_matrix_rpkm_output']), exist_ok=True)
-            write_matrix(self.dp[g]['exp_matrix_rpkm_output'], conditions, length_normalized_data)
 
-    def normalize_tpm(self):
+        :param incremental: skip genomes for which the normalized matrices are up to date (default = False)
+        :param binary: also write binary copies of the matrices, which are faster to read for pcc.py and the helper
+                       scripts (default = False)
         """
-        Applies tpm normalization to the htseq-counts expression matrix
+        def header(filename):
+            with open(filename, 'r') as f:
+                return f.readline().rstrip('\n').split('\t')[1:]
 
-        Note that as this is not a cpu intensive process it is done as part of the main pipeline
-        """
         for g in self.genomes:
-            data, conditions = read_matrix(self.dp[g]['exp_matrix_output'])
-            length_normalized_data = normalize_matrix_length(data, self.dp[g]['cds_fasta'])
-            normalized_data = normalize_matrix_counts(length_normalized_data, conditions)
-            os.makedirs(os.path.dirname(self.dp[g]['exp_matrix_rpkm_output']), exist_ok=True)
-            write_matrix(self.dp[g]['exp_matrix_tpm_output'], conditions, normalized_data)
+            manifest = SampleManifest(self.dp[g]['exp_matrix_output'] + '.manifest.tsv')
+            lengths_key = length_index_key(self.dp[g]['cds_fasta'])
+
+            outputs = ['exp_matrix_rpkm_output', 'exp_matrix_tpm_output']
+            if 'exp_matrix_cpm_output' in self.dp[g]:
+                outputs.append('exp_matrix_cpm_output')
+
+            if incremental and len(manifest.samples) > 0 and len(manifest.pending()) == 0 \
+                    and manifest.metadata.get('lengths') == lengths_key \
+                    and all(os.path.exists(self.dp[g][o]) and (not binary or has_binary(self.dp[g][o])) and
+                            header(self.dp[g][o]) == header(self.dp[g]['exp_matrix_output']) for o in outputs):
+                print("Normalized expression matrices for %s are up to date" % g)
+                continue
+
+            matrix = ExpressionMatrix.read(self.dp[g]['exp_matrix_output'], prefer_binary=False)
+            lengths = read_gene_lengths(self.dp[g]['cds_fasta'])
+
+            normalizations = {'exp_matrix_rpkm_output': lambda: matrix.rpkm(lengths),
+                              'exp_matrix_tpm_output': lambda: matrix.tpm(lengths),
+                              'exp_matrix_cpm_output': lambda: matrix.cpm()}
+
+            for key in outputs:
+                os.makedirs(os.path.dirname(self.dp[g][key]), exist_ok=True)
+                normalizations[key]().write(self.dp[g][key], binary=binary)
 
-    def run_pcc(self, matrix_type='tpm'):
+            if len(manifest.samples) > 0:
+                manifest.metadata['lengths'] = lengths_key
+                manifest.set_processed()
+                manifest.write()
+
+    def run_pcc(self, matrix_type='tpm', shards=1, method=None, graph=None, after=None, overwrite=False):
         """
         Calculates pcc values on the cluster using the pcc.py script included in RSTrAP.
 
         :param matrix_type: tpm or rpkm, select the desired matrix
+        :param shards: number of parts the genes are split into, each part is submitted as a task in an array job after
+                       which the partial results are merged (default = 1, single job per genome)
+        :param method: pearson, spearman or log-pearson, overrides pcc_method in the data file for all genomes
+                       (default = None, use pcc_method or pearson if not set)
+        :param graph: JobGraph to add the jobs to, when set the jobs are not run here (default = None)
+        :param after: dict with, for each genome, the key of the job in graph that needs to finish first
+        :param overwrite: when true PCC values are always calculated, otherwise genomes for which they were calculated
+                          before with the same settings and matrix are skipped (see StepManifest, not used with graph)
+        :return: dict with, for each genome, the key of the last job in graph (None without graph)
         """
-        filename, jobname = self.write_submission_script("pcc_wrapper_%d",
-                                                         self.python3_module,
-                                                         self.pcc_cmd,
-                                                         "pcc_wrapper_%d.sh")
+        keys = {}
+        steps, markers = [], {}
+        submitted = False
+
+        if shards > 1:
+            if self.pcc_shard_cmd is None or self.pcc_merge_cmd is None:
+                print('pcc_shard_cmd and pcc_merge_cmd are required in the config file to run PCC in shards, quiting...')
+                quit()
+
+            filename, jobname = self.write_batch_submission_script("pcc_shard_%d",
+                                                                   self.python3_module,
+                                                                   self.pcc_shard_cmd,
+                                                                   "pcc_shard_%d.sh",
+                                                                   jobcount=shards)
+        else:
+            filename, jobname = self.write_submission_script("pcc_wrapper_%d",
+                                                             self.python3_module,
+                                                             self.pcc_cmd if graph is not None else
+                                                             self.mark_done(self.pcc_cmd),
+                                                             "pcc_wrapper_%d.sh")
 
         for g in self.genomes:
             pcc_out = self.dp[g]['pcc_output']
@@ -580,8 +984,52 @@ class TranscriptomePipeline(PipelineBase):
                 print('Matrix type %s unknown, quiting...' % matrix_type)
                 quit()
 
-            command = ["qsub"] + self.qsub_pcc + ["-v", "in=%s,out=%s,mcl_out=%s" % (htseq_matrix, pcc_out, mcl_out), filename]
-            subprocess.call(command)
+            top_k = int(self.dp[g]['pcc_top_k']) if 'pcc_top_k' in self.dp[g] else 1000
+            cutoff = float(self.dp[g]['pcc_cutoff']) if 'pcc_cutoff' in self.dp[g] else 0.7
+            sparse = self.dp[g].getboolean('pcc_sparse') if 'pcc_sparse' in self.dp[g] else False
+
+            if method is not None:
+                pcc_method = method
+            else:
+                pcc_method = self.dp[g]['pcc_method'] if 'pcc_method' in self.dp[g] else 'pearson'
+
+            if pcc_method not in ['pearson', 'spearman', 'log-pearson']:
+                print('Correlation method %s unknown, quiting...' % pcc_method)
+                quit()
+
+            variables = "in=%s,out=%s,mcl_out=%s,store=%s,shards=%d,top_k=%d,cutoff=%s,method=%s,sparse=%s" % (htseq_matrix, pcc_out, mcl_out, self.__pcc_store(g), shards, top_k, cutoff, pcc_method, '--sparse' if sparse else '')
+
+            if graph is None:
+                command = self.pcc_cmd if shards == 1 else self.pcc_shard_cmd + '\n' + self.pcc_merge_cmd
+                outputs = [pcc_out, mcl_out] + ([self.__pcc_store(g)] if '${store}' in command else [])
+
+                steps.append(self.step_manifest(pcc_out))
+                marked = self.__start_step(steps[-1], g, command, variables, [htseq_matrix], outputs, overwrite)
+
+                if marked is None:
+                    print('PCC values for %s are up to date, skipping' % g)
+                    continue
+
+                if shards > 1:
+                    # the merge job signals the step is done
+                    markers[g] = marked
+                else:
+                    variables = marked
+
+                submit_job(filename, jobname, self.qsub_pcc, variables)
+                submitted = True
+            else:
+                keys[g] = graph.add(g + '/pcc', filename, jobname, self.qsub_pcc, variables,
+                                    after=[after.get(g)] if after is not None else None)
+
+        if graph is not None:
+            return self.__merge_pcc_shards(matrix_type, shards, graph=graph, after=keys) if shards > 1 else keys
+
+        if not submitted:
+            # all genomes are up to date, there are no jobs to wait for
+            os.remove(filename)
+            print("Done\n\n")
+            return
 
         # wait for all jobs to complete
         wait_for_job(jobname, sleep_time=1)
@@ -592,23 +1040,224 @@ class TranscriptomePipeline(PipelineBase):
         # remove OUT_ files
         PipelineBase.clean_out_files(jobname)
 
+        if shards > 1:
+            self.__merge_pcc_shards(matrix_type, shards, markers=markers)
+
+        for step in steps:
+            step.finish()
+
         print("Done\n\n")
 
-    def cluster_pcc(self):
+    def __pcc_store(self, genome):
+        """
+        Returns the path for the binary co-expression store of a genome, if not set in the data file the store is
+        written next to the PCC output. Note that pcc.py only writes the store when --store ${store} is included in the
+        command.
+
+        :param genome: genome to get the path for
+        :return: path to the store
+        """
+        if 'pcc_store_output' in self.dp[genome]:
+            return self.dp[genome]['pcc_store_output']
+        else:
+            return os.path.splitext(self.dp[genome]['pcc_output'])[0] + '.store'
+
+    def __merge_pcc_shards(self, matrix_type, shards, graph=None, after=None, markers=None):
+        """
+        Submits jobs that concatenate the partial output of the PCC shards, in gene order, to the final output files
+
+        :param matrix_type: tpm or rpkm, the matrix the PCC values were calculated on
+        :param shards: number of shards to merge
+        :param graph: JobGraph to add the jobs to, when set the jobs are not run here (default = None)
+        :param after: dict with, for each genome, the key of the job in graph that needs to finish first
+        :param markers: dict with, for each genome to merge, the marker file to create when done (see StepManifest),
+                        only used without graph
+        :return: dict with, for each genome, the key of the job in graph (None without graph)
+        """
+        keys = {}
+        submitted = False
+
+        filename, jobname = self.write_submission_script("pcc_merge_%d",
+                                                         self.python3_module,
+                                                         self.pcc_merge_cmd if markers is None else
+                                                         self.mark_done(self.pcc_merge_cmd),
+                                                         "pcc_merge_%d.sh")
+
+        for g in self.genomes:
+            htseq_matrix = self.dp[g]['exp_matrix_%s_output' % matrix_type]
+            variables = "in=%s,out=%s,mcl_out=%s,store=%s,shards=%d" % (htseq_matrix, self.dp[g]['pcc_output'], self.dp[g]['pcc_mcl_output'], self.__pcc_store(g), shards)
+
+            if graph is None:
+                if markers is not None:
+                    if g not in markers:
+                        continue
+                    variables += ",done=" + markers[g]
+
+                submit_job(filename, jobname, self.qsub_pcc, variables)
+                submitted = True
+            else:
+                keys[g] = graph.add(g + '/pcc_merge', filename, jobname, self.qsub_pcc, variables,
+                                    after=[after.get(g)] if after is not None else None)
+
+        if graph is not None:
+            return keys
+
+        if not submitted:
+            os.remove(filename)
+            return
+
+        # wait for all jobs to complete
+        wait_for_job(jobname, sleep_time=1)
+
+        # remove the submission script
+        os.remove(filename)
+
+        # remove OUT_ files
+        PipelineBase.clean_out_files(jobname)
+
+    def build_rank_network(self, shards=1, graph=None, after=None):
+        """
+        Builds a mutual rank (MR) or highest reciprocal rank (HRR) network for each genome from the binary store with
+        the top co-expressed genes (see run_pcc), using the rank_network.py script included in LSTrAP.
+
+        :param shards: number of shards the PCC values were calculated in, used to check the store is written by the
+                       PCC jobs in graph (default = 1)
+        :param graph: JobGraph to add the jobs to, when set the jobs are not run here (default = None)
+        :param after: dict with, for each genome, the key of the job in graph that needs to finish first
+        :return: dict with, for each genome, the key of the job in graph (None without graph)
+        """
+        keys = {}
+        submitted = False
+
+        if self.rank_network_cmd is None:
+            print('rank_network_cmd is required in the config file to build rank based networks, quiting...')
+            quit()
+
+        filename, jobname = self.write_submission_script("rank_network_%d",
+                                                         self.python3_module,
+                                                         self.rank_network_cmd,
+                                                         "rank_network_%d.sh")
+
+        for g in self.genomes:
+            store = self.__pcc_store(g)
+            rank_out = self.__rank_network_output(g)
+
+            if graph is not None and after is not None and after.get(g) is not None:
+                # the store is written by a job in graph that didn't run yet, check the command writes it
+                pcc_cmd = self.pcc_cmd if shards == 1 else self.pcc_merge_cmd
+                if '${store}' not in pcc_cmd:
+                    print('Rank based networks require --store ${store} in %s, quiting...' %
+                          ('pcc_cmd' if shards == 1 else 'pcc_shard_cmd and pcc_merge_cmd'), file=sys.stderr)
+                    quit()
+            elif not os.path.exists(store):
+                print('Binary store %s for %s not found, add --store ${store} to pcc_cmd and run PCC again, quiting...'
+                      % (store, g), file=sys.stderr)
+                quit()
+
+            method = self.dp[g]['rank_network_method'] if 'rank_network_method' in self.dp[g] else 'mr'
+            max_rank = float(self.dp[g]['rank_network_max_rank']) if 'rank_network_max_rank' in self.dp[g] else 30
+
+            if method not in ['mr', 'hrr']:
+                print('Rank network method %s unknown, quiting...' % method)
+                quit()
+
+            os.makedirs(os.path.dirname(rank_out), exist_ok=True)
+
+            variables = "store=%s,out=%s,method=%s,max_rank=%s" % (store, rank_out, method, max_rank)
+
+            if graph is None:
+                submit_job(filename, jobname, self.qsub_pcc, variables)
+                submitted = True
+            else:
+                keys[g] = graph.add(g + '/rank_network', filename, jobname, self.qsub_pcc, variables,
+                                    after=[after.get(g)] if after is not None else None)
+
+        if graph is not None:
+            return keys
+
+        if not submitted:
+            os.remove(filename)
+            print("Done\n\n")
+            return
+
+        # wait for all jobs to complete
+        wait_for_job(jobname, sleep_time=1)
+
+        # remove the submission script
+        os.remove(filename)
+
+        # remove OUT_ files
+        PipelineBase.clean_out_files(jobname)
+
+        print("Done\n\n")
+
+    def __rank_network_output(self, genome):
+        """
+        Returns the path for the rank based network of a genome, if not set in the data file it is written next to the
+        mcl output of the PCC values.
+
+        :param genome: genome to get the path for
+        :return: path to the network
+        """
+        if 'rank_network_output' in self.dp[genome]:
+            return self.dp[genome]['rank_network_output']
+        else:
+            return os.path.splitext(self.dp[genome]['pcc_mcl_output'])[0] + '.rank.txt'
+
+    def cluster_pcc(self, rank_network=False, graph=None, after=None, overwrite=False):
         """
         Creates co-expression clusters using mcl.
+
+        :param rank_network: cluster the rank based network (see build_rank_network) instead of the PCC values
+                             (default = False)
+        :param graph: JobGraph to add the jobs to, when set the jobs are not run here (default = None)
+        :param after: dict with, for each genome, the key of the job in graph that needs to finish first
+        :param overwrite: when true clustering is always done, otherwise genomes clustered before with the same settings
+                          and input are skipped (see StepManifest, not used with graph)
+        :return: dict with, for each genome, the key of the job in graph (None without graph)
         """
+        keys = {}
+        steps = []
+        submitted = False
+
         filename, jobname = self.write_submission_script("cluster_pcc_%d",
                                                          self.mcl_module,
-                                                         self.mcl_cmd,
+                                                         self.mcl_cmd if graph is not None else
+                                                         self.mark_done(self.mcl_cmd),
                                                          "cluster_pcc_%d.sh")
 
         for g in self.genomes:
-            mcl_out = self.dp[g]['pcc_mcl_output']          # This is the PCC table in mcl format
+            if rank_network:
+                mcl_out = self.__rank_network_output(g)     # MR or HRR network in mcl format
+            else:
+                mcl_out = self.dp[g]['pcc_mcl_output']      # This is the PCC table in mcl format
             mcl_clusters = self.dp[g]['mcl_cluster_output'] # Desired path for the clusters
 
-            command = ["qsub"] + self.qsub_mcl + ["-v", "in=%s,out=%s" % (mcl_out, mcl_clusters), filename]
-            subprocess.call(command)
+            variables = "in=%s,out=%s" % (mcl_out, mcl_clusters)
+
+            if graph is None:
+                steps.append(self.step_manifest(mcl_clusters))
+                variables = self.__start_step(steps[-1], g, self.mcl_cmd, variables, [mcl_out], [mcl_clusters],
+                                              overwrite)
+
+                if variables is None:
+                    print('Clusters for %s are up to date, skipping' % g)
+                    continue
+
+                submit_job(filename, jobname, self.qsub_mcl, variables)
+                submitted = True
+            else:
+                keys[g] = graph.add(g + '/cluster_pcc', filename, jobname, self.qsub_mcl, variables,
+                                    after=[after.get(g)] if after is not None else None)
+
+        if graph is not None:
+            return keys
+
+        if not submitted:
+            # all genomes are up to date, there are no jobs to wait for
+            os.remove(filename)
+            print("Done\n\n")
+            return
 
         # wait for all jobs to complete
         wait_for_job(jobname, sleep_time=1)
@@ -619,6 +1268,7 @@ class TranscriptomePipeline(PipelineBase):
         # remove OUT_ files
         PipelineBase.clean_out_files(jobname)
 
-        print("Done\n\n")
-
+        for step in steps:
+            step.finish()
 
+        print("Done\n\n")
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import argparse
+import os
 import sys
 
+from cluster.graph import JobGraph
+from cluster.report import write_summary
 from pipeline.check.sanity import check_sanity_config, check_sanity_data
 from pipeline.interpro import InterProPipeline
 from pipeline.transcriptome import TranscriptomePipeline
@@ -10,36 +13,49 @@ from pipeline.orthology import OrthologyPipeline
 
 def run_pipeline(args):
     """
-    Runs pipeline based on settings in args.
+    Runs pipeline based on settings in args. The timing and resource use of all jobs is written to lstrap.report.tsv,
+    with a summary per step and per sample in lstrap.report.json.
 
     :param args: Parsed arguments from argparse
     """
     if check_sanity_config(args.config) and check_sanity_data(args.data):
+        scheduler = 'LOCAL' if args.local else None
+
+        # start a new report for this run, unless this run is part of a larger one (see submit_pipeline)
+        if os.path.exists('lstrap.report.tsv') and not args.append_report:
+            os.remove('lstrap.report.tsv')
+
         if args.transcriptomics:
             tp = TranscriptomePipeline(args.config,
                                        args.data,
                                        enable_log=args.enable_log,
-                                       use_hisat2=args.use_hisat2)
+                                       use_hisat2=args.use_hisat2,
+                                       scheduler=scheduler,
+                                       hash_inputs=args.hash_inputs)
 
-            if args.indexing:
-                tp.prepare_genome()
+            if args.per_sample:
+                tp.run_samples(index=args.indexing, trim=args.trim_fastq, align=args.alignment, count=args.htseq,
+                               overwrite=args.rerun, keep_previous=args.keep_intermediate)
             else:
-                print("Skipping Indexing", file=sys.stderr)
+                if args.indexing:
+                    tp.prepare_genome()
+                else:
+                    print("Skipping Indexing", file=sys.stderr)
 
-            if args.trim_fastq:
-                tp.trim_fastq()
-            else:
-                print("Skipping Trimmomatic", file=sys.stderr)
+                if args.trim_fastq:
+                    tp.trim_fastq(overwrite=args.rerun)
+                else:
+                    print("Skipping Trimmomatic", file=sys.stderr)
 
-            if args.alignment:
-                    tp.run_alignment(keep_previous=args.keep_intermediate)
-            else:
-                print("Skipping Alignment", file=sys.stderr)
+                if args.alignment:
+                        tp.run_alignment(overwrite=args.rerun, keep_previous=args.keep_intermediate)
+                else:
+                    print("Skipping Alignment", file=sys.stderr)
 
-            if args.htseq:
-                tp.run_htseq_count(keep_previous=args.keep_intermediate)
-            else:
-                print("Skipping htseq-counts", file=sys.stderr)
+                if args.htseq:
+                    tp.run_htseq_count(keep_previous=args.keep_intermediate, overwrite=args.rerun)
+                else:
+                    print("Skipping htseq-counts", file=sys.stderr)
 
             if args.qc:
                 tp.check_quality()
@@ -47,19 +63,23 @@ def run_pipeline(args):
                 print("Skipping quality control", file=sys.stderr)
 
             if args.exp_matrix:
-                tp.htseq_to_matrix()
-                tp.normalize_rpkm()
-                tp.normalize_tpm()
+                tp.htseq_to_matrix(incremental=args.incremental_matrix, binary=args.binary_matrix)
+                tp.normalize(incremental=args.incremental_matrix, binary=args.binary_matrix)
             else:
                 print("Skipping expression matrix", file=sys.stderr)
 
             if args.pcc:
-                tp.run_pcc()
+                tp.run_pcc(shards=args.pcc_shards, method=args.pcc_method, overwrite=args.rerun)
             else:
                 print("Skipping PCC calculations", file=sys.stderr)
 
+            if args.rank_network:
+                tp.build_rank_network(shards=args.pcc_shards)
+            else:
+                print("Skipping rank based network", file=sys.stderr)
+
             if args.mcl:
-                tp.cluster_pcc()
+                tp.cluster_pcc(rank_network=args.rank_network, overwrite=args.rerun)
             else:
                 print("Skipping MCL clustering of PCC values", file=sys.stderr)
         else:
@@ -67,14 +87,14 @@ def run_pipeline(args):
 
         # Run InterPro Section
         if args.interpro:
-            ip = InterProPipeline(args.config, args.data)
+            ip = InterProPipeline(args.config, args.data, scheduler=scheduler)
             ip.run_interproscan()
         else:
             print("Skipping Interpro", file=sys.stderr)
 
         # Run Orthology Section
         if args.orthology:
-            op = OrthologyPipeline(args.config, args.data)
+            op = OrthologyPipeline(args.config, args.data, scheduler=scheduler)
             if args.orthofinder:
                 op.run_orthofinder()
 
@@ -83,6 +103,94 @@ def run_pipeline(args):
         else:
             print("Skipping Orthology", file=sys.stderr)
 
+        if os.path.exists('lstrap.report.tsv'):
+            write_summary('lstrap.report.tsv', 'lstrap.report.json')
+            print("Timing and resource use of all jobs written to lstrap.report.tsv and lstrap.report.json")
+
+    else:
+        print("Sanity check failed, cannot start pipeline", file=sys.stderr)
+
+
+def submit_pipeline(args):
+    """
+    Submits all steps at once, the order is handled by the scheduler using job dependencies so run.py doesn't need to
+    wait for the jobs. Quality control and building the expression matrices, which are done by LSTrAP itself, are
+    submitted as a job that runs run.py with only those steps enabled. Intermediate files are kept and OUT_ files are
+    not merged in this mode.
+
+    :param args: Parsed arguments from argparse
+    """
+    if check_sanity_config(args.config) and check_sanity_data(args.data):
+        scheduler = 'LOCAL' if args.local else None
+        graph = None
+
+        # start a new report for this run, the job building the expression matrices adds to it
+        if os.path.exists('lstrap.report.tsv'):
+            os.remove('lstrap.report.tsv')
+
+        if args.transcriptomics:
+            tp = TranscriptomePipeline(args.config,
+                                       args.data,
+                                       enable_log=args.enable_log,
+                                       use_hisat2=args.use_hisat2,
+                                       scheduler=scheduler,
+                                       hash_inputs=args.hash_inputs)
+            graph = JobGraph(tp.scheduler)
+
+            samples = tp.run_samples(index=args.indexing, trim=args.trim_fastq, align=args.alignment, count=args.htseq,
+                                     overwrite=args.rerun, keep_previous=True, graph=graph)
+
+            matrix = None
+            if args.qc or args.exp_matrix:
+                command = ['python3', os.path.abspath(__file__), '--local', '--append-report', '--skip-indexing',
+                           '--skip-trim-fastq', '--skip-alignment', '--skip-htseq', '--skip-pcc', '--skip-mcl']
+                command += [] if args.qc else ['--skip-qc']
+                command += [] if args.exp_matrix else ['--skip-exp-matrix']
+                command += ['--incremental-matrix'] if args.incremental_matrix else []
+                command += ['--binary-matrix'] if args.binary_matrix else []
+                command += ['--use-hisat2'] if args.use_hisat2 else []
+                command += [] if args.enable_log else ['--disable-log']
+
+                filename, jobname = tp.write_submission_script("exp_matrix_%d", tp.python3_module,
+                                                               ' '.join(command + [args.config, args.data]),
+                                                               "exp_matrix_%d.sh")
+                matrix = graph.add('exp_matrix', filename, jobname,
+                                   after=[k for keys in samples.values() for k in keys])
+
+            pcc = {}
+            if args.pcc:
+                pcc = tp.run_pcc(shards=args.pcc_shards, method=args.pcc_method, graph=graph,
+                                 after={g: matrix for g in tp.genomes})
+
+            if args.rank_network:
+                pcc = tp.build_rank_network(shards=args.pcc_shards, graph=graph, after=pcc)
+
+            if args.mcl:
+                tp.cluster_pcc(rank_network=args.rank_network, graph=graph, after=pcc)
+
+        if args.interpro:
+            ip = InterProPipeline(args.config, args.data, scheduler=scheduler)
+            graph = JobGraph(ip.scheduler) if graph is None else graph
+            ip.run_interproscan(graph=graph)
+
+        if graph is not None:
+            job_ids = graph.submit_all()
+
+            with open('lstrap.jobs.txt', 'w') as f:
+                for key, job_id in job_ids.items():
+                    print(key, job_id, sep='\t', file=f)
+
+            print("%d jobs submitted, job ids are listed in lstrap.jobs.txt" % len(job_ids))
+
+        # OrthoFinder's output needs to be processed before MCL can be started, this can't be submitted at once
+        if args.orthology:
+            print("Running Orthology (this can't be submitted at once)", file=sys.stderr)
+            op = OrthologyPipeline(args.config, args.data, scheduler=scheduler)
+            if args.orthofinder:
+                op.run_orthofinder()
+
+            if args.mcl_families:
+                op.run_mcl()
     else:
         print("Sanity check failed, cannot start pipeline", file=sys.stderr)
 
@@ -98,21 +206,34 @@ if __name__ == "__main__":
     parser.add_argument('--enable-interpro', dest='interpro', action='store_true', help='Runs InterProScan to detect protein domains and provide functional annotation')
     parser.add_argument('--enable-orthology', dest='orthology', action='store_true', help='Runs OrhtoFinder and MCL to detect orthogroups, gene families and orthologs')
 
+    parser.add_argument('--local', dest='local', action='store_true', help='add --local to run all jobs on this machine instead of submitting them to a cluster (the number of cores can be set with local_cores in config.ini)')
+
     parser.add_argument('--use-hisat2', dest='use_hisat2', action='store_true', help='Use HISAT2 to build the index and align reads instead of BowTie2 and TopHat2')
 
+    parser.add_argument('--submit-all', dest='submit_all', action='store_true', help='add --submit-all to submit all steps at once, using job dependencies, so run.py doesn\'t need to wait until the jobs are done (OrthoFinder is still run step by step)')
+    parser.add_argument('--per-sample', dest='per_sample', action='store_true', help='add --per-sample to run indexing, trimming, alignment and htseq-count as a chain of jobs for each sample, so samples don\'t wait for each other between these steps')
     parser.add_argument('--skip-indexing', dest='indexing', action='store_false', help='add --skip-indexing to skip building an index (for read alignment) on the genome (BowTie2 or HISAT2)')
     parser.add_argument('--skip-trim-fastq', dest='trim_fastq', action='store_false', help='add --skip-trim-fastq to skip trimming fastq files using trimmomatic')
     parser.add_argument('--skip-alignment', dest='alignment', action='store_false', help='add --skip-alignment to skip the read alignment step (TopHat 2 or HISAT2)')
     parser.add_argument('--skip-htseq', dest='htseq', action='store_false', help='add --skip-htseq to skip counting reads per gene with htseq-count')
     parser.add_argument('--skip-qc', dest='qc', action='store_false', help='add --skip-qc to skip quality control of tophat and htseq output')
     parser.add_argument('--skip-exp-matrix', dest='exp_matrix', action='store_false', help='add --skip-exp-matrix to skip converting htseq files to an expression matrix')
+    parser.add_argument('--incremental-matrix', dest='incremental_matrix', action='store_true', help='add --incremental-matrix to only add new or changed htseq files to existing expression matrices')
+    parser.add_argument('--binary-matrix', dest='binary_matrix', action='store_true', help='add --binary-matrix to write a binary copy (float32) of each expression matrix, which is read much faster by the helper scripts and by pcc.py (with --binary in pcc_cmd)')
     parser.add_argument('--skip-pcc', dest='pcc', action='store_false', help='add --skip-pcc to skip calculating PCC values')
+    parser.add_argument('--pcc-shards', dest='pcc_shards', type=int, default=1, help='split the PCC calculation for each genome into this number of tasks of an array job (default = 1)')
+    parser.add_argument('--pcc-method', dest='pcc_method', choices=['pearson', 'spearman', 'log-pearson'], default=None, help='correlation used for co-expression for all genomes, overrides pcc_method in data.ini (default: pcc_method or pearson)')
+    parser.add_argument('--rank-network', dest='rank_network', action='store_true', help='add --rank-network to build a mutual rank or highest reciprocal rank network from the PCC values and cluster that with MCL')
     parser.add_argument('--skip-mcl', dest='mcl', action='store_false', help='add --skip-mcl to skip clustering PCC values using MCL')
 
     parser.add_argument('--skip-orthofinder', dest='orthofinder', action='store_false', help='add --skip-orthofinder to skip the orthology detection')
     parser.add_argument('--skip-mcl-families', dest='mcl_families', action='store_false', help='add --skip-mcl to skip clustering blast with MCL')
 
+    parser.add_argument('--rerun', dest='rerun', action='store_true', help='add --rerun to run all steps again, by default work that was completed before with the same settings and inputs is skipped (tracked in *.steps.tsv files next to the output)')
+    parser.add_argument('--hash-inputs', dest='hash_inputs', action='store_true', help='add --hash-inputs to also store checksums of input files, so inputs that were touched but are unchanged don\'t trigger a rerun')
+
     parser.add_argument('--remove-intermediate', dest='keep_intermediate', action='store_false', help='add --remove-intermediate to clear trimmomatic and tophat files after completing those steps')
+    parser.add_argument('--append-report', dest='append_report', action='store_true', help='add --append-report to add the jobs to the existing lstrap.report.tsv instead of starting a new report (used by the job --submit-all submits to build the expression matrices)')
     parser.add_argument('--disable-log', dest='enable_log', action='store_false',
                         help='add --disable-log to disable writing additional statistics.')
 
@@ -121,7 +242,12 @@ if __name__ == "__main__":
     parser.set_defaults(interpro=False)
     parser.set_defaults(orthology=False)
 
+    parser.set_defaults(local=False)
+    parser.set_defaults(rerun=False)
+    parser.set_defaults(hash_inputs=False)
     parser.set_defaults(use_hisat2=False)
+    parser.set_defaults(per_sample=False)
+    parser.set_defaults(submit_all=False)
 
     # Flags for individual tools for transcriptomics
     parser.set_defaults(indexing=True)
@@ -130,16 +256,23 @@ if __name__ == "__main__":
     parser.set_defaults(htseq=True)
     parser.set_defaults(qc=True)
     parser.set_defaults(exp_matrix=True)
+    parser.set_defaults(incremental_matrix=False)
+    parser.set_defaults(binary_matrix=False)
     parser.set_defaults(pcc=True)
+    parser.set_defaults(rank_network=False)
     parser.set_defaults(mcl=True)
 
     parser.set_defaults(orthofinder=True)
     parser.set_defaults(mcl_families=True)
 
     parser.set_defaults(keep_intermediate=True)
+    parser.set_defaults(append_report=False)
     parser.set_defaults(enable_log=True)
 
     # Parse arguments and start pipeline
     args = parser.parse_args()
 
-    run_pipeline(args)
+    if args.submit_all:
+        submit_pipeline(args)
+    else:
+        run_pipeline(args)
@@ -2,80 +2,728 @@
 import argparse
 
 import numpy as np
+import os
+import shutil
 import sys
 
+from contextlib import contextmanager
+from multiprocessing import Pool, shared_memory
 
-def pcc(filename, output, mcl_output):
+# the binary matrix reader is shared with the rest of LSTrAP, one level up from this script
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.matrix import read_binary_matrix, has_binary, binary_path
+
+
+def rank_rows(values):
     """
-    Reads an htseq-count matrix, calculated the PCC (Pearson Correlation) for all pairs. It will return a text file with
-    for each sequence the top 1000 strongest correlated genes and a mcl but also genemania/cytoscape compatible file
-    containing all gene pairs with a correlation of 0.7 or better.
+    Replaces the values in each row of a matrix by their rank within that row (starting at 1), tied values get the
+    average of their ranks. All rows are ranked at once.
+
+    :param values: 2d numpy array
+    :return: 2d numpy array (float64) with the ranks
+    """
+    rows, columns = values.shape
+    positions = np.broadcast_to(np.arange(columns), (rows, columns))
+
+    order = np.argsort(values, axis=1, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+
+    # mark where a run of tied values starts and ends in the sorted rows
+    first = np.ones((rows, columns), dtype=bool)
+    first[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    last = np.ones((rows, columns), dtype=bool)
+    last[:, :-1] = first[:, 1:]
+
+    run_start = np.maximum.accumulate(np.where(first, positions, 0), axis=1)
+    run_end = np.minimum.accumulate(np.where(last, positions, columns)[:, ::-1], axis=1)[:, ::-1]
+
+    ranks = np.empty((rows, columns), dtype=np.float64)
+    np.put_along_axis(ranks, order, (run_start + run_end) / 2 + 1, axis=1)
+
+    return ranks
+
+
+def transform(values, method='pearson'):
+    """
+    Prepares expression values for the selected correlation method, the PCC of the transformed values is the requested
+    correlation.
+
+    :param values: 2d numpy array with a profile on each row
+    :param method: pearson (no transformation), spearman (ranks) or log-pearson (log2(value + 1))
+    :return: 2d numpy array with transformed profiles
+    """
+    if method == 'spearman':
+        return rank_rows(values)
+    elif method == 'log-pearson':
+        return np.log2(values + 1)
+
+    return values
+
+
+def center_profiles(genes, rows, method='pearson'):
+    """
+    Transforms and centers a number of profiles at once
+
+    :param genes: list of gene names
+    :param rows: list with the values (list of floats) for each gene
+    :param method: correlation method, see transform (default = pearson)
+    :return: yields tuples with the gene, the centered profile (nominator) and its norm (denominator)
+    """
+    if len(genes) == 0:
+        return
+
+    values = transform(np.array(rows, dtype=np.float64), method=method)
+
+    # cumsum adds up values left to right, exactly like the sum() used previously, this keeps the output identical to
+    # the last digit
+    nominators = values - (values.cumsum(axis=1)[:, -1:] / values.shape[1])
+    denominators = np.sqrt((nominators**2).cumsum(axis=1)[:, -1])
+
+    for gene, nomi, denomi in zip(genes, nominators, denominators):
+        if denomi != 0.0:
+            yield gene, nomi, denomi
+
+
+def read_profiles(filename, method='pearson', chunk_size=1000, prefer_binary=False):
+    """
+    Generator that reads an expression matrix, transforms and centers each profile. Genes without any variation in
+    expression (a denominator of zero) are skipped as no PCC can be calculated for them.
 
     :param filename: path to input, a htseq-count matrix file
-    :param output: Matrix output, for each gene it prints the 1000 most strongly co-expressed genes
-    :param mcl_output: Mcl compatible output
+    :param method: correlation method, see transform (default = pearson)
+    :param chunk_size: number of profiles transformed at once (default = 1000)
+    :param prefer_binary: read the binary copy of the matrix (see utils.matrix.has_binary) if available, values in this
+                          file are stored as float32 (default = False)
+    :return: yields tuples with the gene, the centered profile (nominator) and its norm (denominator)
     """
-    # Read Matrix and store nominators and denominators
-    with open(filename, 'r') as fin:
-        nominators, denominators, genes = [], [], []
+    if prefer_binary and has_binary(filename):
+        print("Reading binary matrix %s" % binary_path(filename), file=sys.stderr)
+        genes, _, values = read_binary_matrix(binary_path(filename))
 
+        for start in range(0, len(genes), chunk_size):
+            yield from center_profiles(genes[start:start + chunk_size], values[start:start + chunk_size], method=method)
+
+        return
+
+    with open(filename, 'r') as fin:
         header = fin.readline()
         size = len(header.strip().split('\t'))
 
+        genes, rows = [], []
+
         for line in fin:
-                parts = line.rstrip().split("\t")
+            parts = line.rstrip().split("\t")
+
+            if size != len(parts):
+                print("Warning! Unequal number of columns found in line:\n%s.\nExpression matrix corrupt. Aborting!\n" % line, file=sys.stderr)
+                quit()
+
+            try:
+                rows.append([float(p) for p in parts[1:]])
+                genes.append(parts[0])
+            except ValueError:
+                print("Warning! Non-number character found in line:\n%s.\nExpression matrix corrupt. Aborting!\n" % line, file=sys.stderr)
+                quit()
+
+            if len(rows) == chunk_size:
+                yield from center_profiles(genes, rows, method=method)
+                genes, rows = [], []
+
+        yield from center_profiles(genes, rows, method=method)
+
+
+def read_matrix(filename, dtype=np.float64, method='pearson', prefer_binary=False):
+    """
+    Reads an expression matrix into memory, see read_profiles
+
+    :param filename: path to input, a htseq-count matrix file
+    :param dtype: precision to store the profiles with (default = float64)
+    :param method: correlation method, see transform (default = pearson)
+    :param prefer_binary: read the binary copy of the matrix if available (default = False)
+    :return: tuple with the list of genes, the centered profiles (nominators) and their norms (denominators)
+    """
+    genes, nominators, denominators = [], [], []
+
+    for gene, nomi, denomi in read_profiles(filename, method=method, prefer_binary=prefer_binary):
+        genes.append(gene)
+        nominators.append(nomi.astype(dtype))
+        denominators.append(denomi)
+
+    nominators = np.array(nominators, dtype=dtype).reshape(len(genes), -1 if len(genes) > 0 else 0)
+
+    return genes, nominators, np.array(denominators, dtype=dtype)
+
+
+def read_matrix_to_disk(filename, path, dtype=np.float64, method='pearson', prefer_binary=False):
+    """
+    Reads an expression matrix, see read_profiles, and writes the centered profiles to a file which is memory-mapped.
+    This way only the gene names and denominators are kept in memory.
+
+    :param filename: path to input, a htseq-count matrix file
+    :param path: file to write the centered profiles to
+    :param dtype: precision to store the profiles with (default = float64)
+    :param method: correlation method, see transform (default = pearson)
+    :param prefer_binary: read the binary copy of the matrix if available (default = False)
+    :return: tuple with the list of genes, the centered profiles (nominators, memory-mapped) and their norms
+             (denominators)
+    """
+    genes, denominators, columns = [], [], 0
+
+    with open(path, 'wb') as fout:
+        for gene, nomi, denomi in read_profiles(filename, method=method, prefer_binary=prefer_binary):
+            genes.append(gene)
+            denominators.append(denomi)
+            columns = len(nomi)
+
+            nomi.astype(dtype).tofile(fout)
+
+    nominators = np.memmap(path, dtype=dtype, mode='r', shape=(len(genes), columns)) if len(genes) > 0 else \
+        np.empty((0, 0), dtype=dtype)
+
+    return genes, nominators, np.array(denominators, dtype=dtype)
+
+
+def plan_blocks(genes, samples, k, max_memory, itemsize, workers=1):
+    """
+    Determines how many genes can be processed at once, both as rows (block) and columns (tile), to keep the memory
+    required by each worker within budget. Besides both parts of the matrix this accounts for the PCC values of a tile,
+    the top co-expressed genes kept for each gene in the block and the output lines.
+
+    :param genes: number of genes in the matrix
+    :param samples: number of samples in the matrix
+    :param k: number of neighbors to keep for each gene
+    :param max_memory: memory available in MB
+    :param itemsize: bytes needed to store one value
+    :param workers: number of processes sharing the memory (default = 1)
+    :return: tuple with the block and tile size
+    """
+    # gene names and denominators are kept by each process
+    available = (max_memory * 1024 * 1024) / workers - genes * (100 + itemsize)
+
+    # solve 2 * itemsize * s^2 + (2 * samples * itemsize + per-gene top-k and output) * s = available
+    a = 2 * itemsize
+    b = 2 * samples * itemsize + k * (3 * (8 + itemsize) + 40)
+    size = int((-b + np.sqrt(b ** 2 + 4 * a * max(available, 0))) / (2 * a))
+
+    if size < 1:
+        print("Warning! Not enough memory for a single gene, using the minimal block size.", file=sys.stderr)
+
+    size = min(max(size, 1), max(genes, 1))
+
+    return size, size
+
+
+def top_k(scores, k):
+    """
+    Selects the k highest scores from an array without sorting the entire array. Ties are resolved in favor of the
+    lowest index, the same order a stable sort on the full array would produce.
+
+    :param scores: 1D numpy array with scores
+    :param k: number of scores to select
+    :return: indices of the selected scores, ordered from high to low
+    """
+    k = min(k, len(scores))
+
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    if k < len(scores):
+        threshold = scores[np.argpartition(scores, len(scores) - k)[len(scores) - k]]
+        above = np.flatnonzero(scores > threshold)
+        ties = np.flatnonzero(scores == threshold)[:k - len(above)]
+        selected = np.concatenate((above, ties))
+    else:
+        selected = np.arange(len(scores))
+
+    return selected[np.lexsort((selected, -scores[selected]))]
+
+
+def pcc_block(nominators, denominators, start, stop, matmul=False):
+    """
+    Calculates the PCC of a block of genes against all genes
+
+    By default the profile of each gene is multiplied with the matrix separately, as in the original per-gene
+    implementation, so the values are identical to the last digit. With matmul the entire block is calculated using a
+    single matrix multiplication, which is faster but as BLAS sums matrix products in a different order values can
+    differ in the last digit.
+
+    :param nominators: centered expression profiles
+    :param denominators: norms of the centered profiles
+    :param start: index of the first gene (row) in the block
+    :param stop: index of the first gene (row) after the block
+    :param matmul: use a single matrix multiplication for the block (default = False)
+    :return: matrix with PCC values, one row for each gene in the block
+    """
+    if matmul:
+        pcc_values = np.dot(nominators[start:stop], nominators.T)
+    else:
+        pcc_values = np.empty((stop - start, len(nominators)), dtype=nominators.dtype)
+        for i in range(start, stop):
+            pcc_values[i - start] = np.dot(nominators, nominators[i])
+
+    pcc_values /= np.outer(denominators[start:stop], denominators)
+
+    return pcc_values
+
+
+def duplicate_genes(genes):
+    """
+    Finds genes that occur more than once in the matrix. A gene is never reported as co-expressed with itself, this
+    includes other rows with the same gene id.
+
+    :param genes: list with all genes
+    :return: dictionary with, for each row of a duplicated gene, the indices of all rows with that gene id
+    """
+    rows = {}
+    for i, gene in enumerate(genes):
+        rows.setdefault(gene, []).append(i)
+
+    return {i: np.array(r, dtype=np.intp) for r in rows.values() if len(r) > 1 for i in r}
+
+
+def select_candidates(row, k, cutoff=None):
+    """
+    Selects the top k scores in a row, optionally only considering scores above a cutoff. Scores below the cutoff are
+    dropped before the selection, so the fewer scores pass, the less there is to rank.
+
+    :param row: 1D numpy array with PCC values
+    :param k: number of co-expressed genes to select
+    :param cutoff: only select PCC values above this value, set to None to consider all values (default = None)
+    :return: indices of the selected scores, ordered from high to low
+    """
+    if cutoff is None:
+        return top_k(row, k)
+
+    candidates = np.flatnonzero(row > cutoff)
+
+    return candidates[top_k(row[candidates], k)]
+
+
+def select_neighbors(pcc_values, start, k, cutoff=None, duplicates=None):
+    """
+    Selects the top k co-expressed genes for each gene in a block
+
+    :param pcc_values: matrix with PCC values from pcc_block
+    :param start: index of the first gene in the block
+    :param k: number of co-expressed genes to select per gene
+    :param cutoff: only select genes with a PCC above this value, set to None to select the top k regardless of their
+                   PCC (default = None)
+    :param duplicates: rows with the same gene id for duplicated genes, see duplicate_genes (default = None)
+    :return: list with, for each gene, a tuple with the indices of the co-expressed genes and their PCC values
+    """
+    duplicates = {} if duplicates is None else duplicates
+    neighbors = []
+
+    for i, row in enumerate(pcc_values, start=start):
+        # exclude the gene itself
+        row[duplicates.get(i, i)] = -np.inf
+        selected = select_candidates(row, k, cutoff=cutoff)
+        selected = selected[row[selected] > -np.inf]
 
-                if size != len(parts):
-                    print("Warning! Unequal number of columns found in line:\n%s.\nExpression matrix corrupt. Aborting!\n" % line, file=sys.stderr)
-                    quit()
+        neighbors.append((selected, row[selected]))
 
-                if len(parts) == size:
-                    temp = []
-                    for j in range(1, len(parts)):
-                        try:
-                            temp.append(float(parts[j]))
-                        except ValueError:
-                            print("Warning! Non-number character found in line:\n%s.\nExpression matrix corrupt. Aborting!\n" % line, file=sys.stderr)
-                            quit()
+    return neighbors
 
-                    row_values = np.array(temp)
-                    nomi = row_values-(sum(row_values)/len(row_values))
-                    denomi = np.sqrt(sum(nomi**2))
 
-                    if denomi != 0.0:
-                        nominators.append(nomi)
-                        denominators.append(denomi)
-                        genes.append(parts[0])
+def stream_neighbors(nominators, denominators, start, stop, tile_size, k, cutoff=None, duplicates=None):
+    """
+    Selects the top k co-expressed genes for each gene in a block, reading the other genes in tiles. For each gene only
+    the best k genes found so far are kept, so memory use depends on the block and tile size, not on the number of
+    genes. Tiles are calculated using matrix multiplications, so values can differ in the last digit from those
+    calculated one gene at the time.
+
+    :param nominators: centered expression profiles (can be memory-mapped)
+    :param denominators: norms of the centered profiles
+    :param start: index of the first gene (row) in the block
+    :param stop: index of the first gene (row) after the block
+    :param tile_size: number of genes (columns) read at once
+    :param k: number of co-expressed genes to select per gene
+    :param cutoff: only select genes with a PCC above this value, set to None to select the top k regardless of their
+                   PCC (default = None)
+    :param duplicates: rows with the same gene id for duplicated genes, see duplicate_genes (default = None)
+    :return: list with, for each gene, a tuple with the indices of the co-expressed genes and their PCC values
+    """
+    duplicates = {} if duplicates is None else duplicates
+    rows = np.array(nominators[start:stop])
+    best = [(np.empty(0, dtype=np.intp), np.empty(0, dtype=rows.dtype)) for _ in range(start, stop)]
+
+    for tile_start in range(0, len(nominators), tile_size):
+        tile_stop = min(tile_start + tile_size, len(nominators))
+
+        pcc_values = np.dot(rows, np.array(nominators[tile_start:tile_stop]).T)
+        pcc_values /= np.outer(denominators[start:stop], denominators[tile_start:tile_stop])
+
+        for i, row in enumerate(pcc_values):
+            # exclude the gene itself
+            excluded = np.atleast_1d(duplicates.get(start + i, start + i))
+            excluded = excluded[(excluded >= tile_start) & (excluded < tile_stop)]
+            row[excluded - tile_start] = -np.inf
+
+            candidates = select_candidates(row, k, cutoff=cutoff)
+            candidates = candidates[row[candidates] > -np.inf]
+
+            # the best genes so far have lower indices than the tile, so ties are still resolved in favor of the
+            # lowest index
+            indices = np.concatenate((best[i][0], candidates + tile_start))
+            scores = np.concatenate((best[i][1], row[candidates]))
+            selected = top_k(scores, k)
+
+            best[i] = (indices[selected], scores[selected])
+
+    return best
+
+
+def format_block(genes, start, neighbors, cutoff=0.7):
+    """
+    Formats the output lines for a block of genes
 
-    nominators = np.array(nominators)
-    denominators = np.array(denominators)
+    :param genes: list with all genes
+    :param start: index of the first gene in the block
+    :param neighbors: list with the co-expressed genes for each gene in the block, see select_neighbors
+    :param cutoff: only pairs with a PCC above this value are included in the mcl output (default = 0.7)
+    :return: tuple with the ranked output and mcl output for the block (both strings) and a tuple with the number of
+             neighbors per gene, their indices and PCC values (numpy arrays)
+    """
+    lines, mcl_lines = [], []
+
+    for i, (selected, selected_scores) in enumerate(neighbors, start=start):
+        gene = genes[i]
+
+        # tolist() converts to python floats, keep float32 values as numpy scalars so they print with their own
+        # (shorter) precision
+        scores = selected_scores.tolist() if selected_scores.dtype == np.float64 else list(selected_scores)
+
+        lines.append(gene + ": " + '\t'.join([genes[j] + '(' + str(s) + ')' for j, s in zip(selected, scores)]) + "\n")
 
-    # Calculate PCC and write output
-    with open(output, 'w') as fout, open(mcl_output, 'w') as mcl_out:
-        print("Database OK.\nCalculating Pearson Correlation Coefficient and ranks.\n")
-        for i, (nom, denom, gene) in enumerate(zip(nominators, denominators, genes), start=1):
-            print("Calculated PCC values for sequence:%s, %d out of %d." % (gene, i, len(nominators)))
+        # Keep scores > cutoff substract the cutoff from result to remap values to [0,1-cutoff] as this is important for
+        # mcl
+        mcl_lines += [gene + '\t' + genes[j] + '\t' + str(s - cutoff) + '\n' for j, s in zip(selected, scores) if s > cutoff]
 
-            nominator = np.dot(nominators, nom)
-            denominator = np.dot(denominators, denom)
-            pcc_values = nominator/denominator
+    counts = np.array([len(n[0]) for n in neighbors], dtype=np.int64)
+    indices = np.concatenate([n[0] for n in neighbors]) if len(neighbors) > 0 else np.empty(0, dtype=np.intp)
+    scores = np.concatenate([n[1] for n in neighbors]) if len(neighbors) > 0 else np.empty(0)
 
-            data = [{'score': p,
-                     'gene': g,
-                     'string': g + '(' + str(p) + ')'} for g, p in zip(genes, pcc_values) if g != gene]
+    return ''.join(lines), ''.join(mcl_lines), (counts, indices, scores)
 
-            # sort by absolute pcc value
-            data.sort(key=lambda x: x['score'], reverse=True)
 
-            # get top 1000 genes and write them
-            subset = data[:1000]
+def process_block(genes, nominators, denominators, start, stop, tile_size=None, k=1000, cutoff=0.7, sparse=False,
+                  duplicates=None, matmul=False):
+    """
+    Calculates PCC values for a block of genes, selects the top k co-expressed genes and formats the output
+
+    :param genes: list with all genes
+    :param nominators: centered expression profiles
+    :param denominators: norms of the centered profiles
+    :param start: index of the first gene (row) in the block
+    :param stop: index of the first gene (row) after the block
+    :param tile_size: number of genes (columns) to read at once, set to None to process all genes at once
+                      (default = None)
+    :param k: number of co-expressed genes to select per gene (default = 1000)
+    :param cutoff: PCC cutoff for the mcl output (default = 0.7)
+    :param sparse: when true only genes with a PCC above the cutoff are selected (default = False)
+    :param duplicates: rows with the same gene id for duplicated genes, see duplicate_genes (default = None)
+    :param matmul: calculate PCC values with a single matrix multiplication, see pcc_block (default = False)
+    :return: tuple with start, stop, ranked output, mcl output and neighbors for the block (see format_block)
+    """
+    k = min(k, len(genes) - 1)
+    min_score = cutoff if sparse else None
+
+    if tile_size is None:
+        neighbors = select_neighbors(pcc_block(nominators, denominators, start, stop, matmul=matmul), start, k,
+                                     cutoff=min_score, duplicates=duplicates)
+    else:
+        neighbors = stream_neighbors(nominators, denominators, start, stop, tile_size, k, cutoff=min_score,
+                                     duplicates=duplicates)
+
+    return (start, stop) + format_block(genes, start, neighbors, cutoff=cutoff)
+
+
+class StoreWriter:
+    """
+    Writes the top co-expressed genes to a binary store, a directory containing the genes (genes.txt, the line number
+    is the gene's index) and the neighbors of all genes in CSR layout: the neighbors of gene i are
+    indices[indptr[i]:indptr[i+1]] with their PCC values at the same positions in scores. The arrays are stored as .npy
+    files so they can be memory-mapped, use utils.coexpression.CoexpressionStore to read a store.
+    """
+    def __init__(self, path, genes, dtype='float32'):
+        """
+        Creates the store and writes the gene index
 
-            fout.writelines(gene + ": " + '\t'.join([s['string'] for s in subset]) + "\n")
+        :param path: directory to write the store to
+        :param genes: list with all genes
+        :param dtype: float16 or float32, precision of the stored PCC values (default = float32)
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.counts = []
+
+        os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(path, 'genes.txt'), 'w') as f:
+            f.writelines([g + '\n' for g in genes])
+
+        # neighbors and scores are written as raw data as they come in, and converted to .npy files when closing
+        self.indices = open(os.path.join(path, 'indices.raw'), 'wb')
+        self.scores = open(os.path.join(path, 'scores.raw'), 'wb')
+
+    def add(self, counts, indices, scores):
+        """
+        Adds the neighbors for the next genes
+
+        :param counts: numpy array with the number of neighbors for each gene
+        :param indices: numpy array with the indices of the neighbors
+        :param scores: numpy array with the PCC values of the neighbors
+        """
+        self.counts.append(counts)
+        indices.astype(np.int32).tofile(self.indices)
+        scores.astype(self.dtype).tofile(self.scores)
+
+    def close(self):
+        """
+        Writes the index pointers and converts the raw neighbors and scores to .npy files
+        """
+        self.indices.close()
+        self.scores.close()
+
+        counts = np.concatenate(self.counts) if len(self.counts) > 0 else np.empty(0, dtype=np.int64)
+        np.save(os.path.join(self.path, 'indptr.npy'), np.concatenate(([0], np.cumsum(counts))).astype(np.int64))
+
+        for name, dtype in [('indices', np.dtype(np.int32)), ('scores', self.dtype)]:
+            raw = os.path.join(self.path, name + '.raw')
+
+            with open(os.path.join(self.path, name + '.npy'), 'wb') as fout, open(raw, 'rb') as fin:
+                np.lib.format.write_array_header_1_0(fout, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                            'fortran_order': False,
+                                                            'shape': (os.path.getsize(raw) // dtype.itemsize,)})
+                shutil.copyfileobj(fin, fout)
+
+            os.remove(raw)
+
+
+# Matrix shared by the worker processes, set by __init_worker
+__shared = {}
+
+
+def __init_worker(genes, source, options):
+    """
+    Initializes a worker process, attaches the centered profiles and their norms stored in shared memory or a
+    memory-mapped file
+
+    :param genes: list with all genes
+    :param source: dictionary describing where the matrix is stored (see calculate_blocks)
+    :param options: dictionary with keyword arguments for process_block
+    """
+    shape, dtype = source['shape'], np.dtype(source['dtype'])
+
+    if 'shm' in source:
+        shm = shared_memory.SharedMemory(name=source['shm'])
+        buffer = np.ndarray(shape[0] * (shape[1] + 1), dtype=dtype, buffer=shm.buf)
+
+        __shared['shm'] = shm
+        __shared['nominators'] = buffer[:shape[0] * shape[1]].reshape(shape)
+        __shared['denominators'] = buffer[shape[0] * shape[1]:]
+    else:
+        __shared['nominators'] = np.memmap(source['memmap'], dtype=dtype, mode='r', shape=shape)
+        __shared['denominators'] = source['denominators']
+
+    __shared['genes'] = genes
+    __shared['options'] = options
+
+
+def __process_block(block):
+    """
+    Calculates and ranks the PCC values for a block of genes in a worker process
+
+    :param block: tuple with start and stop index of the block
+    :return: tuple with start, stop, ranked output, mcl output and neighbors for the block
+    """
+    start, stop = block
 
-            for s in subset:
-                # Keep scores > 0.7 substract 0.7 from result to remap values to [0,0.3] as this is important for mcl
-                if s['score'] > 0.7:
-                    print(gene, s['gene'], s['score'] - 0.7, sep='\t', file=mcl_out)
+    return process_block(__shared['genes'], __shared['nominators'], __shared['denominators'], start, stop,
+                         **__shared['options'])
+
+
+def shard_path(path, shard):
+    """
+    Returns the path where a shard writes its part of an output file
+
+    :param path: path of the complete output file
+    :param shard: number of the shard (starting at 1)
+    :return: path to the partial output
+    """
+    return "%s.part%d" % (path, shard)
+
+
+def merge_shards(output, mcl_output, shards, store=None):
+    """
+    Concatenates the partial outputs of all shards, in order, and removes the partial files. As shards cover
+    consecutive ranges of genes this yields the same files as a run without shards.
+
+    :param output: path to ranked output
+    :param mcl_output: path to mcl compatible output
+    :param shards: number of shards
+    :param store: path to the binary store, set to None if no store was written (default = None)
+    """
+    for path in [output, mcl_output]:
+        parts = [shard_path(path, shard) for shard in range(1, shards + 1)]
+
+        missing = [p for p in parts if not os.path.exists(p)]
+        if len(missing) > 0:
+            print("Partial output %s missing, cannot merge shards. Aborting!" % ', '.join(missing), file=sys.stderr)
+            quit()
+
+        with open(path, 'wb') as fout:
+            for p in parts:
+                with open(p, 'rb') as fin:
+                    shutil.copyfileobj(fin, fout)
+
+        for p in parts:
+            os.remove(p)
+
+    if store is not None:
+        parts = [shard_path(store, shard) for shard in range(1, shards + 1)]
+
+        with open(os.path.join(parts[0], 'genes.txt')) as f:
+            genes = [g.rstrip('\n') for g in f]
+
+        writer = StoreWriter(store, genes, dtype=np.load(os.path.join(parts[0], 'scores.npy'), mmap_mode='r').dtype)
+        for p in parts:
+            writer.add(np.diff(np.load(os.path.join(p, 'indptr.npy'))),
+                       np.load(os.path.join(p, 'indices.npy'), mmap_mode='r'),
+                       np.load(os.path.join(p, 'scores.npy'), mmap_mode='r'))
+        writer.close()
+
+        for p in parts:
+            shutil.rmtree(p)
+
+    print("Merged %d shards into %s and %s." % (shards, output, mcl_output), file=sys.stderr)
+
+
+@contextmanager
+def calculate_blocks(genes, nominators, denominators, blocks, workers=1, **options):
+    """
+    Context manager that calculates and ranks PCC values for the blocks, either in this process or in a pool of
+    worker processes that share the matrix.
+
+    :param genes: list with all genes
+    :param nominators: centered expression profiles, in memory or memory-mapped
+    :param denominators: norms of the centered profiles
+    :param blocks: list of tuples with the start and stop index of each block
+    :param workers: number of processes to use (default = 1)
+    :param options: keyword arguments for process_block
+    :return: iterator with the results for each block in order (see process_block)
+    """
+    if workers > 1:
+        source = {'shape': nominators.shape, 'dtype': nominators.dtype.str}
+
+        if isinstance(nominators, np.memmap):
+            # Workers map the same file
+            shm = None
+            source['memmap'] = nominators.filename
+            source['denominators'] = denominators
+        else:
+            # Store the matrix once in shared memory, the workers only receive the range of rows to process
+            shm = shared_memory.SharedMemory(create=True, size=max(nominators.size + len(denominators), 1) * nominators.itemsize)
+            source['shm'] = shm.name
+
+            buffer = np.ndarray(nominators.size + len(denominators), dtype=nominators.dtype, buffer=shm.buf)
+            buffer[:nominators.size] = nominators.ravel()
+            buffer[nominators.size:] = denominators
+            del buffer
+
+        try:
+            with Pool(workers, initializer=__init_worker, initargs=(genes, source, options)) as pool:
+                # imap returns the results in order, so the output is written in the original gene order
+                yield pool.imap(__process_block, blocks)
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+    else:
+        yield (process_block(genes, nominators, denominators, start, stop, **options)
+               for start, stop in blocks)
+
+
+def pcc(filename, output, mcl_output, block_size=500, workers=1, shard=None, shards=1, store=None,
+        store_dtype='float32', max_memory=None, dtype='float64', top_k=1000, cutoff=0.7, sparse=False, method='pearson',
+        prefer_binary=False, matmul=False):
+    """
+    Reads an htseq-count matrix, calculated the PCC (Pearson Correlation) for all pairs. It will return a text file with
+    for each sequence the top 1000 (top_k) strongest correlated genes and a mcl but also genemania/cytoscape compatible
+    file containing all gene pairs with a correlation of 0.7 (cutoff) or better.
+
+    :param filename: path to input, a htseq-count matrix file
+    :param output: Matrix output, for each gene it prints the top_k most strongly co-expressed genes
+    :param mcl_output: Mcl compatible output
+    :param block_size: number of genes for which PCC values are calculated at once (default = 500)
+    :param workers: number of processes to calculate PCC values with (default = 1)
+    :param shard: only process this shard (starting at 1) and write the output to partial files, set to None to process
+                  all genes (default = None)
+    :param shards: number of shards genes are divided into (default = 1)
+    :param store: directory to write the top co-expressed genes to in a binary format, set to None to skip this
+                  (default = None)
+    :param store_dtype: float16 or float32, precision of the PCC values in the store (default = float32)
+    :param max_memory: memory budget in MB, when set the matrix is kept on disk and processed in tiles that fit the
+                       budget, block_size is ignored in that case and values can differ in the last digit (default =
+                       None, keep everything in memory)
+    :param dtype: float32 or float64, precision used to calculate PCC values (default = float64)
+    :param top_k: number of co-expressed genes to report for each gene (default = 1000)
+    :param cutoff: PCC cutoff for the mcl output (default = 0.7)
+    :param sparse: when true the ranked output and store only contain genes with a PCC above the cutoff, genes below
+                   the cutoff are discarded before ranking (default = False)
+    :param method: pearson, spearman (PCC of ranks) or log-pearson (PCC of log2(value + 1)) (default = pearson)
+    :param prefer_binary: read the binary copy of the matrix (written by run.py --binary-matrix) if available, note
+                          values in this file are stored as float32 (default = False)
+    :param matmul: calculate the PCC values of a block with a single matrix multiplication, faster but values can differ
+                   in the last digit from the per-gene implementation (default = False)
+    """
+    profiles = None
+    tile_size = None
+
+    if shard is not None:
+        output, mcl_output = shard_path(output, shard), shard_path(mcl_output, shard)
+        store = shard_path(store, shard) if store is not None else None
+
+    try:
+        if max_memory is not None:
+            profiles = output + '.profiles.tmp'
+            genes, nominators, denominators = read_matrix_to_disk(filename, profiles, dtype=dtype, method=method,
+                                                                  prefer_binary=prefer_binary)
+            block_size, tile_size = plan_blocks(len(genes), nominators.shape[1], min(top_k, len(genes) - 1), max_memory,
+                                                nominators.itemsize, workers=workers)
+            print("Processing blocks of %d genes in tiles of %d genes to stay within %d MB." % (block_size, tile_size, max_memory))
+        else:
+            genes, nominators, denominators = read_matrix(filename, dtype=dtype, method=method, prefer_binary=prefer_binary)
+
+        blocks = [(start, min(start + block_size, len(genes))) for start in range(0, len(genes), block_size)]
+
+        if shard is not None:
+            # shards get consecutive blocks, this way the blocks (and values) are identical to a run without shards
+            blocks = blocks[(shard - 1) * len(blocks) // shards:shard * len(blocks) // shards]
+
+        store_writer = StoreWriter(store, genes, dtype=store_dtype) if store is not None else None
+
+        # Calculate PCC and write output
+        with open(output, 'w') as fout, open(mcl_output, 'w') as mcl_out:
+            print("Database OK.\nCalculating Pearson Correlation Coefficient and ranks.\n")
+            with calculate_blocks(genes, nominators, denominators, blocks, workers=workers, tile_size=tile_size,
+                                  k=top_k, cutoff=cutoff, sparse=sparse, duplicates=duplicate_genes(genes),
+                                  matmul=matmul) as results:
+                for start, stop, lines, mcl_lines, neighbors in results:
+                    fout.write(lines)
+                    mcl_out.write(mcl_lines)
+
+                    if store_writer is not None:
+                        store_writer.add(*neighbors)
+
+                    print("Calculated PCC values for sequences %d to %d out of %d." % (start + 1, stop, len(genes)))
+
+        if store_writer is not None:
+            store_writer.close()
+    finally:
+        if profiles is not None and os.path.exists(profiles):
+            os.remove(profiles)
 
     print("PCCs calculated and saved as %s and %s." % (output, mcl_output), file=sys.stderr)
 
@@ -86,6 +734,36 @@ if __name__ == "__main__":
     parser.add_argument('output', help='path to ranked output')
     parser.add_argument('mcl_output', help='path to mcl compatible output')
 
+    parser.add_argument('--block-size', help='number of genes processed at once (default = 500)', default=500, type=int)
+    parser.add_argument('--matmul', help='calculate each block with a single matrix multiplication, this is faster but values can differ in the last digit', action='store_true')
+
+    parser.add_argument('--workers', help='number of processes to use, match this with the cores requested in qsub_pcc (default = 1)', default=1, type=int)
+
+    parser.add_argument('--shards', help='number of shards the genes are divided into (default = 1)', default=1, type=int)
+    parser.add_argument('--shard', help='only process this shard (starting at 1), partial output is written to <output>.part<shard>', default=None, type=int)
+    parser.add_argument('--merge', help='merge the partial output of all shards', action='store_true')
+
+    parser.add_argument('--store', help='directory to write a binary store with the top co-expressed genes to (default: None, no store)', default=None)
+    parser.add_argument('--store-dtype', help='precision of the PCC values in the binary store (default = float32)', choices=['float16', 'float32'], default='float32')
+
+    parser.add_argument('--max-memory', help='memory budget in MB, keeps the matrix on disk and processes it in tiles that fit the budget (default: None, keep everything in memory)', default=None, type=int)
+    parser.add_argument('--dtype', help='precision used to calculate PCC values, float32 halves the memory required (default = float64)', choices=['float32', 'float64'], default='float64')
+
+    parser.add_argument('--top-k', help='number of co-expressed genes to report for each gene (default = 1000)', default=1000, type=int)
+    parser.add_argument('--cutoff', help='PCC cutoff for the mcl output (default = 0.7)', default=0.7, type=float)
+    parser.add_argument('--sparse', help='only report genes with a PCC above the cutoff in the ranked output and store', action='store_true')
+    parser.add_argument('--binary', dest='prefer_binary', help='read the binary copy of the matrix (<input>.bin, written by run.py --binary-matrix) if it is up to date, this is faster but values are stored as float32 so PCC values can differ slightly', action='store_true')
+    parser.add_argument('--method', help='correlation to calculate, spearman uses the ranks of the values, log-pearson the log2 of the values + 1 (default = pearson)', choices=['pearson', 'spearman', 'log-pearson'], default='pearson')
+
     args = parser.parse_args()
 
-    pcc(args.input, args.output, args.mcl_output)
+    if args.shard is not None and not 1 <= args.shard <= args.shards:
+        parser.error('--shard should be between 1 and --shards')
+
+    if args.merge:
+        merge_shards(args.output, args.mcl_output, args.shards, store=args.store)
+    else:
+        pcc(args.input, args.output, args.mcl_output, block_size=args.block_size, workers=args.workers,
+            shard=args.shard, shards=args.shards, store=args.store, store_dtype=args.store_dtype,
+            max_memory=args.max_memory, dtype=args.dtype, top_k=args.top_k, cutoff=args.cutoff, sparse=args.sparse,
+            method=args.method, prefer_binary=args.prefer_binary, matmul=args.matmul)
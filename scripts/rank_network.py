@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import argparse
+
+import numpy as np
+import os
+import sys
+
+
+def read_store(path):
+    """
+    Reads the top co-expressed genes from a binary store written by pcc.py (--store). The neighbors are kept as a
+    sparse (CSR) matrix, the arrays are memory-mapped.
+
+    :param path: directory containing the store
+    :return: tuple with the list of genes, the row pointers and the column indices of the neighbors
+    """
+    with open(os.path.join(path, 'genes.txt'), 'r') as f:
+        genes = [g.rstrip('\n') for g in f]
+
+    indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode='r')
+    indices = np.load(os.path.join(path, 'indices.npy'), mmap_mode='r')
+
+    return genes, indptr, indices
+
+
+def reciprocal_ranks(indptr, indices):
+    """
+    Looks up, for all pairs of genes that are in each other's top co-expressed genes, the rank of both genes in the
+    other gene's list. Neighbors are stored from high to low PCC, so the rank is the position in the row (starting at 1).
+    Both directions are matched at once by sorting the pairs on their coordinate in the (sparse) matrix.
+
+    :param indptr: row pointers of the neighbors (CSR)
+    :param indices: column indices of the neighbors (CSR)
+    :return: tuple with the first and second gene of each pair (first < second), the rank of the second gene for the
+             first one and the rank of the first gene for the second one (all numpy arrays)
+    """
+    gene_count = len(indptr) - 1
+    counts = np.diff(indptr)
+
+    rows = np.repeat(np.arange(gene_count, dtype=np.int64), counts)
+    columns = np.asarray(indices, dtype=np.int64)
+    ranks = np.arange(len(columns), dtype=np.int64) - np.repeat(np.asarray(indptr[:-1], dtype=np.int64), counts) + 1
+
+    if len(columns) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, empty
+
+    keys = rows * gene_count + columns
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    # position of the transposed pair, if present
+    positions = np.minimum(np.searchsorted(sorted_keys, columns * gene_count + rows), len(sorted_keys) - 1)
+    mutual = (sorted_keys[positions] == columns * gene_count + rows) & (rows < columns)
+
+    return rows[mutual], columns[mutual], ranks[mutual], ranks[order[positions[mutual]]]
+
+
+def rank_network(store, output, method='mr', max_rank=30, decay=10.0, raw=False):
+    """
+    Builds a Mutual Rank (MR, geometric mean of both ranks) or Highest Reciprocal Rank (HRR, the highest of both ranks)
+    network from the top co-expressed genes in a binary store written by pcc.py. Pairs are only scored when both genes
+    are among each other's top co-expressed genes, only pairs with a score <= max_rank are kept.
+
+    The output is written in mcl compatible (abc) format, as MCL requires higher values for stronger edges scores are
+    converted to weights using exp(-(score - 1)/decay).
+
+    :param store: directory containing the store
+    :param output: path to write the edges to
+    :param method: mr or hrr (default = mr)
+    :param max_rank: highest MR or HRR to include (default = 30)
+    :param decay: controls how fast weights drop with higher ranks (default = 10)
+    :param raw: write the MR or HRR score rather than the weight (default = False)
+    """
+    genes, indptr, indices = read_store(store)
+
+    first, second, first_rank, second_rank = reciprocal_ranks(indptr, indices)
+
+    if method == 'mr':
+        scores = np.sqrt(first_rank.astype(np.float64) * second_rank)
+    else:
+        scores = np.maximum(first_rank, second_rank).astype(np.float64)
+
+    keep = scores <= max_rank
+    first, second, scores = first[keep], second[keep], scores[keep]
+
+    # strongest edges first
+    order = np.lexsort((second, first, scores))
+    first, second, scores = first[order], second[order], scores[order]
+
+    values = scores if raw else np.exp(-(scores - 1) / decay)
+
+    with open(output, 'w') as fout:
+        for i, j, v in zip(first.tolist(), second.tolist(), values.tolist()):
+            print(genes[i], genes[j], v, sep='\t', file=fout)
+
+    print("%d %s edges written to %s." % (len(scores), method.upper(), output), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="./rank_network.py")
+
+    parser.add_argument('store', help='path to the binary store written by pcc.py (--store)')
+    parser.add_argument('output', help='path to mcl compatible output')
+
+    parser.add_argument('--method', help='mr (mutual rank) or hrr (highest reciprocal rank) (default = mr)', choices=['mr', 'hrr'], default='mr')
+    parser.add_argument('--max-rank', help='highest MR or HRR included in the network (default = 30)', default=30, type=float)
+    parser.add_argument('--decay', help='edges get weight exp(-(rank - 1)/decay) (default = 10)', default=10.0, type=float)
+    parser.add_argument('--raw', help='write MR or HRR values instead of weights (not suited for MCL)', action='store_true')
+
+    args = parser.parse_args()
+
+    rank_network(args.store, args.output, method=args.method, max_rank=args.max_rank, decay=args.decay, raw=args.raw)
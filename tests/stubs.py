@@ -0,0 +1,90 @@
+import os
+import shutil
+import stat
+import tempfile
+
+
+class StubCommands:
+    """
+    Puts stub executables for the commands of a cluster manager (e.g. sbatch and squeue) first on the PATH. Each stub
+    records its arguments, one call per line, in <name>.calls.
+    """
+    def __init__(self):
+        self.path = tempfile.mkdtemp()
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = self.path + os.pathsep + self.old_path
+
+    def add(self, name, script):
+        """
+        Adds a stub
+
+        :param name: name of the command
+        :param script: body of the stub (sh)
+        """
+        filename = os.path.join(self.path, name)
+
+        with open(filename, 'w') as f:
+            print('#!/bin/sh', file=f)
+            print('echo "$@" >> %s' % os.path.join(self.path, name + '.calls'), file=f)
+            print(script, file=f)
+
+        os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
+
+    def calls(self, name):
+        """
+        :param name: name of the command
+        :return: list with the arguments (string) of each call
+        """
+        filename = os.path.join(self.path, name + '.calls')
+
+        if not os.path.exists(filename):
+            return []
+
+        with open(filename) as f:
+            return [line.rstrip('\n') for line in f]
+
+    def remove(self):
+        os.environ['PATH'] = self.old_path
+        shutil.rmtree(self.path)
+
+    def add_sge(self):
+        """
+        Adds qsub and qstat stubs that behave like SGE on a cluster where jobs run as soon as they are submitted. qsub
+        runs the script right away, with JOB_ID, JOB_NAME and the variables passed with -v, and writes its exit code to
+        exit.<job id>. A job held with -hold_jid is never run if one of the jobs it waits for exited with code 100, as on
+        SGE. qstat lists no jobs, as all jobs are done.
+        """
+        exit_codes = os.path.join(self.path, 'exit')
+
+        self.add('qsub', '\n'.join([
+            'id=$(( $(cat %s 2> /dev/null || echo 0) + 1 ))' % os.path.join(self.path, 'last_id'),
+            'echo $id > %s' % os.path.join(self.path, 'last_id'),
+            'hold=""',
+            'while [ $# -gt 1 ]; do',
+            '    case "$1" in',
+            '        -v) for v in $(echo "$2" | tr "," " "); do export "$v"; done; shift ;;',
+            '        -hold_jid) hold=$(echo "$2" | tr "," " "); shift ;;',
+            '    esac',
+            '    shift',
+            'done',
+            'name=$(sed -n "s/^#\\$ -N //p" "$1")',
+            'echo "Your job $id (\\"$name\\") has been submitted"',
+            'for h in $hold; do',
+            '    if [ "$(cat %s.$h)" = 100 ]; then exit 0; fi' % exit_codes,
+            'done',
+            'JOB_ID=$id JOB_NAME=$name bash "$1" > OUT_$name.$id 2>&1',
+            'echo $? > %s.$id' % exit_codes]))
+        self.add('qstat', '')
+
+    def exit_code(self, job_id):
+        """
+        :param job_id: id of a job run by the qsub stub (see add_sge)
+        :return: exit code of the job, None if it was never run
+        """
+        filename = os.path.join(self.path, 'exit.%s' % job_id)
+
+        if not os.path.exists(filename):
+            return None
+
+        with open(filename) as f:
+            return int(f.read())
@@ -0,0 +1,56 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from cluster.schedulers import SGEScheduler
+from pipeline.base import PipelineBase
+
+
+class TestTaskArrayScript(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+
+        # only the scheduler and email are needed to write scripts, skip reading the config files
+        self.pipeline = PipelineBase.__new__(PipelineBase)
+        self.pipeline.scheduler = SGEScheduler()
+        self.pipeline.email = None
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+    def run_task(self, command, tasks, task_id):
+        filename, _, _ = self.pipeline.write_task_array_script('test_%d', None, PipelineBase.mark_done(command),
+                                                               'test_%d.sh', tasks)
+
+        return subprocess.call(['bash', filename], env=dict(os.environ, SGE_TASK_ID=str(task_id), JOB_ID='1'),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def test_empty_fields(self):
+        tasks = [{'a': 'x', 'b': '', 'c': 'z', 'done': 'first.done'},
+                 {'a': '', 'b': 'y', 'c': '', 'done': 'second.done'}]
+
+        for i in range(2):
+            self.assertEqual(self.run_task('echo "$a|$b|$c" > out_${SGE_TASK_ID}.txt', tasks, i + 1), 0)
+
+        with open('out_1.txt') as f:
+            self.assertEqual(f.read(), 'x||z\n')
+        with open('out_2.txt') as f:
+            self.assertEqual(f.read(), '|y|\n')
+        self.assertTrue(os.path.exists('first.done') and os.path.exists('second.done'))
+
+    def test_mark_done_checks_all_lines(self):
+        tasks = [{'done': 'task.done'}]
+
+        self.assertEqual(self.run_task('false\ntouch out.txt', tasks, 1), 1)
+
+        self.assertFalse(os.path.exists('out.txt'))
+        self.assertFalse(os.path.exists('task.done'))
+
+
+if __name__ == '__main__':
+    unittest.main()
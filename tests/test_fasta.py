@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils.parser.fasta import FastaIndex
+
+
+class TestFastaIndex(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+
+        self.write('genes.fa', '>gene1 description\nACGTA\nCG\n>gene2\nTTTT\n')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+    @staticmethod
+    def write(filename, content):
+        with open(filename, 'w') as f:
+            f.write(content)
+
+    def test_fetch(self):
+        with FastaIndex('genes.fa') as index:
+            self.assertEqual(index.lengths(), {'gene1 description': 7, 'gene2': 4})
+            self.assertEqual(index.fetch('gene1 description', 3, 6), 'TAC')
+
+        # the index uses full names, samtools' .fai is left alone
+        self.assertFalse(os.path.exists('genes.fa.fai'))
+
+        with FastaIndex('genes.fa') as index:
+            self.assertEqual(index['gene2'], 'TTTT')
+
+    def test_changed_fasta(self):
+        FastaIndex('genes.fa').close()
+        stat = os.stat('genes.fa')
+
+        # same modification time, only the size differs
+        self.write('genes.fa', '>gene3\nGG\n')
+        os.utime('genes.fa', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        with FastaIndex('genes.fa') as index:
+            self.assertEqual(list(index), ['gene3'])
+            self.assertEqual(index['gene3'], 'GG')
+
+
+if __name__ == '__main__':
+    unittest.main()
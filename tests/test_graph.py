@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cluster.graph import JobGraph
+from cluster.schedulers import SGEScheduler
+from stubs import StubCommands
+
+
+class TestJobGraph(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+
+        self.stubs = StubCommands()
+        self.stubs.add_sge()
+
+        self.scheduler = SGEScheduler()
+        self.scheduler.min_poll_interval = 0
+
+        self.graph = JobGraph(self.scheduler)
+        self.cleaned = []
+
+    def tearDown(self):
+        self.stubs.remove()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+    def add(self, key, command, after=None):
+        filename = key + '.sh'
+        with open(filename, 'w') as f:
+            print(self.scheduler.build_template(key, None, None, command), file=f)
+
+        return self.graph.add(key, filename, key, after=after, on_done=lambda: self.cleaned.append(key))
+
+    def test_run(self):
+        self.add('trim', 'touch trimmed')
+        self.add('align', 'test -e trimmed && touch aligned', after=['trim'])
+
+        self.assertEqual(self.graph.run(sleep_time=0), set())
+        self.assertEqual(self.cleaned, ['trim', 'align'])
+        self.assertTrue(os.path.exists('aligned'))
+
+    def test_run_failed_upstream_job(self):
+        self.add('trim', 'exit 3')
+        self.add('align', 'touch aligned', after=['trim'])
+        self.add('count', 'touch counted', after=['align'])
+        self.add('other', 'true')
+
+        self.assertEqual(self.graph.run(sleep_time=0), {'trim', 'align', 'count'})
+
+        # the failed job isn't cleaned up after, jobs depending on it are not submitted
+        self.assertEqual(self.cleaned, ['other'])
+        self.assertEqual(len(self.stubs.calls('qsub')), 2)
+        self.assertFalse(os.path.exists('aligned'))
+
+    def test_run_job_without_stats(self):
+        # e.g. a job killed by the scheduler
+        self.add('trim', 'rm -f trimmed')
+        self.graph.jobs['trim']['script'] = 'missing.sh'
+        self.add('align', 'touch aligned', after=['trim'])
+
+        self.assertEqual(self.graph.run(sleep_time=0), {'trim', 'align'})
+        self.assertEqual(self.cleaned, [])
+
+    def test_submit_all(self):
+        self.add('trim', 'touch trimmed')
+        self.add('align', 'touch aligned', after=['trim'])
+
+        job_ids = self.graph.submit_all()
+
+        calls = self.stubs.calls('qsub')
+        self.assertIn('-hold_jid %s' % job_ids['trim'], calls[1])
+        # only jobs others depend on keep them on hold when they fail
+        self.assertIn('LSTRAP_HOLD_EXIT=100', calls[0])
+        self.assertNotIn('LSTRAP_HOLD_EXIT', calls[1])
+        self.assertTrue(os.path.exists('aligned'))
+
+    def test_submit_all_failed_upstream_job(self):
+        self.add('trim', 'exit 3')
+        self.add('align', 'touch aligned', after=['trim'])
+
+        job_ids = self.graph.submit_all()
+
+        # exit code 100 keeps the alignment on hold on SGE, the real exit code is kept in the statistics
+        self.assertEqual(self.stubs.exit_code(job_ids['trim']), 100)
+        self.assertEqual(self.scheduler.exit_codes(job_ids['trim'], 'trim'), [3])
+        self.assertIsNone(self.stubs.exit_code(job_ids['align']))
+        self.assertFalse(os.path.exists('aligned'))
+
+    def test_submit_all_without_job_id(self):
+        self.add('trim', 'touch trimmed')
+        self.add('align', 'touch aligned', after=['trim'])
+        self.add('count', 'touch counted', after=['align'])
+
+        # the alignment is submitted, but its job id can't be read from the output
+        self.stubs.add('qsub', '\n'.join([
+            'case "$*" in',
+            '    *align.sh) echo "Unable to run job" ;;',
+            '    *) echo "Your job 7 (\\"trim\\") has been submitted" ;;',
+            'esac']))
+        self.stubs.add('qdel', '')
+
+        with self.assertRaises(SystemExit) as context:
+            self.graph.submit_all()
+
+        self.assertEqual(context.exception.code, 1)
+        self.assertEqual(self.stubs.calls('qdel'), ['7'])
+        self.assertEqual(len(self.stubs.calls('qsub')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
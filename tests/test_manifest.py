@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils.manifest import StepManifest
+
+
+class TestStepManifest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+
+        self.write('in.txt', 'input')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+    @staticmethod
+    def write(filename, content):
+        with open(filename, 'w') as f:
+            f.write(content)
+
+    def test_finished_task(self):
+        steps = StepManifest('step.steps.tsv')
+        marker = steps.start('task', 'cmd', ['in.txt'], ['out.txt'])
+        self.write('out.txt', 'output')
+        self.write(marker, '')
+        steps.finish()
+
+        self.assertFalse(os.path.exists(marker))
+        self.assertTrue(StepManifest('step.steps.tsv').done('task', 'cmd', ['in.txt'], ['out.txt']))
+        self.assertFalse(StepManifest('step.steps.tsv').done('task', 'other', ['in.txt'], ['out.txt']))
+
+    def test_failed_task(self):
+        steps = StepManifest('step.steps.tsv')
+        steps.start('task', 'cmd', ['in.txt'], ['out.txt'])
+        self.write('out.txt', 'partial')
+        steps.finish()
+
+        self.assertFalse(StepManifest('step.steps.tsv').done('task', 'cmd', ['in.txt'], ['out.txt']))
+
+    def test_input_changed_while_running(self):
+        steps = StepManifest('step.steps.tsv')
+        marker = steps.start('task', 'cmd', ['in.txt'], ['out.txt'])
+        # the job used the input as it was when the task started
+        self.write('in.txt', 'changed input')
+        self.write('out.txt', 'output')
+        self.write(marker, '')
+        steps.finish()
+
+        self.assertFalse(StepManifest('step.steps.tsv').done('task', 'cmd', ['in.txt'], ['out.txt']))
+
+    def test_input_written_by_earlier_job(self):
+        steps = StepManifest('step.steps.tsv')
+        marker = steps.start('task', 'cmd', ['in.txt', 'trimmed.txt'], ['out.txt'])
+        self.write('trimmed.txt', 'trimmed')
+        self.write('out.txt', 'output')
+        self.write(marker, '')
+        steps.finish()
+
+        self.assertTrue(StepManifest('step.steps.tsv').done('task', 'cmd', ['in.txt', 'trimmed.txt'], ['out.txt']))
+
+    def test_intermediate_files(self):
+        steps = StepManifest('step.steps.tsv')
+        marker = steps.start('task', 'cmd', ['in.txt'], ['trimmed.txt'], intermediate=['trimmed.txt'])
+        self.write(marker, '')
+        # removed by the next step before the task is recorded
+        steps.finish()
+
+        steps = StepManifest('step.steps.tsv')
+        self.assertFalse(steps.done('task', 'cmd', ['in.txt'], ['trimmed.txt']))
+        self.assertTrue(steps.done('task', 'cmd', ['in.txt'], ['trimmed.txt'], intermediate=['trimmed.txt']))
+
+        # made again by another run, so the task isn't done
+        self.write('trimmed.txt', 'trimmed')
+        self.assertFalse(steps.done('task', 'cmd', ['in.txt'], ['trimmed.txt'], intermediate=['trimmed.txt']))
+
+    def test_task_finished_after_run(self):
+        steps = StepManifest('step.steps.tsv')
+        first = steps.start('first', 'cmd', ['in.txt'], ['first.txt'])
+        second = steps.start('second', 'cmd', ['in.txt'], ['second.txt'])
+        steps.write()
+
+        # the job finishes once run.py stopped, e.g. with --submit-all
+        self.write('first.txt', 'output')
+        self.write(first, '')
+
+        steps = StepManifest('step.steps.tsv')
+        self.assertTrue(steps.done('first', 'cmd', ['in.txt'], ['first.txt']))
+        self.assertFalse(steps.done('second', 'cmd', ['in.txt'], ['second.txt']))
+        self.assertFalse(os.path.exists(first))
+
+        # still running, recorded once it is done
+        self.write('second.txt', 'output')
+        self.write(second, '')
+        self.assertTrue(StepManifest('step.steps.tsv').done('second', 'cmd', ['in.txt'], ['second.txt']))
+
+
+if __name__ == '__main__':
+    unittest.main()
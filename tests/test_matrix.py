@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'numpy is required')
+class TestExpressionMatrix(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_read_gene_with_hash(self):
+        from utils.matrix import ExpressionMatrix
+
+        filename = os.path.join(self.path, 'exp_matrix.txt')
+        with open(filename, 'w') as f:
+            print('gene', 's1', 's2', sep='\t', file=f)
+            print('g1#1', 1, 2, sep='\t', file=f)
+            print('g2', 3, 4, sep='\t', file=f)
+
+        matrix = ExpressionMatrix.read(filename, prefer_binary=False)
+
+        self.assertEqual(matrix.genes, ['g1#1', 'g2'])
+        self.assertEqual(matrix.values.tolist(), [[1, 2], [3, 4]])
+
+    def test_from_htseq_duplicate_gene(self):
+        from utils.matrix import ExpressionMatrix
+
+        filenames = [os.path.join(self.path, name) for name in ['s1.htseq', 's2.htseq']]
+        for filename, content in zip(filenames, ['g1\t1\ng2\t2\ng1\t3\n', 'g1\t4\ng2\t5\ng1\t6\n']):
+            with open(filename, 'w') as f:
+                f.write(content)
+
+        matrix = ExpressionMatrix.from_htseq(filenames, samples=['s1', 's2'])
+
+        # the first file is handled like the others, the last count of a gene is used
+        self.assertEqual(matrix.genes, ['g1', 'g2'])
+        self.assertEqual(matrix.values.tolist(), [[3, 6], [2, 5]])
+
+
+@unittest.skipIf(numpy is None, 'numpy is required')
+class TestIncrementalMatrix(unittest.TestCase):
+    def setUp(self):
+        from pipeline.transcriptome import TranscriptomePipeline
+
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+
+        os.makedirs('htseq')
+        with open('cds.fa', 'w') as f:
+            for i, gene in enumerate(['g1', 'g2', 'g3', 'g4', 'g5', 'only_s2']):
+                print('>%s\n%s' % (gene, 'A' * (100 * i + 137)), file=f)
+
+        # only the settings used to build and normalize the matrix, skip reading the config files
+        self.pipeline = TranscriptomePipeline.__new__(TranscriptomePipeline)
+        self.pipeline.genomes = ['zma']
+        self.pipeline.dp = {'zma': {}}
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+    @staticmethod
+    def write_htseq(sample, counts):
+        with open(os.path.join('htseq', sample + '.htseq'), 'w') as f:
+            for gene, count in counts + [('__no_feature', 3), ('__ambiguous', 1)]:
+                print(gene, count, sep='\t', file=f)
+
+    def build(self, output, incremental):
+        output = os.path.join(self.path, output)
+        self.pipeline.dp['zma'] = {'htseq_output': os.path.join(self.path, 'htseq'), 'cds_fasta': 'cds.fa',
+                                   'exp_matrix_output': os.path.join(output, 'exp_matrix.txt'),
+                                   'exp_matrix_tpm_output': os.path.join(output, 'exp_matrix.tpm.txt'),
+                                   'exp_matrix_rpkm_output': os.path.join(output, 'exp_matrix.rpkm.txt'),
+                                   'exp_matrix_cpm_output': os.path.join(output, 'exp_matrix.cpm.txt')}
+
+        self.pipeline.htseq_to_matrix(incremental=incremental)
+        self.pipeline.normalize(incremental=incremental)
+
+    def assertSameOutput(self):
+        self.build('full', incremental=False)
+
+        for name in ['exp_matrix.txt', 'exp_matrix.tpm.txt', 'exp_matrix.rpkm.txt', 'exp_matrix.cpm.txt']:
+            with open(os.path.join('incremental', name)) as incremental, open(os.path.join('full', name)) as full:
+                self.assertEqual(incremental.read(), full.read(), name)
+
+    def test_same_as_full_rebuild(self):
+        self.write_htseq('s1', [('g1', 10), ('g2', 0), ('g3', 7)])
+        self.write_htseq('s2', [('g4', 3), ('only_s2', 12), ('g1', 1), ('g2', 9)])
+        self.build('incremental', incremental=True)
+        self.assertSameOutput()
+
+        # added sample, with a new gene
+        self.write_htseq('s3', [('g5', 2), ('g1', 3), ('g3', 0), ('g2', 11)])
+        self.build('incremental', incremental=True)
+        self.assertSameOutput()
+
+        # changed sample
+        self.write_htseq('s1', [('g3', 1), ('g1', 17), ('g2', 5)])
+        self.build('incremental', incremental=True)
+        self.assertSameOutput()
+
+        # removed sample, only_s2 and the position of g4 have to follow
+        os.remove(os.path.join('htseq', 's2.htseq'))
+        self.build('incremental', incremental=True)
+        self.assertSameOutput()
+
+        with open(os.path.join('incremental', 'exp_matrix.txt')) as f:
+            self.assertNotIn('only_s2', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cluster.schedulers import LocalScheduler, PBSScheduler, SGEScheduler, SLURMScheduler
+from stubs import StubCommands
+
+
+class TestSLURMScheduler(unittest.TestCase):
+    def setUp(self):
+        self.stubs = StubCommands()
+        self.scheduler = SLURMScheduler()
+        self.scheduler.retry_interval = 0
+
+    def tearDown(self):
+        self.stubs.remove()
+
+    def test_submit_parses_job_id(self):
+        self.stubs.add('sbatch', 'echo "Submitted batch job 4242"')
+
+        job_id = self.scheduler.submit('job.sh', 'job_1', options=['--time=00:10:00'], variables='in=a.txt')
+
+        self.assertEqual(job_id, '4242')
+        self.assertEqual(self.scheduler.submitted_jobs, {'job_1': ['4242']})
+
+        args = self.stubs.calls('sbatch')[0].split()
+        self.assertEqual(args[0], '--time=00:10:00')
+        self.assertTrue(args[1].startswith('--export=ALL,in=a.txt,LSTRAP_SUBMITTED='))
+        self.assertEqual(args[-1], 'job.sh')
+
+    def test_submit_without_job_id(self):
+        self.stubs.add('sbatch', 'echo "sbatch: error: invalid partition"')
+
+        self.assertIsNone(self.scheduler.submit('job.sh', 'job_1'))
+
+    def test_dependency_options(self):
+        self.stubs.add('sbatch', 'echo "Submitted batch job 12"')
+
+        self.scheduler.submit('job.sh', 'job_1', after=['10', '11'])
+
+        args = self.stubs.calls('sbatch')[0].split()
+        self.assertIn('--dependency=afterok:10:11', args)
+        self.assertIn('--kill-on-invalid-dep=yes', args)
+
+    def test_running_job_ids(self):
+        # array tasks are listed with their task id
+        self.stubs.add('squeue', 'printf "10_3\\n10_[4-9]\\n12\\n"')
+
+        self.assertEqual(self.scheduler.status(['10', '11', '12']), ['10', '12'])
+        self.assertEqual(len(self.stubs.calls('squeue')), 1)
+
+    def test_failing_status_command(self):
+        self.stubs.add('squeue', 'echo "slurm_load_jobs error: Socket timed out" >&2; exit 1')
+
+        # jobs are considered running when their status can't be determined
+        self.assertEqual(self.scheduler.status(['10', '11']), ['10', '11'])
+        self.assertEqual(len(self.stubs.calls('squeue')), self.scheduler.status_attempts)
+
+    def test_status_command_recovers(self):
+        # fails on the first call only
+        self.stubs.add('squeue', 'if [ ! -e %s ]; then touch %s; exit 1; fi\necho 11' %
+                       ((os.path.join(self.stubs.path, 'failed'),) * 2))
+
+        self.assertEqual(self.scheduler.status(['10', '11']), ['11'])
+        self.assertEqual(len(self.stubs.calls('squeue')), 2)
+
+
+class TestSGEScheduler(unittest.TestCase):
+    def setUp(self):
+        self.stubs = StubCommands()
+        self.stubs.add('qsub', 'echo "Your job-array 31.1-4:1 (\\"job_1\\") has been submitted"')
+        self.scheduler = SGEScheduler()
+        self.scheduler.retry_interval = 0
+
+    def tearDown(self):
+        self.stubs.remove()
+
+    def test_dependency_options(self):
+        job_id = self.scheduler.submit_array('job.sh', 'job_1', after=['10', '11'], hold_on_failure=True)
+
+        self.assertEqual(job_id, '31')
+
+        args = self.stubs.calls('qsub')[0].split()
+        self.assertEqual(args[args.index('-hold_jid') + 1], '10,11')
+        self.assertIn('LSTRAP_HOLD_EXIT=100', args[args.index('-v') + 1].split(','))
+
+    def test_failing_status_command(self):
+        self.stubs.add('qstat', 'exit 1')
+
+        self.assertEqual(self.scheduler.status(['10']), ['10'])
+
+
+class TestPBSScheduler(unittest.TestCase):
+    def setUp(self):
+        self.stubs = StubCommands()
+        self.stubs.add('qsub', 'echo "12.server"')
+        self.scheduler = PBSScheduler()
+        self.scheduler.retry_interval = 0
+
+    def tearDown(self):
+        self.stubs.remove()
+
+    def test_dependency_options(self):
+        job_id = self.scheduler.submit('job.sh', 'job_1', after=['10.server', '11[].server'], hold_on_failure=True)
+
+        self.assertEqual(job_id, '12.server')
+
+        args = self.stubs.calls('qsub')[0].split()
+        self.assertEqual(args[args.index('-W') + 1], 'depend=afterok:10.server,afterokarray:11[].server')
+        # dependencies are only released when jobs succeed, no need for a special exit code
+        self.assertNotIn('LSTRAP_HOLD_EXIT', args[args.index('-v') + 1])
+
+    def test_running_job_ids(self):
+        # Torque truncates long ids, finished jobs are unknown (exit code 153) or completed
+        self.stubs.add('qstat', 'echo "Job ID                    Name             User            Time Use S Queue"\n'
+                                'echo "------------------------- ---------------- --------------- -------- - -----"\n'
+                                'echo "10.long-server-name.e*     job_1            user            00:00:01 R batch"\n'
+                                'echo "11[].long-server-name*     job_2            user                   0 Q batch"\n'
+                                'echo "12.long-server-name.e*     job_3            user            00:00:05 C batch"\n'
+                                'echo "qstat: Unknown Job Id 13.long-server-name.example.org" >&2\n'
+                                'exit 153')
+
+        job_ids = ['10.long-server-name.example.org', '11[].long-server-name.example.org',
+                   '12.long-server-name.example.org', '13.long-server-name.example.org']
+
+        self.assertEqual(self.scheduler.status(job_ids), job_ids[:2])
+        self.assertEqual(len(self.stubs.calls('qstat')), 1)
+
+    def test_failing_status_command(self):
+        self.stubs.add('qstat', 'echo "Cannot connect to default server host \'server\' - check pbs_server daemon." >&2\n'
+                                'exit 111')
+
+        # jobs are considered running when their status can't be determined
+        self.assertEqual(self.scheduler.status(['10.server', '11.server']), ['10.server', '11.server'])
+        self.assertEqual(len(self.stubs.calls('qstat')), self.scheduler.status_attempts)
+
+
+class TestLocalScheduler(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+    def script(self, name, command):
+        with open(name, 'w') as f:
+            print(command, file=f)
+
+        return name
+
+    def test_waiting_jobs_dont_block_others(self):
+        scheduler = LocalScheduler(cores=2)
+
+        first = scheduler.submit(self.script('first.sh', 'sleep 1; touch first.done'), 'first')
+        for i in range(3):
+            scheduler.submit(self.script('next_%d.sh' % i, 'test -e first.done'), 'next', after=[first])
+        # only needs a free core, not the first job
+        scheduler.submit(self.script('other.sh', 'test ! -e first.done'), 'other')
+
+        scheduler.wait('next')
+        scheduler.wait('other')
+
+        for job_id in scheduler.futures:
+            self.assertEqual(scheduler.exit_codes(job_id), [0])
+
+    def test_failed_dependency(self):
+        scheduler = LocalScheduler(cores=2)
+
+        first = scheduler.submit(self.script('first.sh', 'exit 1'), 'first')
+        second = scheduler.submit(self.script('second.sh', 'touch second.done'), 'second', after=[first])
+        third = scheduler.submit(self.script('third.sh', 'touch third.done'), 'third', after=[second])
+
+        scheduler.wait('third')
+
+        self.assertEqual(scheduler.exit_codes(first), [1])
+        self.assertEqual(scheduler.exit_codes(second), [None])
+        self.assertEqual(scheduler.exit_codes(third), [None])
+        self.assertFalse(os.path.exists('second.done') or os.path.exists('third.done'))
+
+
+if __name__ == '__main__':
+    unittest.main()
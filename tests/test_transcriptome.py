@@ -0,0 +1,58 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from cluster import set_scheduler
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'numpy is required')
+class TestUpToDateSteps(unittest.TestCase):
+    def setUp(self):
+        from pipeline.transcriptome import TranscriptomePipeline
+
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+
+        with open('network.mcl.txt', 'w') as f:
+            print('g1', 'g2', '0.9', sep='\t', file=f)
+
+        # only the settings used to cluster the network, skip reading the config files
+        self.pipeline = TranscriptomePipeline.__new__(TranscriptomePipeline)
+        self.pipeline.scheduler = set_scheduler('LOCAL', cores=1)
+        self.pipeline.email = None
+        self.pipeline.hash_inputs = False
+        self.pipeline.genomes = ['zma']
+        self.pipeline.dp = {'zma': {'pcc_mcl_output': os.path.join(self.path, 'network.mcl.txt'),
+                                    'mcl_cluster_output': os.path.join(self.path, 'clusters.txt')}}
+        self.pipeline.mcl_module = None
+        self.pipeline.mcl_cmd = 'cp ${in} ${out}'
+        self.pipeline.qsub_mcl = None
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+    def test_cluster_pcc_up_to_date(self):
+        self.pipeline.cluster_pcc()
+        self.assertTrue(os.path.exists('clusters.txt'))
+
+        with mock.patch('pipeline.transcriptome.wait_for_job') as wait_for_job:
+            self.pipeline.cluster_pcc()
+
+        # nothing was submitted, so there is nothing to wait for
+        wait_for_job.assert_not_called()
+        self.assertEqual(glob.glob('cluster_pcc_*.sh'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
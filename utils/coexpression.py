@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+
+
+class CoexpressionStore:
+    """
+    Reads a binary co-expression store written by scripts/pcc.py (--store). The arrays are memory-mapped, so looking up
+    the neighbors of a gene only reads that gene's part of the store from disk.
+    """
+    def __init__(self, path):
+        """
+        Opens a store
+
+        :param path: directory containing the store
+        """
+        with open(os.path.join(path, 'genes.txt'), 'r') as f:
+            self.genes = [g.rstrip('\n') for g in f]
+
+        self.gene_index = {g: i for i, g in enumerate(self.genes)}
+
+        self.indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode='r')
+        self.indices = np.load(os.path.join(path, 'indices.npy'), mmap_mode='r')
+        self.scores = np.load(os.path.join(path, 'scores.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.genes)
+
+    def __contains__(self, gene):
+        return gene in self.gene_index
+
+    def neighbors(self, gene, top_k=None):
+        """
+        Returns the genes most strongly co-expressed with a gene, ordered from high to low PCC
+
+        :param gene: gene to get the neighbors for
+        :param top_k: maximum number of neighbors to return, set to None for all stored neighbors (default = None)
+        :return: list of tuples with gene and PCC value
+        """
+        i = self.gene_index[gene]
+        start, stop = int(self.indptr[i]), int(self.indptr[i + 1])
+
+        if top_k is not None:
+            stop = min(stop, start + top_k)
+
+        return [(self.genes[j], s) for j, s in zip(self.indices[start:stop].tolist(),
+                                                   self.scores[start:stop].astype(np.float64).tolist())]
@@ -0,0 +1,347 @@
+import hashlib
+import os
+
+
+def file_fingerprint(filename):
+    """
+    Gets the size and modification time of a file, these are cheap to obtain and used to detect changes
+
+    :param filename: path to the file
+    :return: tuple with size (bytes) and modification time (ns)
+    """
+    stat = os.stat(filename)
+
+    return stat.st_size, stat.st_mtime_ns
+
+
+def file_hash(filename, block_size=1 << 20):
+    """
+    Calculates the md5 checksum of a file, used to check files that were touched but might not have changed
+
+    :param filename: path to the file
+    :param block_size: number of bytes read at once (default = 1MB)
+    :return: hexadecimal md5 checksum
+    """
+    md5 = hashlib.md5()
+
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+class SampleManifest:
+    """
+    Keeps track of the files (samples) an output was built from, with their size, modification time and checksum, so
+    only new or changed files have to be processed again. Additional settings (e.g. the version of other inputs) can
+    be stored as metadata. The genes found in each file can be stored as well, identical lists are only stored once (as
+    metadata with their checksum). Manifests are stored as tab-delimited text, metadata on lines starting with #.
+    """
+    def __init__(self, filename):
+        """
+        Opens a manifest, if the file doesn't exist an empty manifest is created
+
+        :param filename: path to the manifest
+        """
+        self.filename = filename
+        self.metadata = {}
+        self.samples = {}
+
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    if line.startswith('#'):
+                        key, value = line[1:].rstrip('\n').split('\t', 1)
+                        self.metadata[key] = value
+                        continue
+
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) in [5, 6]:
+                        self.samples[parts[0]] = {'size': int(parts[1]), 'mtime': int(parts[2]), 'md5': parts[3],
+                                                  'processed': parts[4] == '1',
+                                                  'genes': parts[5] if len(parts) == 6 else '-'}
+
+    def changed(self, sample, filename):
+        """
+        Checks if the file for a sample is new or changed since it was added to the manifest. If the size and
+        modification time match the file is considered unchanged, otherwise the checksum is compared.
+
+        :param sample: sample name
+        :param filename: path to the file for this sample
+        :return: True if the file is new or changed, False otherwise
+        """
+        if sample not in self.samples:
+            return True
+
+        entry = self.samples[sample]
+        size, mtime = file_fingerprint(filename)
+
+        if (size, mtime) == (entry['size'], entry['mtime']):
+            return False
+
+        if size == entry['size'] and file_hash(filename) == entry['md5']:
+            # touched but identical, remember the new modification time
+            entry['mtime'] = mtime
+            return False
+
+        return True
+
+    def add(self, sample, filename, processed=False, genes=None):
+        """
+        Adds (or updates) a sample
+
+        :param sample: sample name
+        :param filename: path to the file for this sample
+        :param processed: flag to keep track if downstream steps handled this sample (default = False)
+        :param genes: list of genes found in the file, set to None to not store these (default = None)
+        """
+        size, mtime = file_fingerprint(filename)
+        self.samples[sample] = {'size': size, 'mtime': mtime, 'md5': file_hash(filename), 'processed': processed,
+                                'genes': '-'}
+
+        if genes is not None:
+            value = '\t'.join(genes)
+            key = hashlib.md5(value.encode('utf-8')).hexdigest()
+
+            self.metadata['genes:' + key] = value
+            self.samples[sample]['genes'] = key
+
+    def genes(self, sample):
+        """
+        :param sample: sample name
+        :return: list of genes found in the file of the sample, None if these weren't stored
+        """
+        key = self.samples[sample]['genes'] if sample in self.samples else '-'
+
+        if 'genes:' + key not in self.metadata:
+            return None
+
+        value = self.metadata['genes:' + key]
+
+        return value.split('\t') if value != '' else []
+
+    def keep(self, samples):
+        """
+        Removes all samples that are not in the list, and the gene lists no other sample uses
+
+        :param samples: list of samples to retain
+        """
+        samples = set(samples)
+        self.samples = {s: e for s, e in self.samples.items() if s in samples}
+
+        used = set('genes:' + e['genes'] for e in self.samples.values())
+        self.metadata = {k: v for k, v in self.metadata.items() if not k.startswith('genes:') or k in used}
+
+    def pending(self):
+        """
+        :return: list of samples not flagged as processed
+        """
+        return [s for s, e in self.samples.items() if not e['processed']]
+
+    def set_processed(self, processed=True):
+        """
+        Flags all samples as processed (or not)
+
+        :param processed: value of the flag (default = True)
+        """
+        for e in self.samples.values():
+            e['processed'] = processed
+
+    def write(self):
+        """
+        Writes the manifest to disk
+        """
+        with open(self.filename + '.tmp', 'w') as f:
+            for key, value in self.metadata.items():
+                print('#%s\t%s' % (key, value), file=f)
+            for sample, e in self.samples.items():
+                print(sample, e['size'], e['mtime'], e['md5'], 1 if e['processed'] else 0, e['genes'], sep='\t',
+                      file=f)
+
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+class StepManifest:
+    """
+    Keeps track of the tasks of a pipeline step (e.g. trimming or aligning a sample), with the command that was run and
+    the fingerprints of the input and output files. A task only needs to run again when it is new, the command or an
+    input changed, or an output is missing or changed afterwards. Tasks are only recorded once the job signals it
+    finished successfully (by creating a marker file, see start), so output truncated by a job that was killed is never
+    considered done. Manifests are stored as tab-delimited text, with a line for the command and each file of a task.
+
+    Tasks that were started but not yet finished are stored as well, so jobs that finish after run.py stopped (e.g.
+    with --submit-all) are recorded the next time the manifest is opened.
+    """
+    def __init__(self, filename, use_hash=False):
+        """
+        Opens a manifest, if the file doesn't exist an empty manifest is created
+
+        :param filename: path to the manifest
+        :param use_hash: when True the md5 checksum of inputs is stored, an input that was touched but is identical is
+                         then not considered changed (default = False, only size and modification time are used)
+        """
+        self.filename = filename
+        self.use_hash = use_hash
+        self.tasks = {}
+        self.started = {}
+
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+
+                    if parts[1] == 'cmd' and len(parts) == 3:
+                        self.tasks[parts[0]] = {'cmd': parts[2], 'in': {}, 'out': {}}
+                    elif parts[1] in ['in', 'out'] and len(parts) == 6 and parts[0] in self.tasks:
+                        self.tasks[parts[0]][parts[1]][parts[2]] = {'size': int(parts[3]), 'mtime': int(parts[4]),
+                                                                    'md5': parts[5]}
+                    elif parts[1] == 'started' and len(parts) == 4:
+                        self.started[parts[0]] = {'cmd': parts[2], 'in': {}, 'out': [], 'intermediate': [],
+                                                  'marker': parts[3]}
+                    elif parts[1] == 'started_in' and len(parts) == 6 and parts[0] in self.started:
+                        self.started[parts[0]]['in'][parts[2]] = {'size': int(parts[3]), 'mtime': int(parts[4]),
+                                                                  'md5': parts[5]}
+                    elif parts[1] == 'started_out' and len(parts) == 4 and parts[0] in self.started:
+                        self.started[parts[0]]['out'].append(parts[2])
+                        if parts[3] == '1':
+                            self.started[parts[0]]['intermediate'].append(parts[2])
+
+            # record jobs of an earlier run that finished in the meantime
+            if any(os.path.exists(task['marker']) for task in self.started.values()):
+                self.__record_finished()
+                self.write()
+
+    @staticmethod
+    def command_id(command, variables):
+        """
+        Combines a command and the variables it is run with into a checksum, used to detect changes in the command or
+        its settings. The marker file (done) and sample name are not included.
+
+        :param command: command (with placeholders for the variables)
+        :param variables: dict with the variables for the command
+        :return: hexadecimal md5 checksum
+        """
+        settings = '\t'.join('%s=%s' % (k, v) for k, v in sorted(variables.items()) if k not in ['done', 'sample'])
+
+        return hashlib.md5((command + '\n' + settings).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def __fingerprint(filename, use_hash):
+        if not os.path.exists(filename):
+            # unknown, never matches a file
+            return {'size': -1, 'mtime': -1, 'md5': '-'}
+
+        size, mtime = file_fingerprint(filename)
+
+        return {'size': size, 'mtime': mtime, 'md5': file_hash(filename) if use_hash else '-'}
+
+    @staticmethod
+    def __unchanged(filename, entry):
+        if not os.path.exists(filename):
+            return False
+
+        size, mtime = file_fingerprint(filename)
+
+        if (size, mtime) == (entry['size'], entry['mtime']):
+            return True
+
+        return size == entry['size'] and entry['md5'] != '-' and file_hash(filename) == entry['md5']
+
+    def done(self, key, command, inputs, outputs, intermediate=None):
+        """
+        Checks if a task was completed before with the same command and inputs, and its outputs are still intact
+
+        :param key: unique name of the task (e.g. the sample)
+        :param command: command id (see command_id)
+        :param inputs: list of input files
+        :param outputs: list of output files
+        :param intermediate: list of files that are removed once the next step is done (e.g. trimmed reads), these are
+                             only checked if they exist (default = None)
+        :return: True if the task doesn't need to run again, False otherwise
+        """
+        if key not in self.tasks:
+            return False
+
+        task = self.tasks[key]
+        removed = set(f for f in (intermediate or []) if not os.path.exists(f))
+
+        if task['cmd'] != command or set(task['in'].keys()) != set(inputs) or set(task['out'].keys()) != set(outputs):
+            return False
+
+        return all(f in removed or self.__unchanged(f, e) for f, e in task['in'].items()) and \
+            all(f in removed or self.__unchanged(f, e) for f, e in task['out'].items())
+
+    def start(self, key, command, inputs, outputs, intermediate=None):
+        """
+        Registers a task that is about to be submitted. The job should create the returned marker file when (and only
+        when) it succeeds, see PipelineBase.mark_done. Any previous record of the task is removed.
+
+        The inputs are fingerprinted here, so changes made while the job runs are detected by the next run. Inputs that
+        don't exist yet (written by a job the task depends on) are fingerprinted once the task is finished.
+
+        :param key: unique name of the task (e.g. the sample)
+        :param command: command id (see command_id)
+        :param inputs: list of input files
+        :param outputs: list of output files
+        :param intermediate: list of outputs that may be removed before the task is recorded (e.g. trimmed reads that
+                             are removed once they are aligned), these don't need to exist when finished (default = None)
+        :return: path to the marker file
+        """
+        marker = '%s.%s.done' % (os.path.abspath(self.filename), hashlib.md5(key.encode('utf-8')).hexdigest()[:12])
+
+        if os.path.exists(marker):
+            os.remove(marker)
+
+        self.tasks.pop(key, None)
+        self.started[key] = {'cmd': command, 'in': {f: self.__fingerprint(f, self.use_hash) for f in inputs},
+                             'out': list(outputs), 'intermediate': [f for f in outputs if f in (intermediate or [])],
+                             'marker': marker}
+
+        return marker
+
+    def __record_finished(self):
+        """
+        Records started tasks that succeeded and had all their outputs written and removes their marker files, tasks
+        that didn't finish (yet) are kept as started
+        """
+        for key, task in list(self.started.items()):
+            if os.path.exists(task['marker']):
+                os.remove(task['marker'])
+                del self.started[key]
+
+                if all(os.path.exists(f) or f in task['intermediate'] for f in task['out']):
+                    self.tasks[key] = {'cmd': task['cmd'],
+                                       'in': {f: e if e['size'] >= 0 else self.__fingerprint(f, self.use_hash)
+                                              for f, e in task['in'].items()},
+                                       'out': {f: self.__fingerprint(f, False) for f in task['out']}}
+
+    def finish(self):
+        """
+        Records all started tasks that succeeded and had all their outputs written, removes the marker files and writes
+        the manifest to disk. Tasks that didn't succeed are forgotten.
+        """
+        self.__record_finished()
+
+        self.started = {}
+        self.write()
+
+    def write(self):
+        """
+        Writes the manifest to disk, including the tasks that were started but aren't finished
+        """
+        with open(self.filename + '.tmp', 'w') as f:
+            for key, task in self.tasks.items():
+                print(key, 'cmd', task['cmd'], sep='\t', file=f)
+                for io in ['in', 'out']:
+                    for filename, e in task[io].items():
+                        print(key, io, filename, e['size'], e['mtime'], e['md5'], sep='\t', file=f)
+            for key, task in self.started.items():
+                print(key, 'started', task['cmd'], task['marker'], sep='\t', file=f)
+                for filename, e in task['in'].items():
+                    print(key, 'started_in', filename, e['size'], e['mtime'], e['md5'], sep='\t', file=f)
+                for filename in task['out']:
+                    print(key, 'started_out', filename, 1 if filename in task['intermediate'] else 0, sep='\t',
+                          file=f)
+
+        os.replace(self.filename + '.tmp', self.filename)
@@ -1,116 +1,433 @@
-from .parser.fasta import Fasta
+import numpy as np
+import os
+import sys
 
+from .parser.fasta import sequence_lengths
 
-def read_matrix(filename):
+BINARY_MAGIC = b'LSTRAPMX'
+
+# rows with statistics in htseq-count output, these aren't genes
+HTSEQ_STATISTICS = ('no_feature', 'ambiguous', 'too_low_aQual', 'not_aligned', 'alignment_not_unique')
+
+
+class ExpressionMatrix:
+    """
+    Expression matrix with genes as rows and samples (conditions) as columns. Values are kept in a single contiguous
+    numpy array, genes and samples can be looked up through gene_index and sample_index.
     """
-    Reads a matrix and returns a dictionary with the data and list of conditions (tuple of dict and list)
+    def __init__(self, genes, samples, values):
+        """
+        Constructor
+
+        :param genes: list with gene ids (rows)
+        :param samples: list with sample names (columns)
+        :param values: 2d array-like with the values (genes x samples)
+        """
+        self.genes = list(genes)
+        self.samples = list(samples)
+        self.values = np.ascontiguousarray(values).reshape(len(self.genes), len(self.samples))
+
+        self.gene_index = {g: i for i, g in enumerate(self.genes)}
+        self.sample_index = {s: i for i, s in enumerate(self.samples)}
+
+    def __len__(self):
+        return len(self.genes)
+
+    def __contains__(self, gene):
+        return gene in self.gene_index
+
+    @classmethod
+    def read(cls, filename, dtype=np.float64, prefer_binary=True):
+        """
+        Reads a matrix from a tab-delimited file, the first row contains the sample names, the first column the gene ids
+
+        If there is an up-to-date binary copy of the matrix (see binary_path) that one is read instead, note that values
+        are stored as float32 in the binary file.
+
+        :param filename: path to the matrix
+        :param dtype: type to store the values as (default = float64)
+        :param prefer_binary: read the binary copy if available (default = True)
+        :return: ExpressionMatrix
+        """
+        if prefer_binary and has_binary(filename):
+            matrix = cls.read_binary(binary_path(filename))
+            matrix.values = matrix.values.astype(dtype)
+            return matrix
+
+        with open(filename, "r") as f:
+            samples = f.readline().rstrip('\n').split('\t')[1:]
+            genes = [row.split('\t', 1)[0] for row in f if row.strip() != '']
+
+        if len(genes) > 0 and len(samples) > 0:
+            # comments=None, otherwise rows from a gene id with a # are cut off
+            values = np.loadtxt(filename, delimiter='\t', skiprows=1, usecols=range(1, len(samples) + 1), dtype=dtype,
+                                ndmin=2, comments=None)
+        else:
+            values = np.zeros((len(genes), len(samples)), dtype=dtype)
+
+        return cls(genes, samples, values)
+
+    @classmethod
+    def from_htseq(cls, filenames, samples=None, exclude=HTSEQ_STATISTICS, gene_lists=None):
+        """
+        Builds a count matrix from htseq-count output files, one file at a time. Genes are indexed based on the first
+        file, counts of each other file are written into a preallocated column. Genes missing from the first file are
+        added when encountered, genes missing from a file get a count of zero.
+
+        :param filenames: list of paths to htseq-count files
+        :param samples: sample names to use as header, set to None to use the filenames (default = None)
+        :param exclude: genes containing any of these are left out, to skip the htseq-count statistics
+        :param gene_lists: dict to which the genes of each file are added (by sample name, without the excluded genes),
+                           these give the order of genes when the matrix is updated later, see merge_genes
+                           (default = None)
+        :return: ExpressionMatrix with counts (int32, int64 when required)
+        """
+        samples = filenames if samples is None else samples
+
+        genes, gene_index = [], {}
+        values = None
+
+        for column, filename in enumerate(filenames):
+            file_genes, file_counts = [], []
+
+            with open(filename, "r") as f:
+                for row in f:
+                    parts = row.rstrip().rsplit('\t', 1)
+                    if len(parts) == 2:
+                        file_genes.append(parts[0].strip())
+                        file_counts.append(parts[1])
+
+            counts = np.array(file_counts, dtype=np.int64)
+
+            if gene_lists is not None:
+                gene_lists[samples[column]] = [g for g in dict.fromkeys(file_genes) if all(x not in g for x in exclude)]
+
+            if values is None:
+                # a gene listed twice gets a single row, as for the other files
+                genes = list(dict.fromkeys(file_genes))
+                gene_index = {g: i for i, g in enumerate(genes)}
+                values = np.zeros((len(genes), len(filenames)), dtype=np.int32)
+
+            if file_genes == genes:
+                indices = np.arange(len(genes))
+            else:
+                new_genes = [g for g in dict.fromkeys(file_genes) if g not in gene_index]
+
+                if len(new_genes) > 0:
+                    gene_index.update({g: i for i, g in enumerate(new_genes, start=len(genes))})
+                    genes = genes + new_genes
+                    values = np.concatenate([values, np.zeros((len(new_genes), len(filenames)), dtype=values.dtype)])
+
+                indices = np.array([gene_index[g] for g in file_genes], dtype=np.intp)
+
+            if len(counts) > 0 and counts.max() > np.iinfo(values.dtype).max:
+                values = values.astype(np.int64)
+
+            values[indices, column] = counts
+
+        if values is None:
+            values = np.zeros((0, len(filenames)), dtype=np.int32)
+
+        keep = [i for i, g in enumerate(genes) if all(x not in g for x in exclude)]
+
+        return cls([genes[i] for i in keep], samples, values[keep])
+
+    def write(self, filename, chunk_size=1000, binary=False):
+        """
+        Writes the matrix to a tab-delimited text file
+
+        :param filename: the output file
+        :param chunk_size: number of rows converted to text at once (default = 1000)
+        :param binary: also write a binary copy (see write_binary and binary_path), an outdated copy is removed
+                       otherwise (default = False)
+        """
+        with open(filename, "w") as f:
+            print("gene\t" + '\t'.join(self.samples), file=f)
+
+            for start in range(0, len(self.genes), chunk_size):
+                # tolist converts to python types, str() then gives the shortest representation of each value
+                rows = self.values[start:start + chunk_size].tolist()
+                f.writelines(gene + '\t' + '\t'.join(map(str, row)) + '\n'
+                             for gene, row in zip(self.genes[start:start + chunk_size], rows))
+
+        if binary:
+            self.write_binary(binary_path(filename))
+        elif os.path.exists(binary_path(filename)):
+            os.remove(binary_path(filename))
+
+    @classmethod
+    def read_binary(cls, filename):
+        """
+        Reads a matrix from a binary file, see write_binary. The values are memory-mapped and only read from disk when
+        they are used.
+
+        :param filename: path to the binary matrix
+        :return: ExpressionMatrix with float32 values
+        """
+        genes, samples, values = read_binary_matrix(filename)
+
+        return cls(genes, samples, values)
+
+    def write_binary(self, filename):
+        """
+        Writes the matrix to a binary file, starting with a header that contains the dimensions of the matrix, the genes
+        and samples followed by the values as float32 (genes x samples, row-major). The values start at a multiple of 64
+        bytes so they can be memory-mapped.
+
+        :param filename: the output file
+        """
+        names = '\n'.join(self.genes + self.samples).encode('utf-8')
+        offset = -(-(len(BINARY_MAGIC) + 24 + len(names)) // 64) * 64
+
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(BINARY_MAGIC)
+            f.write(np.array([len(self.genes), len(self.samples), offset], dtype='<u8').tobytes())
+            f.write(names)
+            f.write(b'\0' * (offset - len(BINARY_MAGIC) - 24 - len(names)))
+
+            for start in range(0, len(self.genes), 10000):
+                f.write(np.ascontiguousarray(self.values[start:start + 10000], dtype='<f4').tobytes())
+
+        os.replace(filename + '.tmp', filename)
+
+    def subset(self, genes):
+        """
+        Selects genes from the matrix
+
+        :param genes: list with gene ids to keep (in that order)
+        :return: ExpressionMatrix with the selected genes
+        """
+        return ExpressionMatrix(genes, self.samples, self.values[[self.gene_index[g] for g in genes]])
+
+    def select_samples(self, samples):
+        """
+        Selects samples (columns) from the matrix
+
+        :param samples: list with samples to keep (in that order)
+        :return: ExpressionMatrix with the selected samples
+        """
+        return ExpressionMatrix(self.genes, samples, self.values[:, [self.sample_index[s] for s in samples]])
+
+    def update(self, other, samples=None, genes=None):
+        """
+        Combines two matrices, samples in the other matrix are added or replace samples with the same name. Genes that
+        are only found in the other matrix are added at the end, missing values are set to zero.
+
+        :param other: ExpressionMatrix with the new samples
+        :param samples: list with the samples to include (in that order), set to None to include all samples
+                        (default = None)
+        :param genes: list with the genes to include (in that order), e.g. from merge_genes, set to None to include all
+                      genes (default = None)
+        :return: ExpressionMatrix with the combined values
+        """
+        if genes is None:
+            genes = self.genes + [g for g in other.genes if g not in self.gene_index]
+        gene_rows = {g: i for i, g in enumerate(genes)}
 
-    :param filename: the matrix containing genes id , conditions and reads
-    :return: data, conditions
+        if samples is None:
+            samples = self.samples + [s for s in other.samples if s not in self.sample_index]
+
+        values = np.zeros((len(genes), len(samples)), dtype=np.result_type(self.values, other.values))
+
+        own = [(j, self.sample_index[s]) for j, s in enumerate(samples)
+               if s in self.sample_index and s not in other.sample_index]
+        new = [(j, other.sample_index[s]) for j, s in enumerate(samples) if s in other.sample_index]
+
+        for matrix, selected in [(self, own), (other, new)]:
+            rows = [(gene_rows[g], i) for i, g in enumerate(matrix.genes) if g in gene_rows]
+
+            if len(selected) > 0 and len(rows) > 0:
+                columns, source = zip(*selected)
+                target, source_rows = zip(*rows)
+                values[np.ix_(list(target), list(columns))] = matrix.values[np.ix_(list(source_rows), list(source))]
+
+        return ExpressionMatrix(genes, samples, values)
+
+    def cpm(self):
+        """
+        Normalizes values per sample to counts per million
+
+        :return: ExpressionMatrix with the normalized values, samples without any counts are set to zero
+        """
+        return ExpressionMatrix(self.genes, self.samples, scale_columns(self.values))
+
+    def rpkm(self, lengths):
+        """
+        RPKM normalization, counts per million divided by the gene length in kb. Genes without a length are dropped,
+        they are taken into account to get the total number of reads of each sample though.
+
+        :param lengths: dictionary with the length of each gene in bp (see read_gene_lengths)
+        :return: ExpressionMatrix with the normalized values
+        """
+        genes, kb = self.__lengths(lengths)
+
+        cpm = self.cpm()
+
+        return ExpressionMatrix(genes, self.samples, cpm.values[[self.gene_index[g] for g in genes]] / kb[:, None])
+
+    def tpm(self, lengths):
+        """
+        TPM normalization, counts divided by the gene length in kb and scaled so each sample sums up to a million.
+        Genes without a length are dropped.
+
+        :param lengths: dictionary with the length of each gene in bp (see read_gene_lengths)
+        :return: ExpressionMatrix with the normalized values
+        """
+        genes, kb = self.__lengths(lengths)
+
+        rates = self.values[[self.gene_index[g] for g in genes]] / kb[:, None]
+
+        return ExpressionMatrix(genes, self.samples, scale_columns(rates))
+
+    def __lengths(self, lengths):
+        """
+        Looks up the length of each gene, genes without a sequence are reported
+
+        :param lengths: dictionary with the length of each gene in bp
+        :return: tuple with the list of genes with a length and a numpy array with their length in kb
+        """
+        genes = []
+
+        for gene_id in self.genes:
+            if lengths.get(gene_id, 0) > 0:
+                genes.append(gene_id)
+            else:
+                print("No sequence", gene_id)
+
+        return genes, np.array([lengths[g] for g in genes], dtype=np.float64) / 1000
+
+
+def merge_genes(gene_lists):
     """
-    data = {}
-    with open(filename, "r") as f:
-        header = f.readline().strip().split('\t')
-        conditions = header[1:]
+    Combines the genes found in several htseq-count files in the order ExpressionMatrix.from_htseq gives when reading
+    these files: by first occurrence, in the order of the files
 
-        for row in f:
-            parts = row.strip().split('\t')
-            gene_id = parts[0]
-            expression_values = parts[1:]
+    :param gene_lists: list with, for each file, the list of genes (see ExpressionMatrix.from_htseq)
+    :return: list of genes
+    """
+    return list(dict.fromkeys(g for genes in gene_lists for g in genes))
 
-            gene_data = {}
-            for condition, read_counts in zip(conditions, expression_values):
-                gene_data[condition] = read_counts
 
-            data[gene_id] = gene_data
+def binary_path(filename):
+    """
+    Returns the path of the binary copy of a matrix
 
-        return data, conditions
+    :param filename: path to the tab-delimited matrix
+    :return: path to the binary matrix
+    """
+    return filename + '.bin'
 
 
-def write_matrix(filename, conditions, data):
+def has_binary(filename):
     """
-    Writes a matrix to a text file
+    Checks if there is a binary copy of a matrix that is at least as recent as the tab-delimited matrix
 
-    :param filename: the output file
-    :param conditions: experimental conditions (will be the header)
-    :param data: gene id and reads
+    :param filename: path to the tab-delimited matrix
+    :return: True if the binary copy can be used
     """
-    with open(filename, "w") as f_norm:
-        # print(header)
-        header = '\t'.join(conditions)
-        print("gene\t" + header, file=f_norm)
+    binary = binary_path(filename)
 
-        for gene_id in data:
-            nv = []
-            for condition in conditions:
-                nv.append(str(data[gene_id][condition]))
-            joined_values = '\t'.join(nv)
-            print(gene_id + "\t" + joined_values, file=f_norm)
+    return os.path.exists(binary) and \
+        (not os.path.exists(filename) or os.path.getmtime(binary) >= os.path.getmtime(filename))
 
 
-def normalize_matrix_counts(data, conditions):
+def read_binary_matrix(filename):
     """
-    Calculates the scoring factor that is needed to claculate TPM
+    Reads a binary matrix, see ExpressionMatrix.write_binary
 
-    :param data: data form read_matrix
-    :param conditions: conditions form read_matrix
-    :return: dictionary normalized_data in which gene_id is the key , values are normalized data
+    :param filename: path to the binary matrix
+    :return: tuple with the list of genes, list of samples and the values (memory-mapped numpy array)
     """
-    read_counts = {}
+    with open(filename, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError("%s is not a binary expression matrix" % filename)
 
-    for condition in conditions:
-        total = 0
-        for gene_id in data:
-            total += int(data[gene_id][condition])
+        gene_count, sample_count, offset = np.frombuffer(f.read(24), dtype='<u8').tolist()
+        names = f.read(offset - len(BINARY_MAGIC) - 24).rstrip(b'\0').decode('utf-8').split('\n')
 
-        read_counts[condition] = total
+    genes, samples = names[:gene_count], names[gene_count:gene_count + sample_count]
 
-    normalized_data = {}
+    if gene_count * sample_count == 0:
+        return genes, samples, np.zeros((gene_count, sample_count), dtype=np.float32)
 
-    for gene_id in data:
-        gene_normalized_data = {}
+    return genes, samples, np.memmap(filename, dtype='<f4', mode='r', offset=offset, shape=(gene_count, sample_count))
 
-        for condition in conditions:
-            if read_counts[condition] != 0:
-                gene_normalized_data[condition] = (int(data[gene_id][condition]) * 1000000)/read_counts[condition]
-            else:
-                # print('Condition without reads', condition)
-                gene_normalized_data[condition] = 0
 
-        normalized_data[gene_id] = gene_normalized_data
+def scale_columns(values, total=1000000):
+    """
+    Scales each column of an array so its values add up to total, columns that add up to zero are set to zero
+
+    :param values: 2d numpy array
+    :param total: desired sum of each column (default = 1000000)
+    :return: 2d numpy array (float64) with the scaled values
+    """
+    sums = values.sum(axis=0, dtype=np.float64)
+    scaled = np.zeros(values.shape, dtype=np.float64)
+
+    np.divide(values * float(total), sums, out=scaled, where=sums != 0)
+
+    return scaled
+
+
+def length_index_path(fasta_file):
+    """
+    Returns the path of the gene length index that belongs to a fasta file
+
+    :param fasta_file: fasta file with genes
+    :return: path to the index
+    """
+    return fasta_file + '.lengths.tsv'
+
+
+def length_index_key(fasta_file):
+    """
+    Identifies the exact version of a fasta file, the index is rebuilt when any of these change
+
+    :param fasta_file: fasta file with genes
+    :return: string with the path, size and modification time of the file
+    """
+    stat = os.stat(fasta_file)
 
-    return normalized_data
+    return '#%s\t%d\t%d' % (os.path.abspath(fasta_file), stat.st_size, stat.st_mtime_ns)
 
 
-def normalize_matrix_length(data, fasta_file):
+def read_gene_lengths(fasta_file, use_index=True):
     """
-    Needed during calculating TPM and RPKM
-    calculates the read_counts divided by the gene length
+    Gets the length of each sequence in a fasta file, used to normalize for gene length during calculating TPM and RPKM
+
+    Lengths are stored in an index next to the fasta file (see length_index_path), which is reused as long as the path,
+    size and modification time of the fasta file match. If there is no valid index the fasta file is read (without
+    keeping sequences in memory) and the index is (re)built.
 
-    :param data: data from read_matrix
     :param fasta_file: fasta file with genes of the analyzed genome
-    :return: dictionary with the obtained values in which gene_id is the key
+    :param use_index: set to False to ignore the index and always read the fasta file (default = True)
+    :return: dictionary with the length (in bp) of each gene
     """
-    fasta_reader = Fasta()
-    fasta_reader.readfile(fasta_file)
-    fasta_lengths = {}
-    length_normalized_data = {}
+    if not use_index:
+        return dict(sequence_lengths(fasta_file))
 
-    for gene_id, sequence in fasta_reader.sequences.items():
-        # length in kb so divided by 1000
-        lenseq = len(sequence)/1000
-        fasta_lengths[gene_id] = lenseq
+    index_file = length_index_path(fasta_file)
+    key = length_index_key(fasta_file)
 
-    for gene_id in data:
-        if gene_id in fasta_lengths:
-            if fasta_lengths[gene_id] > 0:
-                length_normalized_data[gene_id] = {}
-                for condition in data[gene_id]:
-                    length_normalized_data[gene_id][condition] = float(data[gene_id][condition]) / fasta_lengths[gene_id]
+    if os.path.exists(index_file):
+        with open(index_file, 'r') as f:
+            if f.readline().rstrip('\n') == key:
+                lengths = {}
+                for line in f:
+                    gene_id, length = line.rstrip('\n').rsplit('\t', 1)
+                    lengths[gene_id] = int(length)
 
-            else:
-                print("No sequence", gene_id)
-        else:
-            print("No sequence", gene_id)
+                return lengths
+
+    lengths = dict(sequence_lengths(fasta_file))
+
+    try:
+        with open(index_file + '.tmp', 'w') as f:
+            print(key, file=f)
+            f.writelines('%s\t%d\n' % (gene_id, length) for gene_id, length in lengths.items())
+
+        os.replace(index_file + '.tmp', index_file)
+    except OSError as e:
+        print("Could not write gene length index %s (%s)" % (index_file, e), file=sys.stderr)
 
-    return length_normalized_data
+    return lengths